@@ -19,14 +19,24 @@ DISCLAIMER:
 # ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
 
 
+import hmac
+import os
 import pickle
+import threading
+import time
 
+import metrics
 
+
+@metrics.timed_methods
 class Admin:
     """Singleton Admin class managing admin credentials and authentication."""
 
     _instance = None
     _file = "admin.pickle"
+    # (file stamp, Admin) of the last load, reused while the file is unchanged.
+    _cache = None
+    _cache_lock = threading.Lock()
 
     def __new__(cls):
         """Create a singleton instance of Admin if it doesn't exist."""
@@ -39,8 +49,11 @@ class Admin:
 
     def save_to_file(self):
         """Save the Admin instance to a pickle file."""
+        start = time.perf_counter()
+        data = pickle.dumps(self)
         with open(self._file, "wb") as file:
-            pickle.dump(self, file)
+            file.write(data)
+        metrics.record_write("admin", len(data), start)
 
     @staticmethod
     def validate_credential(ipid, ippass):
@@ -54,15 +67,45 @@ class Admin:
         Returns:
         - bool: True if credentials are valid, False otherwise.
         """
+        admin_instance = Admin._load()
+        if admin_instance is None:
+            print("Admin pickle file not found.")
+            return False
+        return hmac.compare_digest(
+            str(ipid).encode("utf-8"), admin_instance.__id.encode("utf-8")
+        ) & hmac.compare_digest(
+            str(ippass).encode("utf-8"), admin_instance.__password.encode("utf-8")
+        )
+
+    @staticmethod
+    def _load():
+        """
+        Load the Admin instance from its pickle file, reusing the last one
+        read while the file is unchanged.
+
+        Returns:
+        - Admin: The stored instance, or None if the file doesn't exist.
+        """
+        try:
+            st = os.stat(Admin._file)
+        except FileNotFoundError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with Admin._cache_lock:
+            if Admin._cache is not None and Admin._cache[0] == stamp:
+                return Admin._cache[1]
         try:
             with open(Admin._file, "rb") as file:
-                admin_instance = pickle.load(file)
-                if ipid == admin_instance.__id and ippass == admin_instance.__password:
-                    return True
-                return False
+                data = file.read()
         except FileNotFoundError:
-            print("Admin pickle file not found.")
-            return False
+            return None
+        metrics.record_read("admin", len(data))
+        start = time.perf_counter()
+        admin_instance = pickle.loads(data)
+        metrics.record_deserialize("admin", start)
+        with Admin._cache_lock:
+            Admin._cache = (stamp, admin_instance)
+        return admin_instance
 
 
 # End of Admin class
@@ -17,7 +17,24 @@ DISCLAIMER:
 
 # $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $
 
-from flask import Flask, render_template, url_for, request, redirect
+from datetime import datetime
+import hmac
+import json
+import os
+
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    url_for,
+    request,
+    redirect,
+    abort,
+    jsonify,
+    stream_with_context,
+    before_render_template,
+    template_rendered,
+)
 
 from occupant import (
     PaymentStrategy,
@@ -62,13 +79,133 @@ from ps import (
 
 from admin import Admin
 
+from unit_of_work import UnitOfWork
+
+from storage import get_backend, OCCUPANTS
+
+from response_cache import cached_page
+
+from export import FORMATS, date_bound, iter_chunks, iter_rows
+
+import rollups
+
+from payment_queue import FAILED, get_queue
+
+import metrics
+import profiling
+
+from sessions import (
+    COOKIE_NAME,
+    OCCUPANT as OCCUPANT_ROLE,
+    CLIENT as CLIENT_ROLE,
+    ADMIN as ADMIN_ROLE,
+    get_manager,
+    json_stamp,
+    occupant_projection,
+    client_projection,
+    admin_projection,
+)
+
 # $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $ - $
 
 app = Flask(__name__)
+profiling.install(app)
+_watcher = None
+
 
+@app.before_request
+def start_timing():
+    metrics.begin_request()
+
+
+@app.after_request
+def record_timing(response):
+    # The URL rule, not the path, so /metrics has one series per route.
+    rule = request.url_rule
+    metrics.end_request(
+        rule.rule if rule is not None else "unmatched",
+        request.method,
+        response.status_code,
+    )
+    return response
 
-class User:
-    _current = None
+
+@before_render_template.connect_via(app)
+def render_started(sender, template, context, **extra):
+    metrics.render_started()
+
+
+@template_rendered.connect_via(app)
+def render_finished(sender, template, context, **extra):
+    metrics.render_finished(template.name)
+
+
+@app.route("/metrics")
+def metrics_page():
+    """
+    Metrics of this worker process in Prometheus text format. Only for a
+    logged-in administrator, or a scraper sending ``HCMS_METRICS_TOKEN`` as
+    its bearer token.
+    """
+    token = metrics.TOKEN
+    scraper = token and hmac.compare_digest(
+        request.headers.get("Authorization", "").encode("utf-8"),
+        ("Bearer " + token).encode("utf-8"),
+    )
+    if not scraper and current_user(ADMIN_ROLE) is None:
+        abort(403)
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def login(response, data):
+    """
+    Start a session for a logged-in user and set its cookie on the response.
+
+    Args:
+    - response: Flask response to attach the cookie to.
+    - data (dict): Session data (see ``sessions.py``).
+
+    Returns:
+    - The response.
+    """
+    manager = get_manager()
+    response.set_cookie(
+        COOKIE_NAME,
+        manager.create(data),
+        max_age=manager.ttl,
+        httponly=True,
+        samesite="Lax",
+    )
+    return response
+
+
+def current_user(role):
+    """
+    Session data of the user logged in on this request.
+
+    Args:
+    - role (str): ``OCCUPANT_ROLE``, ``CLIENT_ROLE`` or ``ADMIN_ROLE``.
+
+    Returns:
+    - dict: Session data, or None if no user of that role is logged in.
+    """
+    token = request.cookies.get(COOKIE_NAME)
+    manager = get_manager()
+    data = manager.load(token)
+    if data is None or data.get("role") != role:
+        return None
+    if role == OCCUPANT_ROLE:
+        # Reload the projection once the occupant store has been written.
+        stamp = get_backend().stamp(OCCUPANTS)
+        if data.get("stamp") != json_stamp(stamp):
+            try:
+                occupant = OCCUPANT_DB.get_occupant(data["email"])
+            except KeyError:
+                manager.destroy(token)
+                return None
+            data = occupant_projection(occupant, stamp)
+            manager.update(token, data)
+    return data
 
 
 @app.route("/")
@@ -91,7 +228,7 @@ def admin_login():
 
     if Admin.validate_credential(user_id, password):
         # Redirect to admin.html upon successful login
-        return redirect(url_for("admin_panel"))
+        return login(redirect(url_for("admin_panel")), admin_projection(user_id))
     else:
         # Show invalid credentials alert using JavaScript alert
         return """
@@ -107,16 +244,48 @@ def admin_panel():
     return render_template("admin_panel.html")
 
 
+def _month_arg(name):
+    """Read a "YYYY-MM" query argument, aborting with 400 if malformed."""
+    value = request.args.get(name) or None
+    if value is not None:
+        try:
+            datetime.strptime(value, "%Y-%m")
+        except ValueError:
+            abort(400, "Invalid month: %s" % value)
+    return value
+
+
+@app.route("/admin/reports")
+def admin_reports():
+    """
+    Payment totals per month and per block, read from the rollups.
+
+    Query arguments: ``start`` and ``end`` months ("YYYY-MM") and an
+    optional ``email`` whose lifetime total is added. Only for a logged-in
+    administrator.
+    """
+    if current_user(ADMIN_ROLE) is None:
+        abort(403)
+    report = rollups.report(_month_arg("start"), _month_arg("end"))
+    email = request.args.get("email")
+    if email:
+        total, count = rollups.lifetime_paid(email)
+        report["occupant"] = {"email": email, "total": total, "count": count}
+    return jsonify(report)
+
+
 @app.route("/unoccu.html")
+@cached_page("community")
 def unoccu():
-    hc = HousingCommunity.GET_HC()
+    hc = HousingCommunity.snapshot()
     unoccupied_flats = hc.get_unoccupied_flats_info()
     return render_template("unoccu.html", unoccupied_flats=unoccupied_flats)
 
 
 @app.route("/occu.html")
+@cached_page("community", OCCUPANTS)
 def occu():
-    hc = HousingCommunity.GET_HC()
+    hc = HousingCommunity.snapshot()
     unoccupied_flats = hc.list_occupied_flats()
     return render_template("occu.html", unoccupied_flats=unoccupied_flats)
 
@@ -156,18 +325,106 @@ def add_flat():
             return f"Error: {str(e)}"
 
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _date_bound(value, upper):
+    """Parse a date filter of the query string, answering 400 if invalid."""
+    try:
+        return date_bound(value, upper)
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def payment_page(email=None):
+    """
+    Fetch the page of payments asked for by the query string.
+
+    Query arguments: ``sort`` (date, amount or email), ``order`` (asc or
+    desc), ``start`` and ``end`` dates, ``cursor`` and ``limit``.
+
+    Args:
+    - email (str): Only list this occupant's payments.
+
+    Returns:
+    - tuple: (payment rows, URL of the next page or None)
+    """
+    args = request.args
+    try:
+        limit = int(args.get("limit", PAGE_SIZE))
+    except ValueError:
+        abort(400, "Invalid limit")
+    try:
+        rows, cursor = PaymentDB.get_payments_page(
+            sort=args.get("sort", "date"),
+            descending=args.get("order", "asc") == "desc",
+            start=_date_bound(args.get("start"), upper=False),
+            end=_date_bound(args.get("end"), upper=True),
+            email=email,
+            cursor=args.get("cursor"),
+            limit=max(1, min(limit, MAX_PAGE_SIZE)),
+        )
+    except ValueError as e:
+        abort(400, str(e))
+    next_url = None
+    if cursor is not None:
+        next_url = url_for(request.endpoint, **{**args.to_dict(), "cursor": cursor})
+    return rows, next_url
+
+
 @app.route("/payments")
+@cached_page("payments")
 def display_payments():
-    payment_rows = PaymentDB.get_payments()
-    return render_template("payments.html", payment_rows=payment_rows)
+    payment_rows, next_url = payment_page(email=request.args.get("email") or None)
+    return render_template(
+        "payments.html", payment_rows=payment_rows, next_url=next_url
+    )
+
+
+@app.route("/payments/export")
+def export_payments():
+    """
+    Stream the payments as CSV or JSONL, a chunk at a time.
+
+    Query arguments: ``format`` (csv or jsonl), ``start`` and ``end`` dates,
+    ``block``, ``min_amount`` and ``max_amount``. Only for a logged-in
+    administrator.
+    """
+    if current_user(ADMIN_ROLE) is None:
+        abort(403)
+    args = request.args
+    fmt = args.get("format", "csv")
+    if fmt not in FORMATS:
+        abort(400, "Unknown export format: %s" % fmt)
+    try:
+        min_amount, max_amount = (
+            float(args[name]) if args.get(name) else None
+            for name in ("min_amount", "max_amount")
+        )
+    except ValueError:
+        abort(400, "Invalid amount")
+    rows = iter_rows(
+        start=_date_bound(args.get("start"), upper=False),
+        end=_date_bound(args.get("end"), upper=True),
+        block=args.get("block") or None,
+        min_amount=min_amount,
+        max_amount=max_amount,
+    )
+    return Response(
+        stream_with_context(iter_chunks(rows, fmt)),
+        mimetype=FORMATS[fmt],
+        headers={"Content-Disposition": "attachment; filename=payments.%s" % fmt},
+    )
 
 
 # { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ }
 
 
 @app.route("/or.html")
+@cached_page("community")
 def Occupant_Registration():
-    hc = HousingCommunity.GET_HC()
+    hc = HousingCommunity.snapshot()
     unoccupied_flats = hc.get_unoccupied_flats_info()
     return render_template("or.html", unoccupied_flats=unoccupied_flats)
 
@@ -195,13 +452,20 @@ def submit_occupant_registration():
         flat_details = selected_flat.split("-")
         block_no = flat_details[0]
         flat_no = flat_details[1]
-        hc = HousingCommunity.GET_HC()
-        flat = hc.get_flat_by_details(block_no, flat_no)
-        payment_strategy = choose_payment_stategy(flat)
-        occupant = OCCUPANT(
-            name, phone, aadhar, email, password, block_no, flat_no, payment_strategy
-        )
-        flat.occupy(occupant)
+        try:
+            # Occupant and flat are written together, or not at all.
+            with UnitOfWork():
+                hc = HousingCommunity.GET_HC()
+                flat = hc.get_flat_by_details(block_no, flat_no)
+                if flat is None:
+                    raise HC_ERROR("Flat Doesn't Exist")
+                payment_strategy = choose_payment_stategy(flat)
+                occupant = OCCUPANT(
+                    name, phone, aadhar, email, password, block_no, flat_no, payment_strategy
+                )
+                flat.occupy(occupant)
+        except (HC_ERROR, ValidationException) as e:
+            return f"Error: {str(e)}"
         return "Occupant registered successfully!"
     return "Error submitting form. Please try again."
 
@@ -212,9 +476,13 @@ def Occupant_Login():
         email = request.form["email"]
         password = request.form["password"]
 
-        if OCCUPANT_DB.validate_credential(email, password):
-            User._current = OCCUPANT_DB.get_occupant(email)
-            return redirect(url_for("occupant_page"))
+        stamp = get_backend().stamp(OCCUPANTS)
+        occupant = OCCUPANT_DB.validate_credential(email, password)
+        if occupant:
+            return login(
+                redirect(url_for("occupant_page")),
+                occupant_projection(occupant, stamp),
+            )
         else:
             return render_template(
                 "ol.html", error="Invalid credentials. Please try again."
@@ -229,9 +497,9 @@ def occupant_page():
 
 @app.route("/occupant_payment", methods=["GET"])
 def occupant_payment():
-    if User._current:
-        occupant = User._current
-        amount_to_pay = occupant.get_amount()
+    user = current_user(OCCUPANT_ROLE)
+    if user:
+        amount_to_pay = user["pending_payments"]
         return render_template("occu_pay.html", amount_to_pay=amount_to_pay)
     else:
         return redirect(url_for("Occupant_Login"))
@@ -239,12 +507,19 @@ def occupant_payment():
 
 @app.route("/make_payment", methods=["POST"])
 def make_payment():
-    if User._current:
-        occupant = User._current
-        payment_status = occupant.pay_bill()
-        if payment_status:
-            amount_to_pay = occupant.get_amount()
-            return render_template("occu_pay.html", amount_to_pay=amount_to_pay)
+    user = current_user(OCCUPANT_ROLE)
+    if user:
+        # The payment is journaled and paid by the background writer; the
+        # same key (sent by the page, or derived from the occupant's data
+        # as loaded) posts a double-click or a retry only once.
+        key = (
+            request.form.get("idempotency_key")
+            or request.headers.get("Idempotency-Key")
+            or "%s:%s" % (user["email"], json.dumps(user.get("stamp")))
+        )
+        status = get_queue().submit(key, user["email"], user["pending_payments"])
+        if status != FAILED:
+            return render_template("occu_pay.html", amount_to_pay=0)
         else:
             return "Payment failed. Please try again."
     else:
@@ -253,10 +528,16 @@ def make_payment():
 
 @app.route("/payment_history")
 def payment_history():
-    current_occupant_email = User._current._email_id
-    payment_history = PaymentDB.get_payment_history(current_occupant_email)
+    user = current_user(OCCUPANT_ROLE)
+    if not user:
+        return redirect(url_for("Occupant_Login"))
+    current_occupant_email = user["email"]
+    rows, next_url = payment_page(email=current_occupant_email)
+    payment_history = [{"date": date, "amount": amount} for (_, amount, date) in rows]
 
-    return render_template("payment_history.html", payment_history=payment_history)
+    return render_template(
+        "payment_history.html", payment_history=payment_history, next_url=next_url
+    )
 
 
 # { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ }
@@ -286,9 +567,9 @@ def Client_Login():
         email = request.form["email"]
         password = request.form["password"]
 
-        if CLIENT_DB.validate_credential(email, password):
-            User._current = CLIENT_DB.get_client(email)
-            return redirect(url_for("client_page"))
+        client = CLIENT_DB.validate_credential(email, password)
+        if client:
+            return login(redirect(url_for("client_page")), client_projection(client))
         else:
             return render_template(
                 "cl.html", error="Invalid credentials. Please try again."
@@ -297,9 +578,13 @@ def Client_Login():
 
 
 @app.route("/client")
+@cached_page("community", vary=lambda: current_user(CLIENT_ROLE))
 def client_page():
-    client_name = User._current._name
-    hc = HousingCommunity.GET_HC()
+    user = current_user(CLIENT_ROLE)
+    if not user:
+        return redirect(url_for("Client_Login"))
+    client_name = user["name"]
+    hc = HousingCommunity.snapshot()
     unoccupied_flats = hc.get_unoccupied_flats_info()
     return render_template(
         "client.html", client_name=client_name, unoccupied_flats=unoccupied_flats
@@ -308,5 +593,21 @@ def client_page():
 
 # { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ } { ~ }
 
+def create_app():
+    """
+    Start what a serving process needs and return the app. Importing this
+    module starts nothing, so tools that import it (bench.py) stay idle.
+
+    Usage:
+        gunicorn "app:create_app()"
+        flask --app "app:create_app()" run
+    """
+    global _watcher
+    if _watcher is None and os.environ.get("HCMS_WATCH_FILES", "1") != "0":
+        # Notice store files edited outside the app (see versions.py).
+        _watcher = get_backend().engine.watch()
+    return app
+
+
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
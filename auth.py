@@ -0,0 +1,282 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Password hashing and credential checks for occupants and clients.
+
+Passwords are stored as salted PBKDF2-SHA256 hashes
+(``pbkdf2_sha256$<iterations>$<salt>$<hash>``). Hashing runs on a small,
+bounded thread pool. The pool is a concurrency cap, not a way to free the
+request thread: a login still waits for its hash, but at most
+``HCMS_AUTH_WORKERS`` hashes run at once, so a burst of logins can't take
+every core from the requests that don't hash. Passwords stored in plain
+text by older versions are still accepted and are rehashed on the next
+successful login.
+
+Logins look the email up in a credential index: with the pickle engine, one
+read of the store builds an ``email -> record`` map. Units of work committed
+in this process patch it with the records they wrote; a change made any
+other way (another process, a write outside a unit of work) shows in the
+backend's stamp and reloads it. Engines with cheap point lookups (SQLite)
+are asked for the one record. The validated object is returned, so callers
+don't load it a second time.
+
+``HCMS_AUTH_WORKERS`` sets the size of the hashing pool.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import hmac
+import os
+import threading
+
+import records
+from storage import get_backend
+from unit_of_work import UnitOfWork
+
+ALGORITHM = "pbkdf2_sha256"
+ITERATIONS = 100_000
+SALT_BYTES = 16
+
+WORKERS = int(os.environ.get("HCMS_AUTH_WORKERS", min(4, os.cpu_count() or 1)))
+# Hash jobs allowed to wait for a worker before callers block.
+QUEUE_DEPTH = WORKERS * 8
+
+_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="hcms-auth")
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_DEPTH)
+
+
+def _submit(func, *args):
+    """Queue ``func`` on the hashing pool once a slot is free."""
+    _slots.acquire()
+    try:
+        future = _pool.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def _run(func, *args):
+    """
+    Run ``func`` on the hashing pool and wait for its result. The calling
+    thread is blocked until then; the pool only caps how many run at once.
+    """
+    return _submit(func, *args).result()
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+
+
+def hash_password(password):
+    """
+    Hash a password with a fresh salt.
+
+    Args:
+    - password (str): Plain text password.
+
+    Returns:
+    - str: ``pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>``.
+    """
+    return hash_passwords([password])[0]
+
+
+def hash_passwords(passwords):
+    """
+    Hash many passwords, each with a fresh salt, using every worker of the
+    hashing pool at once (e.g. for a bulk import).
+
+    Args:
+    - passwords (list): Plain text passwords.
+
+    Returns:
+    - list: Hashes in the order of ``passwords``, as ``hash_password``
+      makes them.
+    """
+    salts = [os.urandom(SALT_BYTES) for _ in passwords]
+    futures = [
+        _submit(_pbkdf2, password, salt, ITERATIONS)
+        for password, salt in zip(passwords, salts)
+    ]
+    return [
+        "%s$%d$%s$%s" % (ALGORITHM, ITERATIONS, salt.hex(), future.result().hex())
+        for salt, future in zip(salts, futures)
+    ]
+
+
+def is_hashed(stored):
+    """Tell whether a stored password is a hash made by ``hash_password``."""
+    return isinstance(stored, str) and stored.startswith(ALGORITHM + "$")
+
+
+def verify_password(stored, password):
+    """
+    Check a password against its stored form.
+
+    Args:
+    - stored (str): Hash from ``hash_password``, or a legacy plain text
+      password.
+    - password (str): Password to check.
+
+    Returns:
+    - bool: True if the password matches.
+    """
+    if not is_hashed(stored):
+        return isinstance(stored, str) and hmac.compare_digest(
+            stored.encode("utf-8"), str(password).encode("utf-8")
+        )
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        salt, digest, iterations = (
+            bytes.fromhex(salt),
+            bytes.fromhex(digest),
+            int(iterations),
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(_run(_pbkdf2, str(password), salt, iterations), digest)
+
+
+@lru_cache(maxsize=None)
+def _dummy_hash():
+    """Hash checked for unknown emails, so they take as long to refuse."""
+    return hash_password("")
+
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+
+class CredentialIndex:
+    """
+    ``email -> record`` map of one keyed store, kept while the store is
+    unchanged or changed only by the units of work it was told about.
+
+    Args:
+    - store (str): ``OCCUPANTS`` or ``CLIENTS``.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._key = None
+        self._records = {}
+
+    def lookup(self, email):
+        """
+        Find the stored record of an email.
+
+        Returns:
+        - tuple: ``(stored password, object)``, or None if the email is
+          unknown.
+        """
+        backend = get_backend()
+        if backend.point_lookups or backend is not backend.engine:
+            try:
+                obj = backend.get(self.store, email)
+            except KeyError:
+                return None
+            return obj._password, obj
+
+        key = (backend, backend.stamp(self.store))
+        with self._lock:
+            if key[1] is None or key != self._key:
+                self._records = backend.load_records(self.store)
+                self._key = key
+            record = self._records.get(email)
+        if record is None:
+            return None
+        return (
+            record[records.PASSWORD_FIELD[self.store]],
+            records.decode(self.store, record),
+        )
+
+    def absorb(self, engine, written):
+        """
+        Apply the records a unit of work wrote to the map, if the map is
+        of the state the write started from; otherwise leave it to be
+        reloaded.
+
+        Args:
+        - engine: Engine the unit of work was committed to.
+        - written (tuple): ``(stamp before, stamp after, records put, keys
+          deleted)`` as noted by the engine.
+        """
+        before, after, changed, deleted = written
+        with self._lock:
+            if before is None or self._key != (engine, before):
+                return
+            self._records.update(changed)
+            for key in deleted:
+                self._records.pop(key, None)
+            self._key = (engine, after)
+
+    def clear(self):
+        """Forget the cached map."""
+        with self._lock:
+            self._key = None
+            self._records = {}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _index(store):
+    with _indexes_lock:
+        index = _indexes.get(store)
+        if index is None:
+            index = _indexes[store] = CredentialIndex(store)
+        return index
+
+
+def _absorb(uow):
+    """Patch the credential indexes with the records a unit of work wrote."""
+    with _indexes_lock:
+        indexes = list(_indexes.items())
+    for store, index in indexes:
+        written = uow.written.get(store)
+        if written is not None:
+            index.absorb(uow.engine, written)
+
+
+UnitOfWork.committed_listeners.append(_absorb)
+
+
+def authenticate(store, email, password):
+    """
+    Check the credentials of an occupant or client.
+
+    Args:
+    - store (str): ``OCCUPANTS`` or ``CLIENTS``.
+    - email (str): Email of the user.
+    - password (str): Password entered.
+
+    Returns:
+    - The validated OCCUPANT or Client object, or None.
+    """
+    found = _index(store).lookup(email)
+    if found is None:
+        verify_password(_dummy_hash(), password)
+        return None
+    stored, obj = found
+    if not verify_password(stored, password):
+        return None
+    if not is_hashed(stored):
+        hashed = hash_password(password)
+        field = records.PASSWORD_FIELD[store]
+
+        def rehash(table):
+            # Only the password is replaced, and only if it is still the
+            # legacy one that was checked.
+            record = table.get(email)
+            if record is None or record[field] != stored:
+                return {}
+            return {email: record[:field] + (hashed,) + record[field + 1 :]}
+
+        if get_backend().update_records(store, rehash):
+            obj._password = hashed
+    return obj
@@ -0,0 +1,541 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Benchmark harness for the storage operations and the routes of the app.
+
+``run`` builds a synthetic community in a scratch directory through the
+app's own classes (``HousingCommunity``, ``Flat``, ``OCCUPANT``, ``Client``
+and ``PaymentDB``), then times the storage operations and every route of
+``app.py`` through the Flask test client. The results (milliseconds per
+call: min, median, p95 and mean, plus the status codes of the routes) are
+written as JSON.
+
+``compare`` reads two such files and lists the timings whose median got
+slower than the baseline by more than the threshold; it exits with status 1
+if there are any, so it can gate a CI job.
+
+The tree ships no page templates, so a template the app can't find is
+rendered from a one-line stub: the routes' own work is timed, the markup
+of the real pages is not. The stubbed templates are listed in the results.
+
+Passwords are hashed with the real PBKDF2 settings. ``--hash-iterations``
+lowers the cost to build large communities quickly; the login timings
+then no longer reflect production.
+
+Usage:
+    python bench.py run [--blocks 10] [--flats 40] [--occupants 300]
+                        [--clients 50] [--years 1] [--engine pickle|sqlite]
+                        [--repeat 20] [--out bench.json] [--compare base.json]
+    python bench.py compare baseline.json current.json [--threshold 0.25]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import jinja2
+
+from admin import Admin
+import app as app_module
+import auth
+from client import Client
+from housingcommunity import HousingCommunity, Flat
+from occupant import OCCUPANT, OCCUPANT_DB, PaymentDB
+from payment_queue import get_queue
+from ps import BHK_STRATEGIES
+from storage import PickleBackend, SQLiteBackend, set_backend
+from unit_of_work import UnitOfWork
+
+FORMAT_VERSION = 1
+# Medians slower than the baseline by more than this fraction are flagged...
+THRESHOLD = 0.25
+# ...unless they moved by less than this many milliseconds (timer noise).
+MIN_DELTA_MS = 0.05
+PASSWORD = "Passw0rd!"
+# Rendered for every template missing from the app's template folder.
+STUB_TEMPLATE = "<!doctype html><title>{{ request.path }}</title>"
+
+
+def block_name(index):
+    """Alphabetic block name of a 0-based index: A..Z, AA, AB..."""
+    name = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        name = chr(ord("A") + rest) + name
+    return name
+
+
+def summarize(samples):
+    """
+    Args:
+    - samples (list): Durations in seconds.
+
+    Returns:
+    - dict: Count and min, median, p95 and mean in milliseconds.
+    """
+    ms = sorted(sample * 1000 for sample in samples)
+    return {
+        "n": len(ms),
+        "min_ms": round(ms[0], 4),
+        "median_ms": round(statistics.median(ms), 4),
+        "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 4),
+        "mean_ms": round(statistics.fmean(ms), 4),
+    }
+
+
+def timed(func, repeat):
+    """Call ``func(i)`` for i in range(repeat), returning the durations."""
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# ----------------------------------------------------------------- generator
+
+
+class Community:
+    """
+    Synthetic community built through the app's classes.
+
+    Args:
+    - blocks (int): Number of blocks.
+    - flats (int): Flats per block.
+    - occupants (int): Occupied flats (at most blocks x flats).
+    - clients (int): Number of clients.
+    - years (int): Years of monthly payments of every occupant.
+    - seed (int): Seed of the random choices.
+    """
+
+    def __init__(self, blocks, flats, occupants, clients, years, seed=0):
+        self.blocks = blocks
+        self.flats = flats
+        self.occupants = min(occupants, blocks * flats)
+        self.clients = clients
+        self.years = years
+        self.random = random.Random(seed)
+        self.occupant_emails = []
+        self.client_emails = []
+        self.vacant = []
+        self.payments = 0
+
+    def config(self):
+        return {
+            "blocks": self.blocks,
+            "flats_per_block": self.flats,
+            "occupants": self.occupants,
+            "clients": self.clients,
+            "years": self.years,
+        }
+
+    def build(self):
+        """
+        Create the community, its occupants, clients and payments.
+
+        Returns:
+        - float: Seconds taken.
+        """
+        start = time.perf_counter()
+        HousingCommunity().Update_HC()
+        with UnitOfWork():
+            hc = HousingCommunity.GET_HC()
+            for b in range(self.blocks):
+                hc.add_block(block_name(b))
+                for f in range(self.flats):
+                    hc.add_flat(Flat(block_name(b), str(101 + f), 1 + f % 3))
+
+        flats = [
+            (block_name(b), str(101 + f), 1 + f % 3)
+            for b in range(self.blocks)
+            for f in range(self.flats)
+        ]
+        self.random.shuffle(flats)
+        occupied, self.vacant = flats[: self.occupants], flats[self.occupants :]
+        self.homes = {}
+        for start_at in range(0, len(occupied), 500):
+            with UnitOfWork():
+                hc = HousingCommunity.GET_HC()
+                for i, (block, flat_no, bhk) in enumerate(
+                    occupied[start_at : start_at + 500], start_at
+                ):
+                    email = "occupant%d@example.com" % i
+                    occupant = OCCUPANT(
+                        "Occupant",
+                        "9%09d" % i,
+                        "%012d" % i,
+                        email,
+                        PASSWORD,
+                        block,
+                        flat_no,
+                        BHK_STRATEGIES[bhk](),
+                    )
+                    hc.get_flat_by_details(block, flat_no).occupy(occupant)
+                    self.occupant_emails.append(email)
+                    self.homes[email] = (block, flat_no, bhk)
+
+        with UnitOfWork():
+            for i in range(self.clients):
+                email = "client%d@example.com" % i
+                Client("Client", "8%09d" % i, email, PASSWORD)
+                self.client_emails.append(email)
+
+        today = datetime.now()
+        for months_ago in range(self.years * 12, 0, -1):
+            year, month = divmod(today.year * 12 + today.month - 1 - months_ago, 12)
+            date = "%04d-%02d-05 10:00:00" % (year, month + 1)
+            with UnitOfWork():
+                for email in self.occupant_emails:
+                    block, _, bhk = self.homes[email]
+                    amount = BHK_STRATEGIES[bhk]().get_initial_payment()
+                    PaymentDB.add_payment(email, amount, block, date)
+                    self.payments += 1
+        return time.perf_counter() - start
+
+
+# ---------------------------------------------------------------- benchmarks
+
+
+def bench_operations(community, repeat):
+    """Time the storage operations of the DB classes."""
+    emails = community.occupant_emails
+    results = {}
+
+    def pick():
+        return community.random.choice(emails)
+
+    def add_payment(_):
+        email = pick()
+        PaymentDB.add_payment(email, 1, community.homes[email][0])
+
+    if emails:
+        results["get_occupant"] = timed(
+            lambda i: OCCUPANT_DB.get_occupant(pick()), repeat
+        )
+        results["store_occupant"] = timed(
+            lambda i: OCCUPANT_DB.store_occupant(OCCUPANT_DB.get_occupant(pick())),
+            repeat,
+        )
+        results["add_payment"] = timed(add_payment, repeat)
+        results["get_payment_history"] = timed(
+            lambda i: PaymentDB.get_payment_history(pick()), repeat
+        )
+    results["get_payments"] = timed(lambda i: PaymentDB.get_payments(), repeat)
+    results["get_payments_page"] = timed(
+        lambda i: PaymentDB.get_payments_page(limit=50), repeat
+    )
+
+    def cold_hc(_):
+        HousingCommunity.clear_cache()
+        HousingCommunity.GET_HC()
+
+    results["GET_HC (cold)"] = timed(cold_hc, repeat)
+    results["GET_HC (cached)"] = timed(lambda i: HousingCommunity.GET_HC(), repeat)
+    results["snapshot"] = timed(lambda i: HousingCommunity.snapshot(), repeat)
+
+    flats = list(community.homes.values()) or list(community.vacant)
+    if flats:
+
+        def update_flat(i):
+            hc = HousingCommunity.GET_HC()
+            block, flat_no, _ = flats[i % len(flats)]
+            hc.update_flat_details(hc.get_flat_by_details(block, flat_no))
+
+        results["update_flat_details"] = timed(update_flat, repeat)
+    return {name: summarize(samples) for name, samples in results.items()}
+
+
+def bench_routes(community, repeat):
+    """
+    Time every route of the app through the Flask test client.
+
+    Returns:
+    - tuple: (timings of the routes, status codes of the routes that
+      answered with a server error; they are left out of the timings,
+      names of the templates rendered from ``STUB_TEMPLATE``)
+    """
+    flask_app = app_module.app
+    stubbed = set()
+
+    def stub(name):
+        stubbed.add(name)
+        return STUB_TEMPLATE
+
+    flask_app.jinja_env.loader = jinja2.ChoiceLoader(
+        [flask_app.jinja_env.loader, jinja2.FunctionLoader(stub)]
+    )
+    anonymous = flask_app.test_client()
+    occupant = flask_app.test_client()
+    client = flask_app.test_client()
+    # Failing routes are counted by status; their tracebacks are not wanted.
+    flask_app.logger.disabled = True
+    if community.occupant_emails:
+        occupant.post(
+            "/ol.html",
+            data={"email": community.occupant_emails[0], "password": PASSWORD},
+        )
+    if community.client_emails:
+        client.post(
+            "/cl.html", data={"email": community.client_emails[0], "password": PASSWORD}
+        )
+
+    vacant = list(community.vacant)
+    counter = iter(range(10**9))
+
+    def new_block():
+        return "BENCH" + block_name(next(counter))
+
+    def registration(i):
+        if not vacant:
+            return None
+        block, flat_no, _ = vacant.pop()
+        return {
+            "name": "Bench",
+            "phone": "7%09d" % i,
+            "aadhar": "5%011d" % i,
+            "email": "bench%d@example.com" % next(counter),
+            "password": PASSWORD,
+            "unoccupied_flats": "%s-%s" % (block, flat_no),
+        }
+
+    routes = [
+        ("GET", "/", anonymous, None),
+        ("GET", "/al.html", anonymous, None),
+        (
+            "POST",
+            "/admin/login",
+            anonymous,
+            lambda i: {"userId": "Admin", "password": "123"},
+        ),
+        ("GET", "/admin/panel", anonymous, None),
+        ("GET", "/admin/reports", anonymous, None),
+        ("GET", "/unoccu.html", anonymous, None),
+        ("GET", "/occu.html", anonymous, None),
+        ("GET", "/add_block.html", anonymous, None),
+        ("POST", "/add_block.html", anonymous, lambda i: {"block": new_block()}),
+        ("GET", "/add_flat.html", anonymous, None),
+        (
+            "POST",
+            "/add_flat.html",
+            anonymous,
+            lambda i: {
+                "block": block_name(0),
+                "flat_no": "B%d" % next(counter),
+                "bhk": "2",
+            },
+        ),
+        ("GET", "/payments", anonymous, None),
+        ("GET", "/payments/export", anonymous, None),
+        ("GET", "/or.html", anonymous, None),
+        ("POST", "/Osubmit", anonymous, registration),
+        ("GET", "/ol.html", anonymous, None),
+        (
+            "POST",
+            "/ol.html",
+            anonymous,
+            lambda i: {
+                "email": (
+                    community.occupant_emails[0] if community.occupant_emails else ""
+                ),
+                "password": PASSWORD,
+            },
+        ),
+        ("GET", "/occupant", occupant, None),
+        ("GET", "/occupant_payment", occupant, None),
+        (
+            "POST",
+            "/make_payment",
+            occupant,
+            lambda i: {"idempotency_key": "bench-%d" % next(counter)},
+        ),
+        ("GET", "/payment_history", occupant, None),
+        ("GET", "/cr.html", anonymous, None),
+        (
+            "POST",
+            "/Csubmit",
+            anonymous,
+            lambda i: {
+                "name": "Bench",
+                "phone": "6%09d" % i,
+                "email": "benchclient%d@example.com" % next(counter),
+                "password": PASSWORD,
+            },
+        ),
+        ("GET", "/cl.html", anonymous, None),
+        (
+            "POST",
+            "/cl.html",
+            anonymous,
+            lambda i: {
+                "email": community.client_emails[0] if community.client_emails else "",
+                "password": PASSWORD,
+            },
+        ),
+        ("GET", "/client", client, None),
+    ]
+
+    results, failed = {}, {}
+    for method, path, test_client, form in routes:
+        samples, status = [], {}
+        for i in range(repeat):
+            data = form(i) if form is not None else None
+            if form is not None and data is None:
+                break
+            start = time.perf_counter()
+            response = test_client.open(path, method=method, data=data)
+            body = response.get_data()
+            samples.append(time.perf_counter() - start)
+            response.close()
+            status[str(response.status_code)] = (
+                status.get(str(response.status_code), 0) + 1
+            )
+        name = "%s %s" % (method, path)
+        if any(code.startswith("5") for code in status):
+            # The time to render an error page is no baseline for the route.
+            failed[name] = status
+        elif samples:
+            results[name] = dict(summarize(samples), status=status, bytes=len(body))
+    get_queue().flush()
+    return results, failed, sorted(stubbed)
+
+
+def run(community, engine, repeat, workdir):
+    """
+    Build the community and time everything.
+
+    Returns:
+    - dict: The JSON document written by ``run``.
+    """
+    os.chdir(workdir)
+    set_backend(PickleBackend(".") if engine == "pickle" else SQLiteBackend("bench.db"))
+    HousingCommunity.clear_cache()
+    Admin().save_to_file()
+
+    build_seconds = community.build()
+    routes, failed_routes, stubbed = bench_routes(community, repeat)
+    return {
+        "version": FORMAT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "config": dict(community.config(), engine=engine, repeat=repeat),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "build": {"seconds": round(build_seconds, 3), "payments": community.payments},
+        "operations": bench_operations(community, repeat),
+        "routes": routes,
+        "failed_routes": failed_routes,
+        "stub_templates": stubbed,
+    }
+
+
+# ---------------------------------------------------------------- comparison
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """
+    Compare two result documents.
+
+    Routes that failed in the current run count as regressions.
+
+    Returns:
+    - tuple: (report lines, number of regressions)
+    """
+    lines = []
+    if baseline.get("config") != current.get("config"):
+        lines.append("warning: the runs used different configurations")
+    regressions = 0
+    for name, status in sorted(current.get("failed_routes", {}).items()):
+        lines.append("%-9s %-32s FAILED %s" % ("route", name, json.dumps(status)))
+        regressions += 1
+    for section in ("operations", "routes"):
+        old_section = baseline.get(section, {})
+        for name, stats in sorted(current.get(section, {}).items()):
+            old = old_section.get(name)
+            if old is None:
+                lines.append("%-9s %-32s new" % ("", name))
+                continue
+            before, after = old["median_ms"], stats["median_ms"]
+            change = (after - before) / before if before else 0.0
+            flag = ""
+            if change > threshold and after - before > MIN_DELTA_MS:
+                flag = "REGRESSION"
+                regressions += 1
+            elif change < -threshold and before - after > MIN_DELTA_MS:
+                flag = "faster"
+            lines.append(
+                "%-9s %-32s %10.3f -> %10.3f ms  %+7.1f%%  %s"
+                % (section.rstrip("s"), name, before, after, change * 100, flag)
+            )
+    return lines, regressions
+
+
+def _load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_cmd = commands.add_parser("run", help="build a community and time it")
+    run_cmd.add_argument("--blocks", type=int, default=10)
+    run_cmd.add_argument("--flats", type=int, default=40, help="flats per block")
+    run_cmd.add_argument("--occupants", type=int, default=300)
+    run_cmd.add_argument("--clients", type=int, default=50)
+    run_cmd.add_argument("--years", type=int, default=1)
+    run_cmd.add_argument("--engine", choices=("pickle", "sqlite"), default="pickle")
+    run_cmd.add_argument("--repeat", type=int, default=20)
+    run_cmd.add_argument("--seed", type=int, default=0)
+    run_cmd.add_argument("--hash-iterations", type=int)
+    run_cmd.add_argument(
+        "--dir", help="scratch directory (a new temporary one by default)"
+    )
+    run_cmd.add_argument("--out", default="bench.json")
+    run_cmd.add_argument("--compare", help="baseline to compare the results with")
+    compare_cmd = commands.add_parser("compare", help="flag regressions")
+    compare_cmd.add_argument("baseline")
+    compare_cmd.add_argument("current")
+    for command in (run_cmd, compare_cmd):
+        command.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        out = os.path.abspath(args.out)
+        baseline = _load(args.compare) if args.compare else None
+        if args.hash_iterations:
+            auth.ITERATIONS = args.hash_iterations
+        workdir = args.dir or tempfile.mkdtemp(prefix="hcms-bench-")
+        os.makedirs(workdir, exist_ok=True)
+        community = Community(
+            args.blocks, args.flats, args.occupants, args.clients, args.years, args.seed
+        )
+        result = run(community, args.engine, args.repeat, workdir)
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print("results written to %s (data in %s)" % (out, workdir))
+        if result["stub_templates"]:
+            print("templates stubbed: %s" % ", ".join(result["stub_templates"]))
+        for name, status in sorted(result["failed_routes"].items()):
+            print("route %s failed: %s" % (name, json.dumps(status)))
+        if baseline is None:
+            sys.exit(1 if result["failed_routes"] else 0)
+        current = result
+    else:
+        baseline, current = _load(args.baseline), _load(args.current)
+
+    lines, regressions = compare(baseline, current, args.threshold)
+    print("\n".join(lines))
+    print("%d regression(s)" % regressions)
+    sys.exit(1 if regressions else 0)
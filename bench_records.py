@@ -0,0 +1,126 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Benchmark of the compact record format against pickling live objects.
+
+For each size, builds that many synthetic occupants and compares the size of
+the occupant store file and the time to load it, in the old layout (a pickled
+``{email: OCCUPANT}`` dict) and in the record layout of ``records.py``.
+
+Usage:
+    python bench_records.py [--sizes 10000 100000] [--repeat 3]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+import pickle
+import time
+
+import records
+
+
+def synthetic_occupants(count):
+    """
+    Build ``count`` occupants without validating or storing them.
+
+    Returns:
+    - dict: OCCUPANT objects keyed by email.
+    """
+    occupants = {}
+    for i in range(count):
+        email = "occupant%d@example.com" % i
+        occupants[email] = records.decode_occupant(
+            (
+                "Occupant %d" % i,
+                "9%09d" % i,
+                "%012d" % i,
+                email,
+                "Passw0rd%d" % i,
+                chr(ord("A") + i % 26),
+                100 + i % 900,
+                1 + i % 3,
+                500 * (i % 4),
+                i % 2,
+                1_700_000_000_000_000 + i,
+            )
+        )
+    return occupants
+
+
+def best_of(repeat, func):
+    """Return the fastest of ``repeat`` timed calls of ``func``, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(size, repeat):
+    """
+    Compare both layouts for ``size`` occupants.
+
+    Returns:
+    - dict: File sizes in bytes and load times in seconds.
+    """
+    occupants = synthetic_occupants(size)
+    legacy = pickle.dumps(occupants, pickle.HIGHEST_PROTOCOL)
+    compact = pickle.dumps(
+        records.pack_table(
+            {email: records.encode_occupant(o) for email, o in occupants.items()}
+        ),
+        pickle.HIGHEST_PROTOCOL,
+    )
+    some_email = next(iter(occupants))
+
+    def lazy_point_lookup():
+        table = records.unpack_table("occupants", pickle.loads(compact))
+        records.decode_occupant(table[some_email])
+
+    def full_hydration():
+        table = records.unpack_table("occupants", pickle.loads(compact))
+        for record in table.values():
+            records.decode_occupant(record)
+
+    return {
+        "legacy_bytes": len(legacy),
+        "compact_bytes": len(compact),
+        "legacy_load": best_of(repeat, lambda: pickle.loads(legacy)),
+        "compact_lookup": best_of(repeat, lazy_point_lookup),
+        "compact_hydrate": best_of(repeat, full_hydration),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        "%9s  %12s %12s  %10s %14s %15s"
+        % (
+            "records",
+            "pickle B",
+            "compact B",
+            "pickle s",
+            "compact get s",
+            "compact all s",
+        )
+    )
+    for size in args.sizes:
+        result = run(size, args.repeat)
+        print(
+            "%9d  %12d %12d  %10.4f %14.4f %15.4f"
+            % (
+                size,
+                result["legacy_bytes"],
+                result["compact_bytes"],
+                result["legacy_load"],
+                result["compact_lookup"],
+                result["compact_hydrate"],
+            )
+        )
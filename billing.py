@@ -0,0 +1,189 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Billing cycle run over the whole community.
+
+A cycle charges every occupant the monthly dues of their flat and moves
+them to the unpaid state, as ``PaidState.check_state_transition`` does for a
+single occupant on the first of the month. Instead of loading each
+OCCUPANT and calling its strategy, the engine works on the compact occupant
+records (see ``records.py``): the tariff of every record comes from a
+table of strategy rates, the new dues are computed in one pass and all the
+changed records are written back in one write, with the store locked for
+the whole run.
+
+Every record keeps the id of the last cycle it was billed for, so running a
+cycle again (after a crash, or by mistake) bills nobody twice.
+
+Usage:
+    python billing.py [--cycle 2024-01] [--dry-run]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+from datetime import datetime
+import sys
+
+from housingcommunity import HousingCommunity
+from ps import BHK_STRATEGIES
+import records
+from storage import get_backend, flat_key, OCCUPANTS
+
+# Monthly dues per strategy code of the occupant records.
+RATES = {
+    code: cls().get_initial_payment()
+    for code, cls in records.STRATEGIES.items()
+    if cls is not None
+}
+# Strategy code of a flat, by its number of bedrooms.
+BHK_CODES = {bhk: records.STRATEGY_CODES[cls] for bhk, cls in BHK_STRATEGIES.items()}
+
+
+def current_cycle():
+    """
+    Returns:
+    - str: Id of this month's cycle, "YYYY-MM".
+    """
+    return datetime.now().strftime("%Y-%m")
+
+
+class CycleReport:
+    """
+    Outcome of a billing cycle.
+
+    Attributes:
+    - cycle (str): Id of the cycle.
+    - billed (int): Number of occupants billed by this run.
+    - already_billed (int): Number of occupants billed by an earlier run.
+    - charged: Total dues added by this run.
+    - skipped (list): Emails of occupants without a tariff.
+    - committed (bool): False for a dry run.
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        self.billed = 0
+        self.already_billed = 0
+        self.charged = 0
+        self.skipped = []
+        self.committed = False
+
+    def summary(self):
+        """
+        Returns:
+        - str: Counts of the run followed by the skipped occupants.
+        """
+        lines = [
+            "cycle          %s" % self.cycle,
+            "billed         %d" % self.billed,
+            "already billed %d" % self.already_billed,
+            "charged        %s" % self.charged,
+            "skipped        %d" % len(self.skipped),
+        ]
+        lines.extend("no tariff: %s" % email for email in self.skipped)
+        return "\n".join(lines)
+
+
+def flat_codes(hc):
+    """
+    Strategy code of every flat of the community.
+
+    Args:
+    - hc: HousingCommunity object.
+
+    Returns:
+    - dict: Strategy codes keyed by ``flat_key(block_no, flat_no)``; flats
+      with an unsupported number of bedrooms are left out.
+    """
+    return {
+        flat_key(flat._block_no, flat._flat_no): BHK_CODES[flat._bhk]
+        for block_flats in hc._flats.values()
+        for flat in block_flats
+        if flat._bhk in BHK_CODES
+    }
+
+
+def bill(table, cycle, codes, report):
+    """
+    Compute the records of a cycle.
+
+    Args:
+    - table (dict): Occupant records keyed by email.
+    - cycle (str): Id of the cycle.
+    - codes (dict): Output of ``flat_codes``. An occupant whose flat is not
+      found keeps the strategy of its record.
+    - report (CycleReport): Counts are added to it.
+
+    Returns:
+    - dict: New records of the occupants billed, keyed by email.
+    """
+    block = records.OCCUPANT_BLOCK_FIELD
+    flat = records.OCCUPANT_FLAT_FIELD
+    strategy = records.OCCUPANT_STRATEGY_FIELD
+    pending = records.OCCUPANT_PENDING_FIELD
+    last_paid = records.OCCUPANT_LAST_PAID_FIELD
+    billed = records.OCCUPANT_CYCLE_FIELD
+    unpaid = records.UNPAID
+
+    changes = {}
+    for email, record in table.items():
+        record = records.pad_occupant(record)
+        if record[billed] == cycle:
+            report.already_billed += 1
+            continue
+        code = codes.get(flat_key(record[block], record[flat]), record[strategy])
+        rate = RATES.get(code)
+        if rate is None:
+            report.skipped.append(email)
+            continue
+        changes[email] = (
+            record[:strategy]
+            + (
+                code,
+                record[pending] + rate,
+                unpaid,
+                record[last_paid],
+                cycle,
+            )
+            + record[billed + 1 :]
+        )
+        report.charged += rate
+    report.billed = len(changes)
+    return changes
+
+
+def run_cycle(cycle=None, dry_run=False):
+    """
+    Bill every occupant for a cycle and write them in one write.
+
+    Args:
+    - cycle (str): Id of the cycle; this month ("YYYY-MM") by default.
+    - dry_run (bool): Compute and report without writing anything.
+
+    Returns:
+    - CycleReport
+    """
+    report = CycleReport(cycle or current_cycle())
+    codes = flat_codes(HousingCommunity.GET_HC())
+
+    def update(table):
+        changes = bill(table, report.cycle, codes, report)
+        return {} if dry_run else changes
+
+    get_backend().update_records(OCCUPANTS, update)
+    report.committed = not dry_run
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--cycle", help="cycle id, this month (YYYY-MM) by default")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    report = run_cycle(args.cycle, args.dry_run)
+    print(report.summary())
+    if not report.committed:
+        print("dry run: nothing was written")
+    sys.exit(1 if report.skipped else 0)
@@ -0,0 +1,348 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Bulk import of blocks, flats, occupants and clients from CSV or JSONL files.
+
+Rows are streamed from the file and handled in batches inside one unit of
+work, so the whole import is written to storage once instead of once per
+row. Every row runs in its own nested unit of work: a row that fails
+validation is reported with its line number and skipped, and the rest of the
+batch carries on.
+
+Columns (CSV header or JSON keys):
+
+    blocks    : block
+    flats     : block, flat_no, bhk
+    occupants : name, phone, aadhar, email, password, block, flat_no
+    clients   : name, phone, email, password
+
+A file may mix kinds by adding a ``type`` column (``block``, ``flat``,
+``occupant`` or ``client``); otherwise every row is of the ``--kind`` given.
+
+Usage:
+    python bulk_import.py flats.csv --kind flats
+    python bulk_import.py community.jsonl [--batch-size 500] [--dry-run]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+import csv
+import json
+import os
+import sys
+from itertools import islice
+
+from auth import hash_passwords
+from client import Client
+from housingcommunity import HousingCommunity, HC_ERROR, Flat
+from occupant import OCCUPANT
+from ps import BHK_STRATEGIES
+from unit_of_work import UnitOfWork
+from validation import ValidationException, Validations
+
+BATCH_SIZE = 500
+
+KINDS = {
+    "block": "blocks",
+    "blocks": "blocks",
+    "flat": "flats",
+    "flats": "flats",
+    "occupant": "occupants",
+    "occupants": "occupants",
+    "client": "clients",
+    "clients": "clients",
+}
+
+COLUMNS = {
+    "blocks": ("block",),
+    "flats": ("block", "flat_no", "bhk"),
+    "occupants": ("name", "phone", "aadhar", "email", "password", "block", "flat_no"),
+    "clients": ("name", "phone", "email", "password"),
+}
+
+
+class RowError(Exception):
+    """Raised for a row that cannot be imported."""
+
+    pass
+
+
+class _DryRun(Exception):
+    """Raised to roll back a dry run."""
+
+    pass
+
+
+class ImportReport:
+    """
+    Outcome of an import.
+
+    Attributes:
+    - imported (dict): Number of rows imported per kind.
+    - errors (list): ``(line, kind, message)`` for every rejected row.
+    """
+
+    def __init__(self):
+        self.imported = {kind: 0 for kind in COLUMNS}
+        self.errors = []
+        self.committed = False
+
+    @property
+    def total(self):
+        return sum(self.imported.values())
+
+    def summary(self):
+        """
+        Returns:
+        - str: One line per kind followed by the rejected rows.
+        """
+        lines = ["%-10s %d" % (kind, count) for kind, count in self.imported.items()]
+        lines.append("%-10s %d" % ("errors", len(self.errors)))
+        lines.extend(
+            "line %d (%s): %s" % (line, kind, message)
+            for line, kind, message in self.errors
+        )
+        return "\n".join(lines)
+
+
+# ------------------------------------------------------------------- readers
+
+
+def iter_rows(path):
+    """
+    Stream the rows of a CSV or JSONL file.
+
+    Args:
+    - path (str): File ending in ``.csv``, ``.jsonl``, ``.ndjson`` or ``.json``
+      (one JSON object per line).
+
+    Yields:
+    - tuple: ``(line number, row dict)``; a line that is not valid JSON is
+      yielded as a ``RowError`` instead of a dict.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if extension == ".csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        elif extension in (".jsonl", ".ndjson", ".json"):
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    yield line_no, RowError("Invalid JSON: %s" % e)
+                    continue
+                if not isinstance(row, dict):
+                    row = RowError("Expected a JSON object")
+                yield line_no, row
+        else:
+            raise ValueError("Unsupported file type %r" % extension)
+
+
+def batches(rows, size):
+    """Split an iterable of rows into lists of at most ``size`` rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+# ---------------------------------------------------------------- validation
+
+
+def _clean(kind, row):
+    """
+    Check that a row has every column of its kind and normalise the values.
+
+    Returns:
+    - dict: Column values as stripped strings, ``bhk`` as an int and ``block``
+      in upper case.
+
+    Raises:
+    - RowError: Raised for missing or malformed columns.
+    """
+    values = {}
+    for column in COLUMNS[kind]:
+        value = row.get(column)
+        if value is None or str(value).strip() == "":
+            raise RowError("Missing column %r" % column)
+        values[column] = str(value).strip()
+    if "block" in values:
+        if not values["block"].isalpha():
+            raise RowError("Block names must be alphabetic")
+        values["block"] = values["block"].upper()
+    if "bhk" in values:
+        try:
+            values["bhk"] = int(values["bhk"])
+        except ValueError:
+            raise RowError("BHK must be a number")
+        if values["bhk"] not in BHK_STRATEGIES:
+            raise RowError("Unsupported BHK %d" % values["bhk"])
+    return values
+
+
+def _kind(row, default):
+    kind = row.get("type") or default
+    if kind is None:
+        raise RowError("Row has no type and no --kind was given")
+    try:
+        return KINDS[str(kind).strip().lower()]
+    except KeyError:
+        raise RowError("Unknown row type %r" % kind)
+
+
+# ------------------------------------------------------------------ importers
+
+
+def _import_block(hc, values):
+    hc.add_block(values["block"])
+
+
+def _import_flat(hc, values):
+    hc.add_flat(Flat(values["block"], values["flat_no"], values["bhk"]))
+
+
+def _import_occupant(hc, values):
+    # The flat is checked before the occupant is built, so a rejected row
+    # never touches the in-memory community.
+    flat = hc.get_flat_by_details(values["block"], values["flat_no"])
+    if flat is None:
+        raise HC_ERROR("Flat Doesn't Exist")
+    if flat.get_state() == "Yes":
+        raise HC_ERROR("Already Occupied !!! ")
+    strategy = BHK_STRATEGIES.get(flat._bhk)
+    if strategy is None:
+        raise HC_ERROR("Unsupported BHK %r" % flat._bhk)
+    occupant = OCCUPANT(
+        values["name"],
+        values["phone"],
+        values["aadhar"],
+        values["email"],
+        values["password"],
+        flat._block_no,
+        flat._flat_no,
+        strategy(),
+        hashed=values["hashed"],
+    )
+    flat.occupy(occupant)
+
+
+def _import_client(hc, values):
+    Client(
+        values["name"],
+        values["phone"],
+        values["email"],
+        values["password"],
+        hashed=values["hashed"],
+    )
+
+
+def _hash_passwords(checked):
+    """
+    Hash the valid passwords of a batch together on the hashing pool,
+    instead of one at a time in each constructor. Invalid ones are left
+    for the constructor to reject.
+    """
+    rows = []
+    for _, _, values in checked:
+        values["hashed"] = False
+        if "password" in values and Validations.password(values["password"]) is None:
+            rows.append(values)
+    hashes = hash_passwords([values["password"] for values in rows])
+    for values, hashed in zip(rows, hashes):
+        values["password"] = hashed
+        values["hashed"] = True
+
+
+IMPORTERS = {
+    "blocks": _import_block,
+    "flats": _import_flat,
+    "occupants": _import_occupant,
+    "clients": _import_client,
+}
+
+
+def _import_batch(batch, kind, report):
+    """Check the shape of every row of a batch, then apply the valid ones."""
+    checked = []
+    for line_no, row in batch:
+        try:
+            if isinstance(row, RowError):
+                raise row
+            row_kind = _kind(row, kind)
+            checked.append((line_no, row_kind, _clean(row_kind, row)))
+        except RowError as e:
+            label = row.get("type") if isinstance(row, dict) else None
+            label = KINDS.get(str(label).strip().lower(), label) if label else kind
+            report.errors.append((line_no, label, str(e)))
+
+    _hash_passwords(checked)
+    hc = HousingCommunity.GET_HC()
+    for line_no, row_kind, values in checked:
+        try:
+            with UnitOfWork():
+                IMPORTERS[row_kind](hc, values)
+        except (HC_ERROR, ValidationException) as e:
+            report.errors.append((line_no, row_kind, str(e)))
+            # The rollback dropped the cached community; fetch the current one.
+            hc = HousingCommunity.GET_HC()
+        else:
+            report.imported[row_kind] += 1
+    report.errors.sort(key=lambda error: error[0])
+
+
+def import_rows(rows, kind=None, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Import rows and commit them in a single unit of work.
+
+    Args:
+    - rows: Iterable of ``(line number, row dict)`` as given by ``iter_rows``.
+    - kind (str): Kind of rows without a ``type`` column.
+    - batch_size (int): Number of rows validated together.
+    - dry_run (bool): Validate and report without writing anything.
+
+    Returns:
+    - ImportReport: Counts of imported rows and the rejected rows.
+    """
+    report = ImportReport()
+    try:
+        with UnitOfWork():
+            for batch in batches(rows, batch_size):
+                _import_batch(batch, kind, report)
+            if dry_run:
+                raise _DryRun()
+    except _DryRun:
+        return report
+    report.committed = True
+    return report
+
+
+def import_file(path, kind=None, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Import a CSV or JSONL file; see ``import_rows``.
+
+    Returns:
+    - ImportReport
+    """
+    return import_rows(iter_rows(path), kind, batch_size, dry_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("path", help="CSV or JSONL file")
+    parser.add_argument("--kind", choices=sorted(COLUMNS))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    report = import_file(args.path, args.kind, args.batch_size, args.dry_run)
+    print(report.summary())
+    if not report.committed:
+        print("dry run: nothing was written")
+    sys.exit(1 if report.errors else 0)
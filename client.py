@@ -19,7 +19,9 @@ DISCLAIMER:
 # ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
 
 
-import pickle
+from storage import get_backend, CLIENTS
+from auth import authenticate, hash_password
+import metrics
 from validation import (
     ValidationException,
     ClientValidationException,
@@ -29,13 +31,12 @@ from validation import (
 )
 
 
+@metrics.timed_methods
 class CLIENT_DB:
     """
     Class handling client database operations.
     """
 
-    _file = "client_db.pickle"  # File path for client database
-
     @staticmethod
     def store_client(data):
         """
@@ -47,22 +48,7 @@ class CLIENT_DB:
         Returns:
         - None
         """
-        try:
-            f = open(CLIENT_DB._file, "rb")
-            load = pickle.load(f)
-            load[data._email_id] = data
-            f.close()
-
-            f1 = open(CLIENT_DB._file, "wb")
-            pickle.dump(load, f1)
-            f1.close()
-
-        except FileNotFoundError:
-            dic = {}
-            f2 = open(CLIENT_DB._file, "wb")
-            dic[data._email_id] = data
-            pickle.dump(dic, f2)
-            f2.close()
+        get_backend().put(CLIENTS, data._email_id, data)
 
     @staticmethod
     def get_client(email):
@@ -76,10 +62,7 @@ class CLIENT_DB:
         - Client object or None if not found.
         """
         try:
-            f = open(CLIENT_DB._file, "rb")
-            DB = pickle.load(f)
-            f.close()
-            return DB[email]
+            return get_backend().get(CLIENTS, email)
         except:
             Exception("User Not Found")
 
@@ -91,13 +74,7 @@ class CLIENT_DB:
         Returns:
         - List of all client objects.
         """
-        try:
-            f = open(CLIENT_DB._file, "rb")
-            all_clients = pickle.load(f)
-            f.close()
-            return list(all_clients.values())
-        except FileNotFoundError:
-            return []
+        return list(get_backend().load_all(CLIENTS).values())
 
     @staticmethod
     def show_client(email):
@@ -110,10 +87,7 @@ class CLIENT_DB:
         Returns:
         - None
         """
-        f = open(CLIENT_DB._file, "rb")
-        DB = pickle.load(f)
-        f.close()
-        return DB[email].display_info()
+        return get_backend().get(CLIENTS, email).display_info()
 
     @staticmethod
     def show_all_client():
@@ -123,14 +97,12 @@ class CLIENT_DB:
         Returns:
         - None
         """
-        f1 = open(CLIENT_DB._file, "rb")
-        load = pickle.load(f1)
+        load = get_backend().load_all(CLIENTS)
         count = 0
         for i, j in load.items():
             print(("-") * 40)
             j.display_info()
             count += 1
-        f1.close()
 
     @staticmethod
     def validate_credential(email, pwd):
@@ -142,11 +114,9 @@ class CLIENT_DB:
         - pwd: Password of the client.
 
         Returns:
-        - bool: True if credentials are valid, False otherwise.
+        - Client object if the credentials are valid, None otherwise.
         """
-        client = CLIENT_DB.get_client(email)
-        if client._password == pwd:
-            return True
+        return authenticate(CLIENTS, email, pwd)
 
 
 class Client:
@@ -154,12 +124,13 @@ class Client:
     Class representing a client.
     """
 
-    def __init__(self, name, phone, email, password):
+    def __init__(self, name, phone, email, password, hashed=False):
+        # ``hashed``: the password was already hashed (see auth.hash_passwords).
         Validation.Client_Validation(name, phone, email, password)
         self._name = name
         self._phone = phone
         self._email_id = email
-        self._password = password
+        self._password = password if hashed else hash_password(password)
         CLIENT_DB.store_client(self)
 
     def display_info(self):
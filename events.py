@@ -0,0 +1,255 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+In-process publish/subscribe bus.
+
+Publishers put events on a bounded queue per topic and return; the events
+are delivered to the subscribers of the topic on a small thread pool. A
+topic is drained by one pool job at a time, so its subscribers see its
+events in publishing order, and a slow topic doesn't hold up the others
+for more than ``PUMP_BATCH`` events at a time. When a topic's queue is full,
+``publish`` waits for room (backpressure) or raises ``EventQueueFull``.
+
+Subscriber lists are copy-on-write tuples: subscribing replaces the tuple
+under a lock, delivery reads it without one. An exception raised by one
+subscriber is printed and counted, and the other subscribers still get the
+event.
+
+Events published inside a unit of work (``publish_after_commit``) are held
+until it commits, and dropped if it rolls back.
+
+Topics used by the app: ``PAYMENT``, ``OCCUPANCY`` and ``ANNOUNCEMENT``.
+``HCMS_EVENT_WORKERS`` sets the size of the delivery pool.
+
+Usage:
+    bus.subscribe(PAYMENT, handler)
+    bus.publish(PAYMENT, {"email": ..., "amount": ...})
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import threading
+import time
+import traceback
+
+from storage import get_backend
+from unit_of_work import UnitOfWork
+
+PAYMENT = "payment"
+OCCUPANCY = "occupancy"
+ANNOUNCEMENT = "announcement"
+
+WORKERS = int(os.environ.get("HCMS_EVENT_WORKERS", 2))
+# Events a topic may hold before publishers have to wait.
+QUEUE_SIZE = 1000
+# Events delivered by one pool job before it makes way for other topics.
+PUMP_BATCH = 100
+
+
+class EventQueueFull(Exception):
+    """Raised when a topic's queue stayed full for the whole timeout."""
+
+    pass
+
+
+class Topic:
+    """
+    Queue and subscribers of one topic.
+
+    Args:
+    - name (str): Name of the topic.
+    - size (int): Capacity of the queue.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.queue = queue.Queue(size)
+        self.subscribers = ()
+        self.lock = threading.Lock()
+        self.pumping = False
+        self.delivered = 0
+        self.errors = 0
+
+
+class EventBus:
+    """
+    Publish/subscribe bus delivering on a thread pool.
+
+    Args:
+    - workers (int): Threads delivering events.
+    - queue_size (int): Capacity of each topic's queue.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="hcms-events"
+        )
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def _topic(self, name):
+        topic = self._topics.get(name)
+        if topic is None:
+            with self._lock:
+                topic = self._topics.get(name)
+                if topic is None:
+                    topic = Topic(name, self.queue_size)
+                    self._topics = {**self._topics, name: topic}
+        return topic
+
+    # ---------------------------------------------------------- subscribers
+
+    def subscribe(self, topic, handler):
+        """
+        Call ``handler(event)`` for every event published on a topic.
+
+        Returns:
+        - The handler, for ``unsubscribe``.
+        """
+        topic = self._topic(topic)
+        with topic.lock:
+            topic.subscribers = topic.subscribers + (handler,)
+        return handler
+
+    def unsubscribe(self, topic, handler):
+        """Stop calling a handler; unknown handlers are ignored."""
+        topic = self._topic(topic)
+        with topic.lock:
+            topic.subscribers = tuple(
+                subscriber
+                for subscriber in topic.subscribers
+                if subscriber is not handler
+            )
+
+    # ------------------------------------------------------------- publish
+
+    def publish(self, topic, event, block=True, timeout=None):
+        """
+        Queue an event for the subscribers of a topic.
+
+        Args:
+        - topic (str): Name of the topic.
+        - event: Any object; it is passed to every subscriber as is.
+        - block (bool): Wait for room when the topic's queue is full.
+        - timeout (float): Longest wait in seconds (None waits forever).
+
+        Returns:
+        - bool: False if the topic has no subscribers (nothing is queued).
+
+        Raises:
+        - EventQueueFull: Raised if there was no room in the queue in time.
+        """
+        topic = self._topic(topic)
+        if not topic.subscribers:
+            return False
+        try:
+            topic.queue.put(event, block, timeout)
+        except queue.Full:
+            raise EventQueueFull("Event queue of %r is full" % topic.name)
+        with topic.lock:
+            if topic.pumping:
+                return True
+            topic.pumping = True
+        self._pool.submit(self._pump, topic)
+        return True
+
+    def _pump(self, topic):
+        """Deliver the queued events of a topic, a batch per pool job."""
+        while True:
+            for _ in range(PUMP_BATCH):
+                try:
+                    event = topic.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self._deliver(topic, event)
+                finally:
+                    topic.queue.task_done()
+            else:
+                # Give the worker to the other topics before carrying on.
+                self._pool.submit(self._pump, topic)
+                return
+            with topic.lock:
+                if topic.queue.empty():
+                    topic.pumping = False
+                    return
+
+    @staticmethod
+    def _deliver(topic, event):
+        for subscriber in topic.subscribers:
+            try:
+                subscriber(event)
+            except Exception:
+                topic.errors += 1
+                traceback.print_exc()
+        topic.delivered += 1
+
+    # ----------------------------------------------------------- lifecycle
+
+    def flush(self, timeout=None):
+        """
+        Wait until every event published so far has been delivered.
+
+        Returns:
+        - bool: False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for topic in self._topics.values():
+            with topic.queue.all_tasks_done:
+                while topic.queue.unfinished_tasks:
+                    if deadline is None:
+                        topic.queue.all_tasks_done.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    topic.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        """
+        Returns:
+        - dict: Per topic, the events queued and delivered, the subscriber
+          errors and the number of subscribers.
+        """
+        return {
+            name: {
+                "queued": topic.queue.qsize(),
+                "delivered": topic.delivered,
+                "errors": topic.errors,
+                "subscribers": len(topic.subscribers),
+            }
+            for name, topic in self._topics.items()
+        }
+
+    def shutdown(self, timeout=None):
+        """Deliver what is queued, then stop the pool."""
+        self.flush(timeout)
+        self._pool.shutdown(wait=True)
+
+
+bus = EventBus()
+
+
+def publish_after_commit(topic, event):
+    """
+    Publish an event on the shared bus once the current unit of work (if
+    any) commits to the storage engine.
+    """
+    backend = get_backend()
+    if isinstance(backend, UnitOfWork):
+        backend.events.append((topic, event))
+    else:
+        bus.publish(topic, event)
+
+
+def _publish_committed(uow):
+    for topic, event in uow.events:
+        bus.publish(topic, event)
+
+
+UnitOfWork.committed_listeners.append(_publish_committed)
@@ -0,0 +1,241 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Streaming export of the payment ledger as CSV or JSONL.
+
+Rows flow through a chain of generators: payments are read a page at a
+time in date order (through the indexed ``payments_page`` of the storage
+backend, which also applies the date and amount filters), given their
+block, formatted and joined into chunks of text. A web response can send
+each chunk as soon as it is ready.
+
+Columns: email, amount, date, block. The block is looked up from the
+occupant store (it is empty for payments of occupants no longer stored).
+Payments don't carry their block, so the block filter is applied to each
+page once its blocks are known. Engines with point lookups (SQLite) are
+asked for the occupants of each page, so memory stays constant however many
+payments and occupants there are; the pickle store is a single file, read
+once into an ``email -> block`` map that grows with the number of occupants.
+
+Usage:
+    python export.py payments.csv [--start 2024-01-01] [--end 2024-01-31]
+                     [--block A] [--min-amount 500] [--max-amount 1000]
+                     [--format csv|jsonl]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+import csv
+from datetime import datetime
+import io
+import json
+import sys
+
+import records
+from storage import get_backend, OCCUPANTS
+
+COLUMNS = ("email", "amount", "date", "block")
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+# Payments read from storage per page.
+PAGE_SIZE = 5000
+# Approximate size of each chunk of output text.
+CHUNK_SIZE = 64 * 1024
+
+
+def date_bound(value, upper=False):
+    """
+    Parse a date filter.
+
+    Args:
+    - value (str): "YYYY-MM-DD", optionally followed by a time.
+    - upper (bool): Round a bare date or minute up to the end of it.
+
+    Returns:
+    - str: Date as stored with payments, or None when no value was given.
+
+    Raises:
+    - ValueError: Raised if the value is not a date.
+    """
+    if not value:
+        return None
+    formats = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+    for fmt in formats:
+        try:
+            date = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if upper and fmt == "%Y-%m-%d":
+            date = date.replace(hour=23, minute=59, second=59)
+        elif upper and fmt == "%Y-%m-%dT%H:%M":
+            date = date.replace(second=59)
+        return date.strftime("%Y-%m-%d %H:%M:%S")
+    raise ValueError("Invalid date: %s" % value)
+
+
+# ------------------------------------------------------------------- pipeline
+
+
+def iter_pages(start=None, end=None, min_amount=None, max_amount=None):
+    """
+    Yield lists of ``(email, amount, date)`` records in date order.
+
+    Args:
+    - start, end (str): Inclusive date bounds.
+    - min_amount, max_amount (number): Inclusive amount bounds.
+    """
+    backend = get_backend()
+    after = None
+    while True:
+        page, after = backend.payments_page(
+            start=start,
+            end=end,
+            after=after,
+            limit=PAGE_SIZE,
+            min_amount=min_amount,
+            max_amount=max_amount,
+        )
+        yield page
+        if after is None:
+            return
+
+
+def iter_payments(start=None, end=None, min_amount=None, max_amount=None):
+    """
+    Yield ``(email, amount, date)`` records in date order, a page at a time.
+    Takes the arguments of ``iter_pages``.
+    """
+    for page in iter_pages(start, end, min_amount, max_amount):
+        yield from page
+
+
+def occupant_blocks(emails=None):
+    """
+    Look up the block of occupants.
+
+    Args:
+    - emails: Emails to look up, or None for every stored occupant.
+
+    Returns:
+    - dict: Block of each occupant found, keyed by email.
+    """
+    backend = get_backend()
+    if emails is not None:
+        found = backend.get_many(OCCUPANTS, emails)
+        return {email: occupant._block_no for email, occupant in found.items()}
+    field = records.OCCUPANT_BLOCK_FIELD
+    return {
+        email: record[field]
+        for email, record in backend.load_records(OCCUPANTS).items()
+    }
+
+
+def iter_rows(start=None, end=None, block=None, min_amount=None, max_amount=None):
+    """
+    Yield the exported rows as ``(email, amount, date, block)`` tuples.
+
+    Args:
+    - start, end (str): Inclusive date bounds.
+    - block (str): Only payments of occupants of this block.
+    - min_amount, max_amount (number): Inclusive amount bounds.
+    """
+    per_page = get_backend().point_lookups
+    blocks = None if per_page else occupant_blocks()
+    if block is not None:
+        block = block.upper()
+    for page in iter_pages(start, end, min_amount, max_amount):
+        if per_page:
+            blocks = occupant_blocks({email for email, _, _ in page})
+        for email, amount, date in page:
+            row_block = blocks.get(email, "")
+            if block is not None and row_block.upper() != block:
+                continue
+            yield email, amount, date, row_block
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, row))) + "\n"
+
+
+def iter_chunks(rows, fmt="csv", chunk_size=CHUNK_SIZE):
+    """
+    Format rows and join them into chunks of text.
+
+    Args:
+    - rows: Iterable of rows from ``iter_rows``.
+    - fmt (str): "csv" or "jsonl".
+    - chunk_size (int): Approximate number of characters per chunk.
+
+    Yields:
+    - str: Chunks of the export.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format: %s" % fmt)
+    lines = _csv_lines(rows) if fmt == "csv" else _jsonl_lines(rows)
+    pending, size = [], 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(pending)
+            pending, size = [], 0
+    if pending:
+        yield "".join(pending)
+
+
+def export(out, fmt="csv", **filters):
+    """
+    Write an export to a text file.
+
+    Args:
+    - out: File object opened for writing text.
+    - fmt (str): "csv" or "jsonl".
+    - filters: Keyword arguments of ``iter_rows``.
+
+    Returns:
+    - None
+    """
+    for chunk in iter_chunks(iter_rows(**filters), fmt):
+        out.write(chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("path", help="output file, or - for stdout")
+    parser.add_argument("--format", choices=sorted(FORMATS))
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    parser.add_argument("--block")
+    parser.add_argument("--min-amount", type=float)
+    parser.add_argument("--max-amount", type=float)
+    args = parser.parse_args()
+
+    fmt = args.format or ("jsonl" if args.path.endswith(".jsonl") else "csv")
+    try:
+        filters = dict(
+            start=date_bound(args.start),
+            end=date_bound(args.end, upper=True),
+            block=args.block,
+            min_amount=args.min_amount,
+            max_amount=args.max_amount,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    if args.path == "-":
+        export(sys.stdout, fmt, **filters)
+    else:
+        with open(args.path, "w", newline="", encoding="utf-8") as out:
+            export(out, fmt, **filters)
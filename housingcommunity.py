@@ -20,8 +20,14 @@ DISCLAIMER:
 
 
 from abc import ABC, abstractmethod
-import pickle
+from contextlib import contextmanager
+import threading
 from occupant import OCCUPANT_DB
+from storage import get_backend, flat_key
+import records
+from unit_of_work import UnitOfWork
+from events import publish_after_commit, OCCUPANCY
+import metrics
 
 
 class HC_ERROR(Exception):
@@ -72,6 +78,7 @@ class UnoccupiedState(State):
         """
         flat._occupancy_status = OccupiedState()
         flat._state = OccupiedState.state
+        flat._status_changed(self.state)
 
 
 class OccupiedState(State):
@@ -93,6 +100,7 @@ class OccupiedState(State):
         """
         flat._occupancy_status = UnoccupiedState()
         flat._state = UnoccupiedState.state
+        flat._status_changed(self.state)
 
 
 class Flat:
@@ -106,6 +114,78 @@ class Flat:
         self._bhk = bhk
         self._occupant = None
         self._occupancy_status = UnoccupiedState()  # Initial State
+        self._community = None  # Set while the flat belongs to a community
+
+    @property
+    def _occupant(self):
+        """
+        Occupant of the flat, resolved from OCCUPANT_DB on first access.
+        Only the occupant's email is stored with the flat.
+
+        Returns:
+        - OCCUPANT object, or None if the flat has no occupant.
+        """
+        email = self._occupant_email
+        if email is None:
+            return None
+        occupant = self.__dict__.get("_occupant_obj")
+        if occupant is None or occupant._email_id != email:
+            try:
+                occupant = OCCUPANT_DB.get_occupant(email)
+            except KeyError:
+                return None
+            self._occupant_obj = occupant
+        return occupant
+
+    @_occupant.setter
+    def _occupant(self, occupant):
+        self._occupant_email = None if occupant is None else occupant._email_id
+        self._occupant_obj = occupant
+
+    def __getstate__(self):
+        """
+        Pickle the flat without its back-reference to the community or the
+        resolved occupant.
+
+        Returns:
+        - dict: Instance state to be pickled.
+        """
+        state = self.__dict__.copy()
+        state.pop("_community", None)
+        state.pop("_occupant_obj", None)
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled flat. Flats pickled with the whole occupant
+        embedded keep it in memory only and store its email from now on.
+
+        Args:
+        - state: Instance state from the pickle.
+
+        Returns:
+        - None
+        """
+        state = dict(state)
+        if "_occupant" in state:
+            occupant = state.pop("_occupant")
+            state["_occupant_email"] = None if occupant is None else occupant._email_id
+            state["_occupant_obj"] = occupant
+        self.__dict__.update(state)
+
+    def _status_changed(self, old_state):
+        """
+        Tell the owning community that the occupancy status changed.
+
+        Args:
+        - old_state (str): Occupancy state before the change.
+
+        Returns:
+        - None
+        """
+        community = getattr(self, "_community", None)
+        if community is not None:
+            community._flat_status_changed(self, old_state)
 
     def get_state(self):
         """
@@ -138,15 +218,29 @@ class Flat:
         Raises:
         - HC_ERROR: Raised if already occupied.
         """
-        if self.get_state() == "No":
-            self.change_occupancy_status()
-            occupant._block_no = self._block_no
-            occupant._flat_no = self._flat_no
-            self._occupant = occupant
-            self.update_OC()
-            self.update_HC()
-        else:
-            raise HC_ERROR("Already Occupied !!! ")
+        hc = HousingCommunity.GET_HC()
+        # Checked and changed under the community lock, on the community as
+        # stored, so no other writer saves the change before it commits.
+        with hc._writing():
+            flat = hc.get_flat_by_details(self._block_no, self._flat_no) or self
+            if flat.get_state() != "No":
+                raise HC_ERROR("Already Occupied !!! ")
+            flat.change_occupancy_status()
+            occupant._block_no = flat._block_no
+            occupant._flat_no = flat._flat_no
+            flat._occupant = occupant
+            flat.update_OC()
+            hc.update_flat_details(flat)
+            publish_after_commit(
+                OCCUPANCY,
+                {
+                    "block_no": flat._block_no,
+                    "flat_no": flat._flat_no,
+                    "bhk": flat._bhk,
+                    "email": occupant._email_id,
+                    "occupied": True,
+                },
+            )
 
     def update_HC(self):
         """
@@ -167,6 +261,79 @@ class Flat:
         OCCUPANT_DB.store_occupant(self._occupant)
 
 
+class CommunitySnapshot:
+    """
+    Immutable copy of what the read-only pages show of a community.
+
+    A snapshot is never changed once built: writers publish a new one and
+    readers keep using the one they picked up until they are done with it,
+    so reading takes no lock. An old snapshot is freed once no request
+    holds it any more.
+
+    Args:
+    - hc (HousingCommunity): Community to copy.
+    - stamp: Backend stamp of the stored community ``hc`` matches.
+    - backend: Storage engine ``hc`` was read from or written to.
+    """
+
+    __slots__ = ("stamp", "backend", "blocks", "vacant", "occupied")
+
+    def __init__(self, hc, stamp, backend):
+        self.stamp = stamp
+        self.backend = backend
+        self.blocks = tuple(hc.list_blocks())
+        self.vacant = tuple(
+            (flat._block_no, flat._flat_no, flat._bhk)
+            for flat in hc.get_unoccupied_flat_objs()
+        )
+        occupied = []
+        for flat in hc.get_occupied_flat_objs():
+            # Flats pickled with an embedded occupant fall back to it.
+            embedded = flat.__dict__.get("_occupant_obj")
+            occupied.append(
+                (
+                    flat._block_no,
+                    flat._flat_no,
+                    flat._occupant_email,
+                    embedded._name if embedded else "",
+                    embedded._phone_no if embedded else "",
+                )
+            )
+        self.occupied = tuple(occupied)
+
+    def list_blocks(self):
+        """
+        Returns:
+        - tuple: Blocks of the community.
+        """
+        return self.blocks
+
+    def get_unoccupied_flats_info(self):
+        """
+        Returns:
+        - tuple: ``(block, flat_no, bhk)`` of every unoccupied flat.
+        """
+        return self.vacant
+
+    def list_occupied_flats(self):
+        """
+        List the occupied flats with their occupants, read from OCCUPANT_DB.
+
+        Returns:
+        - List: ``[block, flat_no, name, phone]`` of every occupied flat.
+        """
+        occupants = OCCUPANT_DB.get_occupants(
+            [email for _, _, email, _, _ in self.occupied if email]
+        )
+        occupied_flats = []
+        for block_no, flat_no, email, name, phone in self.occupied:
+            occupant = occupants.get(email)
+            if occupant is not None:
+                name, phone = occupant._name, occupant._phone_no
+            occupied_flats.append([block_no, flat_no, name, phone])
+        return occupied_flats
+
+
 class HousingCommunity:
     """
     Class representing a housing community managing flats and blocks.
@@ -174,6 +341,19 @@ class HousingCommunity:
 
     _instance = None
 
+    # Indexes rebuilt from _flats on load instead of being pickled, and the
+    # backend stamp of the stored community the instance matches.
+    _DERIVED = ("_flat_index", "_seq", "_occupied", "_vacant", "_counts", "_stamp")
+
+    # Process-local copy of the stored community, reused while the backend's
+    # stamp for it is unchanged: (stamp, backend, instance).
+    _cache = None
+    _cache_lock = threading.Lock()
+    _cache_stats = {"hits": 0, "misses": 0}
+    # Latest CommunitySnapshot. Only ever replaced, never changed, so
+    # readers take it without a lock.
+    _snapshot = None
+
     @staticmethod
     def create_Housing_community():
         """
@@ -198,33 +378,323 @@ class HousingCommunity:
         if HousingCommunity._instance is None:
             self._blocks = []
             self._flats = {}
+            self._reindex()
             HousingCommunity._instance = self
         else:
             raise HC_ERROR("Housing Community Already Established !")
 
+    def __getstate__(self):
+        """
+        Pickle the community without its derived indexes, with the flats
+        in the compact record format.
+
+        Returns:
+        - dict: Instance state to be pickled.
+        """
+        state = self.__dict__.copy()
+        for name in HousingCommunity._DERIVED:
+            state.pop(name, None)
+        state["_flat_records"] = records.pack_flats(state.pop("_flats"))
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled community and rebuild its indexes.
+        Files written before the indexes or the record format existed load
+        the same way.
+
+        Args:
+        - state: Instance state from the pickle.
+
+        Returns:
+        - None
+        """
+        state = dict(state)
+        if "_flat_records" in state:
+            state["_flats"] = records.unpack_flats(state.pop("_flat_records"))
+        self.__dict__.update(state)
+        self._reindex()
+
+    def _reindex(self):
+        """
+        Rebuild the flat index and occupancy indexes from the block flat lists.
+
+        Returns:
+        - None
+        """
+        self._flat_index = {}  # flat key -> (block, position in block list)
+        self._seq = {}  # flat key -> listing order
+        self._occupied = {}  # flat keys of occupied flats (ordered set)
+        self._vacant = {}  # flat keys of unoccupied flats (ordered set)
+        self._counts = {}  # (block | None, bhk | None) -> {"Yes": n, "No": n}
+        for block_no, block_flats in self._flats.items():
+            for position, flat in enumerate(block_flats):
+                key = flat_key(flat._block_no, flat._flat_no)
+                if key not in self._flat_index:
+                    self._flat_index[key] = (block_no, position)
+                    self._seq[key] = len(self._seq)
+                    self._track(key, flat, 1)
+
+    def _track(self, key, flat, delta):
+        """
+        Add (delta=1) or remove (delta=-1) a flat from the occupancy indexes.
+
+        Returns:
+        - None
+        """
+        state = flat.get_state()
+        for group in self._groups(flat):
+            counts = self._counts.setdefault(group, {"Yes": 0, "No": 0})
+            counts[state] += delta
+        target = self._occupied if state == "Yes" else self._vacant
+        if delta > 0:
+            target[key] = None
+            flat._community = self
+        else:
+            target.pop(key, None)
+            flat._community = None
+
+    @staticmethod
+    def _groups(flat):
+        """Counter keys a flat contributes to."""
+        return (
+            (None, None),
+            (flat._block_no, None),
+            (None, flat._bhk),
+            (flat._block_no, flat._bhk),
+        )
+
+    def _flat_status_changed(self, flat, old_state):
+        """
+        Move a flat between the occupied and vacant indexes.
+        Called by the occupancy states through Flat._status_changed.
+
+        Args:
+        - flat: Flat whose status changed.
+        - old_state (str): Occupancy state before the change.
+
+        Returns:
+        - None
+        """
+        key = flat_key(flat._block_no, flat._flat_no)
+        if self.get_flat_by_details(*key) is not flat:
+            return
+        new_state = flat.get_state()
+        if new_state == old_state:
+            return
+        for group in self._groups(flat):
+            counts = self._counts[group]
+            counts[old_state] -= 1
+            counts[new_state] += 1
+        source, target = (
+            (self._vacant, self._occupied)
+            if new_state == "Yes"
+            else (self._occupied, self._vacant)
+        )
+        source.pop(key, None)
+        target[key] = None
+
     @staticmethod
+    @metrics.timed("HousingCommunity.GET_HC")
     def GET_HC():
         """
-        Static method to retrieve Housing Community from a pickle file.
+        Static method to retrieve Housing Community from the storage backend.
+
+        The loaded instance is cached and handed out again for as long as the
+        stored community is unchanged (checked through the backend's stamp),
+        so repeated reads skip deserialization.
 
         Returns:
-        - HousingCommunity instance from the pickle file.
+        - HousingCommunity instance from the storage backend.
+        """
+        backend = get_backend()
+        pending = backend.pending_community()
+        if pending is not None:
+            return pending
+        backend = backend.engine
+        stamp = backend.stamp("community")
+        with HousingCommunity._cache_lock:
+            cached = HousingCommunity._cache
+            if (
+                cached is not None
+                and stamp is not None
+                and cached[0] == stamp
+                and cached[1] is backend
+            ):
+                HousingCommunity._cache_stats["hits"] += 1
+                return cached[2]
+            HousingCommunity._cache_stats["misses"] += 1
+        hc = backend.load_community()
+        hc._stamp = stamp
+        with HousingCommunity._cache_lock:
+            HousingCommunity._cache = (stamp, backend, hc)
+        return hc
+
+    @staticmethod
+    def snapshot():
         """
-        HC_FILE = "housing_community.pickle"
-        with open(HC_FILE, "rb") as file:
-            return pickle.load(file)
+        Static method to get an immutable snapshot of the stored community
+        for read-only pages, without taking a lock.
 
+        The latest snapshot is used while the backend's stamp for the
+        community is unchanged. Otherwise (a write by another process) a
+        new one is built from the stored community and published. Inside a
+        unit of work the snapshot shows its pending changes and is not
+        published.
+
+        Returns:
+        - CommunitySnapshot
+        """
+        backend = get_backend()
+        pending = backend.pending_community()
+        if pending is not None:
+            return CommunitySnapshot(pending, None, None)
+        backend = backend.engine
+        snapshot = HousingCommunity._snapshot
+        stamp = backend.stamp("community")
+        if (
+            snapshot is not None
+            and stamp is not None
+            and snapshot.stamp == stamp
+            and snapshot.backend is backend
+        ):
+            return snapshot
+        # Built from a fresh load, not the cached instance, which a writer
+        # may be changing before it saves.
+        snapshot = CommunitySnapshot(backend.load_community(), stamp, backend)
+        HousingCommunity._snapshot = snapshot
+        return snapshot
+
+    @staticmethod
+    def cache_stats():
+        """
+        Static method to report how GET_HC has been served.
+
+        Returns:
+        - dict: Number of cache "hits" and "misses".
+        """
+        with HousingCommunity._cache_lock:
+            return dict(HousingCommunity._cache_stats)
+
+    @staticmethod
+    def clear_cache():
+        """
+        Static method to drop the cached community and reset the counters.
+
+        Returns:
+        - None
+        """
+        with HousingCommunity._cache_lock:
+            HousingCommunity._cache = None
+            HousingCommunity._cache_stats = {"hits": 0, "misses": 0}
+        HousingCommunity._snapshot = None
+
+    @staticmethod
+    def _invalidate(uow=None):
+        """
+        Static method to drop the cached community after a rollback, and
+        reload the instance the unit of work changed so it no longer holds
+        changes that were never saved. An enclosing unit of work buffering
+        the same instance keeps it as it is.
+
+        Returns:
+        - None
+        """
+        with HousingCommunity._cache_lock:
+            HousingCommunity._cache = None
+        if uow is None or uow.community is None:
+            return
+        if uow._base.pending_community() is not uow.community:
+            uow.community._refresh(uow._base, force=True)
+
+    @staticmethod
+    def _committed(uow):
+        """
+        Static method to cache the community a unit of work just saved.
+
+        Returns:
+        - None
+        """
+        if uow.community is not None:
+            uow.community._written(uow.engine)
+
+    def _written(self, backend):
+        """
+        Make this instance the cached community after it has been saved,
+        and publish a snapshot of it for readers.
+        Writes buffered by a unit of work are cached once it commits.
+
+        Args:
+        - backend: Storage backend the instance was written to.
+
+        Returns:
+        - None
+        """
+        if backend is not backend.engine:
+            return
+        stamp = backend.stamp("community")
+        self._stamp = stamp
+        with HousingCommunity._cache_lock:
+            HousingCommunity._cache = (stamp, backend, self)
+        HousingCommunity._snapshot = CommunitySnapshot(self, stamp, backend)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Hold the community lock of the backend for a change to this
+        instance, after bringing the instance up to date with the stored
+        community. A change made to a stale copy would otherwise overwrite
+        the changes other processes saved since it was loaded.
+
+        Yields:
+        - StorageBackend: Backend to save the change to.
+        """
+        backend = get_backend()
+        with backend.lock_community():
+            self._refresh(backend)
+            yield backend
+
+    def _refresh(self, backend, force=False):
+        """
+        Reload the stored community into this instance if it has changed
+        since the instance was loaded or saved. The caller holds the
+        community lock.
+
+        Args:
+        - backend: Current storage backend.
+        - force (bool): Reload even if the stored community is unchanged.
+
+        Returns:
+        - None
+        """
+        if backend.pending_community() is self and not force:
+            return
+        engine = backend.engine
+        stamp = engine.stamp("community")
+        if not force and stamp is not None and stamp == self.__dict__.get("_stamp"):
+            return
+        try:
+            fresh = engine.load_community()
+        except FileNotFoundError:
+            return
+        self.__dict__.update(fresh.__dict__)
+        self._reindex()
+        self._stamp = stamp
+
+    @metrics.timed("HousingCommunity.Update_HC")
     def Update_HC(self):
         """
-        Method to update Housing Community in a pickle file.
-        Writes the current instance to the pickle file.
+        Method to update Housing Community in the storage backend.
+        Writes the whole current instance, waiting for any unit of work
+        holding the community lock to finish first.
 
         Returns:
         - None
         """
-        HC_FILE = "housing_community.pickle"
-        with open(HC_FILE, "wb") as file:
-            pickle.dump(self, file)
+        backend = get_backend()
+        with backend.lock_community():
+            backend.save_community(self)
+            self._written(backend)
 
     def update_flat_details(self, new_flat):
         """
@@ -235,14 +705,29 @@ class HousingCommunity:
 
         Returns:
         - None
+
+        Raises:
+        - HC_ERROR: Raised if another occupant took the flat in the meantime.
         """
-        block_no = new_flat._block_no
-        all_flats = self._flats[block_no]
-        for index, flat in enumerate(all_flats):
-            if flat._flat_no == new_flat._flat_no:
-                self._flats[block_no][index] = new_flat
-                self.Update_HC()
+        with self._writing() as backend:
+            key = flat_key(new_flat._block_no, new_flat._flat_no)
+            location = self._flat_index.get(key)
+            if location is None:
                 return
+            block_no, position = location
+            old_flat = self._flats[block_no][position]
+            if old_flat is not new_flat:
+                if (
+                    old_flat.get_state() == "Yes"
+                    and new_flat.get_state() == "Yes"
+                    and old_flat._occupant_email != new_flat._occupant_email
+                ):
+                    raise HC_ERROR("Already Occupied !!! ")
+                self._track(key, old_flat, -1)
+                self._flats[block_no][position] = new_flat
+                self._track(key, new_flat, 1)
+            backend.save_flat(self, new_flat)
+            self._written(backend)
 
     def add_block(self, block):
         """
@@ -255,11 +740,13 @@ class HousingCommunity:
         - HC_ERROR: Raised if the block already exists.
         """
         block = block.upper()
-        if block not in self._blocks:
-            self._blocks.append(block)
-            self.Update_HC()
-        else:
-            raise HC_ERROR("Block Already Exists !")
+        with self._writing() as backend:
+            if block not in self._blocks:
+                self._blocks.append(block)
+                backend.save_community_header(self)
+                self._written(backend)
+            else:
+                raise HC_ERROR("Block Already Exists !")
 
     def add_flat(self, flat):
         """
@@ -269,16 +756,23 @@ class HousingCommunity:
         - flat: Flat object to be added to the housing community.
 
         Raises:
-        - HC_ERROR: Raised if the block for the flat doesn't exist.
-        """
-        if flat._block_no in self._blocks:
-            if flat._block_no not in self._flats:
-                self._flats[flat._block_no] = [flat]
+        - HC_ERROR: Raised if the block for the flat doesn't exist or the flat
+          is already part of the block.
+        """
+        with self._writing() as backend:
+            if flat._block_no in self._blocks:
+                key = flat_key(flat._block_no, flat._flat_no)
+                if key in self._flat_index:
+                    raise HC_ERROR("Flat Already Exists !")
+                block_flats = self._flats.setdefault(flat._block_no, [])
+                self._flat_index[key] = (flat._block_no, len(block_flats))
+                self._seq[key] = len(self._seq)
+                block_flats.append(flat)
+                self._track(key, flat, 1)
+                backend.save_flat(self, flat)
+                self._written(backend)
             else:
-                self._flats[flat._block_no].append(flat)
-            self.Update_HC()
-        else:
-            raise HC_ERROR("Block Doesn't Exist")
+                raise HC_ERROR("Block Doesn't Exist")
 
     def list_blocks(self):
         """
@@ -299,6 +793,22 @@ class HousingCommunity:
         flats_list = [(block, flat._flat_no) for (block, flat) in self._flats.keys()]
         return flats_list
 
+    def _listed(self, keys):
+        """
+        Resolve flat keys to Flat objects in the order flats were added.
+
+        Args:
+        - keys: Flat keys from one of the occupancy indexes.
+
+        Returns:
+        - List: Flat objects.
+        """
+        flats = []
+        for key in sorted(keys, key=self._seq.__getitem__):
+            block_no, position = self._flat_index[key]
+            flats.append(self._flats[block_no][position])
+        return flats
+
     def get_unoccupied_flat_objs(self):
         """
         Get a list of unoccupied flat objects in the housing community.
@@ -306,12 +816,7 @@ class HousingCommunity:
         Returns:
         - List: List of unoccupied flat objects.
         """
-        unoccupied_flats = []
-        for block_flats in self._flats.values():
-            for flat in block_flats:
-                if flat._occupancy_status.state == "No":
-                    unoccupied_flats.append(flat)
-        return unoccupied_flats
+        return self._listed(self._vacant)
 
     def get_unoccupied_flats_info(self):
         """
@@ -320,13 +825,10 @@ class HousingCommunity:
         Returns:
         - List: List of lists containing details of unoccupied flats.
         """
-        unoccupied_flats_info = []
-        for block_flats in self._flats.values():
-            for flat in block_flats:
-                if flat._occupancy_status.state == "No":
-                    flat_info = [flat._block_no, flat._flat_no, flat._bhk]
-                    unoccupied_flats_info.append(flat_info)
-        return unoccupied_flats_info
+        return [
+            [flat._block_no, flat._flat_no, flat._bhk]
+            for flat in self.get_unoccupied_flat_objs()
+        ]
 
     def get_occupied_flat_objs(self):
         """
@@ -335,12 +837,7 @@ class HousingCommunity:
         Returns:
         - List: List of occupied flat objects.
         """
-        occupied_flats = []
-        for block_flats in self._flats.values():
-            for flat in block_flats:
-                if flat._occupancy_status.state == "Yes":
-                    occupied_flats.append(flat)
-        return occupied_flats
+        return self._listed(self._occupied)
 
     def list_occupied_flats(self):
         """
@@ -349,21 +846,49 @@ class HousingCommunity:
         Returns:
         - List: List of lists containing details of occupied flats.
         """
-        occupied_flats = []
         flats = self.get_occupied_flat_objs()
-        for block_flats in self._flats.values():
-            for flat in block_flats:
-                if flat._occupancy_status.state == "Yes":
-                    occupied_flats.append(
-                        [
-                            flat._block_no,
-                            flat._flat_no,
-                            flat._occupant._name,
-                            flat._occupant._phone_no,
-                        ]
-                    )
+        occupants = OCCUPANT_DB.get_occupants(
+            [flat._occupant_email for flat in flats if flat._occupant_email]
+        )
+        occupied_flats = []
+        for flat in flats:
+            occupant = occupants.get(flat._occupant_email) or flat.__dict__.get(
+                "_occupant_obj"
+            )
+            occupied_flats.append(
+                [
+                    flat._block_no,
+                    flat._flat_no,
+                    occupant._name if occupant else "",
+                    occupant._phone_no if occupant else "",
+                ]
+            )
         return occupied_flats
 
+    def normalize_occupants(self):
+        """
+        Rewrite flats pickled with embedded occupants so they keep only the
+        occupant's email. Embedded occupants missing from OCCUPANT_DB are
+        stored there first, so nothing is lost.
+
+        Returns:
+        - int: Number of occupants copied into OCCUPANT_DB.
+        """
+        with self._writing():
+            embedded = {}
+            for flat in self.get_occupied_flat_objs():
+                occupant = flat.__dict__.get("_occupant_obj")
+                if occupant is not None:
+                    embedded[occupant._email_id] = occupant
+            known = OCCUPANT_DB.get_occupants(list(embedded))
+            missing = [
+                occupant for email, occupant in embedded.items() if email not in known
+            ]
+            for occupant in missing:
+                OCCUPANT_DB.store_occupant(occupant)
+            self.Update_HC()
+        return len(missing)
+
     def list_unoccupied_flats(self):
         """
         List details of unoccupied flats in the housing community.
@@ -374,6 +899,32 @@ class HousingCommunity:
         flats = self.get_unoccupied_flat_objs()
         return [[flat._block_no, flat._flat_no] for flat in flats]
 
+    def count_occupied(self, block_no=None, bhk=None):
+        """
+        Count occupied flats, optionally within a block and/or BHK type.
+
+        Args:
+        - block_no (str): Block to count in (all blocks if None).
+        - bhk (int): BHK type to count (all types if None).
+
+        Returns:
+        - int: Number of occupied flats.
+        """
+        return self._counts.get((block_no, bhk), {}).get("Yes", 0)
+
+    def count_vacant(self, block_no=None, bhk=None):
+        """
+        Count unoccupied flats, optionally within a block and/or BHK type.
+
+        Args:
+        - block_no (str): Block to count in (all blocks if None).
+        - bhk (int): BHK type to count (all types if None).
+
+        Returns:
+        - int: Number of unoccupied flats.
+        """
+        return self._counts.get((block_no, bhk), {}).get("No", 0)
+
     def get_flat_by_details(self, block_no, flat_no):
         """
         Get flat details by block number and flat number.
@@ -385,14 +936,15 @@ class HousingCommunity:
         Returns:
         - Flat object: Flat object if found, otherwise None.
         """
-        flat_no = str(flat_no)
-        block_no = block_no.upper()
-        if block_no in self._flats:
-            all_flats = self._flats[block_no]
-            for flat in all_flats:
-                if str(flat._flat_no) == flat_no:
-                    return flat
-        return None
+        location = self._flat_index.get(flat_key(block_no, flat_no))
+        if location is None:
+            return None
+        block_no, position = location
+        return self._flats[block_no][position]
+
+
+UnitOfWork.committed_listeners.append(HousingCommunity._committed)
+UnitOfWork.rolled_back_listeners.append(HousingCommunity._invalidate)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,871 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Append-only payment ledger.
+
+Payments are written as checksummed frames to a log file, so recording a
+payment costs one append instead of a rewrite of every payment ever made.
+Once the log grows past a threshold it is folded into a chunked snapshot
+on a background thread, so the append that crosses it doesn't wait. Appends
+remember where the valid frames of the log end, so they read only the
+frames written since their last look.
+
+Files:
+    <base>.log   : header (magic, generation) followed by frames.
+    <base>.snap  : header (magic, absorbed generation) followed by frames,
+                   a directory frame, an optional keys frame and a trailer
+                   (magic, directory offset).
+    rollups file : optional; the payment rollups (see ``rollups.py``) and
+                   the log generation and offset folded into them.
+
+Each frame is ``<length:u32><crc32:u32><payload>`` where the payload is a
+pickled list of ``(email, amount, date)`` records. A log frame may instead
+hold ``{"records": [...], "rollups": [...], "keys": [...]}``, so the rollup
+increments and the idempotency keys of the payments (see
+``payment_queue.py``) are written by the same append. A frame that is cut short or
+fails its checksum marks the end of the valid data; writers truncate such a
+tail before appending again.
+
+The rollups file is rewritten only by compaction, which folds the
+increments of the log into it before the log is absorbed. Readers add the
+increments of the log past the folded offset.
+
+Compaction carries the last ``KEYS_KEPT`` keys over into the snapshot's
+keys frame, so whether a key was paid is answered by the ledger itself.
+
+The snapshot is kept sorted by ``sort_key`` (date, then email and amount),
+and its directory lists the key range and offset of every frame. A date
+range is found by binary search over the directory, so reading one page of
+payments costs the frames it overlaps rather than the whole ledger.
+Compaction merges the sorted snapshot with the (small) sorted log, so it
+still streams.
+
+Writers hold the exclusive lock of ``<base>`` (see ``locking.py``) and both
+files are only ever replaced by rename, so several processes can share one
+ledger.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import bisect
+import heapq
+from itertools import islice
+import os
+import pickle
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+from locking import atomic_writer, exclusive, shared
+import metrics
+
+LOG_MAGIC = b"HCPL"
+SNAP_MAGIC = b"HCPS"
+INDEX_MAGIC = b"HCPI"
+HEADER = struct.Struct("<4sQ")
+FRAME = struct.Struct("<II")
+# Name of the ledger and of the rollups in the metrics.
+STORE = "payments"
+ROLLUPS = "rollups"
+
+# Number of log records after which the log is folded into the snapshot.
+COMPACT_THRESHOLD = 4096
+# Number of records per snapshot frame.
+SNAP_CHUNK = 1024
+# Number of idempotency keys kept when the log is folded into the snapshot.
+KEYS_KEPT = 65536
+
+
+def sort_key(record):
+    """Snapshot order of an ``(email, amount, date)`` record."""
+    email, amount, date = record
+    return date, email, amount
+
+
+class LedgerError(Exception):
+    """Raised when a ledger file is not recognised."""
+
+    pass
+
+
+def _read_header(f, magic):
+    """Read and check a file header, returning its generation number."""
+    raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        return None
+    found, generation = HEADER.unpack(raw)
+    if found != magic:
+        raise LedgerError("Unrecognised ledger file: %r" % f.name)
+    return generation
+
+
+def _iter_frames(f, end=None):
+    """
+    Yield ``(offset_after_frame, records)`` for every valid frame in ``f``.
+
+    Stops silently at the first incomplete or corrupt frame, and before any
+    frame that would run past ``end`` (the end of the file by default), so a
+    garbled length is never allocated.
+    """
+    if end is None:
+        end = os.fstat(f.fileno()).st_size
+    while True:
+        head = f.read(FRAME.size)
+        if len(head) < FRAME.size:
+            return
+        length, crc = FRAME.unpack(head)
+        if length > end - f.tell():
+            return
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield f.tell(), _loads(payload)
+
+
+def _loads(payload):
+    """Unpickle a frame payload, counting it in the metrics."""
+    metrics.record_read(STORE, FRAME.size + len(payload))
+    start = time.perf_counter()
+    try:
+        return pickle.loads(payload)
+    finally:
+        metrics.record_deserialize(STORE, start)
+
+
+def _frame(records):
+    """Encode a list of records (or a log entry) as one frame."""
+    payload = pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _entry(payload):
+    """Return ``(records, rollup rows, keys)`` of a log frame payload."""
+    if isinstance(payload, dict):
+        return (
+            payload.get("records", []),
+            payload.get("rollups", []),
+            payload.get("keys", []),
+        )
+    return payload, [], []
+
+
+def add_rollups(table, rows):
+    """Add ``(kind, key, amount, count)`` rows to a rollup table in place."""
+    for kind, key, amount, count in rows:
+        total, old_count = table.get((kind, key), (0, 0))
+        table[kind, key] = (total + amount, old_count + count)
+
+
+def _read_frame(f, offset):
+    """Read the frame stored at ``offset``."""
+    f.seek(offset)
+    head = f.read(FRAME.size)
+    if len(head) == FRAME.size:
+        length, crc = FRAME.unpack(head)
+        payload = f.read(length)
+        if len(payload) == length and zlib.crc32(payload) == crc:
+            return _loads(payload)
+    raise LedgerError("Corrupt frame at %d in %r" % (offset, f.name))
+
+
+def _directory_offset(f):
+    """
+    Return the offset of a snapshot's directory frame (where its record
+    frames end), or None for a snapshot written before snapshots were
+    sorted. The file position is left unchanged.
+    """
+    position = f.tell()
+    try:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < 2 * HEADER.size:
+            return None
+        f.seek(size - HEADER.size)
+        magic, offset = HEADER.unpack(f.read(HEADER.size))
+        return offset if magic == INDEX_MAGIC else None
+    finally:
+        f.seek(position)
+
+
+def _snapshot_frames(snap):
+    """
+    Yield the record frames of a snapshot positioned after its header,
+    stopping at the directory frame and trailer.
+    """
+    return _iter_frames(snap, _directory_offset(snap))
+
+
+def _read_directory(f):
+    """
+    Return the frame directory of a snapshot, or None for a snapshot written
+    before snapshots were sorted.
+    """
+    offset = _directory_offset(f)
+    if offset is None:
+        return None
+    return _read_frame(f, offset)["directory"]
+
+
+def _read_keys(f):
+    """Return the idempotency keys kept in a snapshot's keys frame."""
+    offset = _directory_offset(f)
+    if offset is None:
+        return []
+    f.seek(0, os.SEEK_END)
+    end = f.tell() - HEADER.size
+    f.seek(offset)
+    length, _ = FRAME.unpack(f.read(FRAME.size))
+    f.seek(offset + FRAME.size + length)
+    for _, payload in _iter_frames(f, end):
+        return payload["keys"]
+    return []
+
+
+def _batched(records, size):
+    """Split an iterable of records into lists of ``size``."""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+class PaymentLedger:
+    """
+    Log-structured store of payment records.
+
+    Args:
+    - base: Path prefix of the ledger files.
+    - legacy_file: Optional ``{email: [{date, amount}]}`` pickle imported
+      the first time the ledger is created.
+    - rollups_file: Optional file the rollup increments are folded into.
+    """
+
+    def __init__(self, base, legacy_file=None, rollups_file=None):
+        self.base = base
+        self.log_file = base + ".log"
+        self.snap_file = base + ".snap"
+        self.legacy_file = legacy_file
+        self.rollups_file = rollups_file
+        # (file stat, directory, first keys, last keys) of the snapshot and
+        # (file stat, keys, records) of the sorted log, reused while the
+        # files are unchanged.
+        self._snap_index = None
+        self._log_index = None
+        # (snapshot stat, keys, key set) of the snapshot's keys frame.
+        self._keys_index = None
+        # (log inode, generation, end of the valid frames, record count, keys,
+        # key set) of the log scanned so far; later scans of the same log
+        # read only the frames appended since.
+        self._tail = None
+        self._tail_lock = threading.Lock()
+        # Held while a compaction started by ``append`` runs.
+        self._compacting = threading.Lock()
+        # ((rollups file stat, log inode, log generation), log offset, table)
+        # of the last rollups read, extended by the frames appended since.
+        self._rollups_index = None
+
+    # ---------------------------------------------------------------- reading
+
+    def _open_pair(self):
+        """
+        Open the snapshot and log together under the shared lock.
+
+        Both files are only ever replaced by rename, so the open handles keep
+        seeing a consistent pair even if a compaction runs while the caller
+        is still reading them.
+
+        Returns:
+        - tuple: (snapshot file or None, log file or None)
+        """
+        with shared(self.base):
+            try:
+                snap = open(self.snap_file, "rb")
+            except FileNotFoundError:
+                snap = None
+            try:
+                log = open(self.log_file, "rb")
+            except FileNotFoundError:
+                log = None
+        return snap, log
+
+    def iter_chunks(self):
+        """
+        Yield the ledger as lists of ``(email, amount, date)`` records.
+
+        Records come out in the order they were appended, a chunk at a time,
+        so callers can walk the whole ledger in bounded memory.
+        """
+        self._import_legacy()
+        snap, log = self._open_pair()
+        try:
+            absorbed = None
+            if snap is not None:
+                absorbed = _read_header(snap, SNAP_MAGIC)
+                for _, records in _snapshot_frames(snap):
+                    yield records
+            if log is not None:
+                generation = _read_header(log, LOG_MAGIC)
+                if generation is not None and (
+                    absorbed is None or generation > absorbed
+                ):
+                    for _, payload in _iter_frames(log):
+                        records = _entry(payload)[0]
+                        if records:
+                            yield records
+        finally:
+            for f in (snap, log):
+                if f is not None:
+                    f.close()
+
+    def iter_records(self):
+        """Yield every ``(email, amount, date)`` record in append order."""
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def load(self):
+        """
+        Load the ledger into the legacy ``{email: [{date, amount}]}`` shape.
+
+        Returns:
+        - dict: Payments grouped by email, in the order they were made.
+        """
+        payment_data = {}
+        for email, amount, date in self.iter_records():
+            payment_data.setdefault(email, []).append(
+                {"date": date, "amount": amount}
+            )
+        return payment_data
+
+    # ---------------------------------------------------------------- writing
+
+    def _import_legacy(self):
+        """Seed the snapshot from the legacy pickle the first time round."""
+        if self.legacy_file is None or os.path.exists(self.snap_file):
+            return
+        with exclusive(self.base):
+            if os.path.exists(self.snap_file) or os.path.exists(self.log_file):
+                return
+            try:
+                with open(self.legacy_file, "rb") as f:
+                    payment_data = pickle.load(f)
+            except FileNotFoundError:
+                payment_data = {}
+            records = [
+                (email, payment["amount"], payment["date"])
+                for email, payments in payment_data.items()
+                for payment in payments
+            ]
+            records.sort(key=sort_key)
+            self._write_snapshot(iter([records]) if records else iter(()), 0)
+
+    def _write_snapshot(self, chunks, absorbed, keys=()):
+        """
+        Write a fresh snapshot from ``chunks`` and atomically install it.
+        The records must come in ``sort_key`` order.
+        """
+        directory = []
+        start = time.perf_counter()
+        with atomic_writer(self.snap_file) as out:
+            out.write(HEADER.pack(SNAP_MAGIC, absorbed))
+            for records in _batched(
+                (record for chunk in chunks for record in chunk), SNAP_CHUNK
+            ):
+                directory.append(
+                    (sort_key(records[0]), sort_key(records[-1]), out.tell())
+                )
+                out.write(_frame(records))
+            offset = out.tell()
+            out.write(_frame({"directory": directory}))
+            if keys:
+                out.write(_frame({"keys": list(keys)}))
+            out.write(HEADER.pack(INDEX_MAGIC, offset))
+            size = out.tell()
+        metrics.record_write(STORE, size, start)
+
+    def _open_log(self):
+        """
+        Open the log for appending, recovering it first.
+        The caller must hold the exclusive lock.
+
+        A missing or already-absorbed log is restarted with a new generation,
+        and a half-written tail left behind by a crash is truncated.
+
+        Returns:
+        - tuple: (file object positioned at the end, number of valid records)
+        """
+        try:
+            with open(self.snap_file, "rb") as f:
+                absorbed = _read_header(f, SNAP_MAGIC)
+        except FileNotFoundError:
+            absorbed = None
+        if absorbed is None:
+            absorbed = 0
+            self._write_snapshot(iter(()), absorbed)
+        try:
+            f = open(self.log_file, "r+b")
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            generation = _read_header(f, LOG_MAGIC)
+            if generation is not None and generation > absorbed:
+                end, count = self._scan_log(f, generation)[:2]
+                f.seek(0, os.SEEK_END)
+                if f.tell() != end:
+                    f.truncate(end)
+                    f.flush()
+                    os.fsync(f.fileno())
+                f.seek(end)
+                return f, count
+            f.close()
+        self._reset_log(absorbed + 1)
+        f = open(self.log_file, "r+b")
+        f.seek(0, os.SEEK_END)
+        return f, 0
+
+    def _reset_log(self, generation):
+        with atomic_writer(self.log_file) as out:
+            out.write(HEADER.pack(LOG_MAGIC, generation))
+
+    def _scan_log(self, log, generation):
+        """
+        Scan an open log of ``generation`` for its valid frames.
+
+        The end of the last scan is kept per log file, so only the frames
+        appended since are read; a new log (after a compaction) is read from
+        its start.
+
+        Returns:
+        - tuple: (end of the valid frames, number of records, keys, key set)
+        """
+        st = os.fstat(log.fileno())
+        with self._tail_lock:
+            tail = self._tail
+            if (
+                tail is None
+                or tail[:2] != (st.st_ino, generation)
+                or tail[2] > st.st_size
+            ):
+                tail = (st.st_ino, generation, HEADER.size, 0, [], set())
+            _, _, end, count, keys, key_set = tail
+            if st.st_size > end:
+                log.seek(end)
+                for end, payload in _iter_frames(log):
+                    records, _, frame_keys = _entry(payload)
+                    count += len(records)
+                    keys.extend(frame_keys)
+                    key_set.update(frame_keys)
+            self._tail = (st.st_ino, generation, end, count, keys, key_set)
+            return end, count, keys, key_set
+
+    def append(self, records, rollups=(), keys=()):
+        """
+        Append records to the ledger as a single frame.
+
+        Args:
+        - records: List of ``(email, amount, date)`` tuples.
+        - rollups: ``(kind, key, amount, count)`` increments written in the
+          same frame (needs a rollups file).
+        - keys: Idempotency keys of the payments.
+
+        Once the log holds ``COMPACT_THRESHOLD`` records, a compaction is
+        started on a background thread, so the caller doesn't wait for it.
+
+        Returns:
+        - None
+        """
+        if not records and not rollups and not keys:
+            return
+        self._import_legacy()
+        with exclusive(self.base):
+            f, count = self._open_log()
+            start = time.perf_counter()
+            if rollups or keys:
+                entry = {"records": list(records), "rollups": list(rollups)}
+                if keys:
+                    entry["keys"] = list(keys)
+                frame = _frame(entry)
+            else:
+                frame = _frame(list(records))
+            with f:
+                f.write(frame)
+                f.flush()
+                os.fsync(f.fileno())
+            metrics.record_write(STORE, len(frame), start)
+        if count + len(records) >= COMPACT_THRESHOLD:
+            self._compact_later()
+
+    def _compact_later(self):
+        """Start a background compaction unless one is already running."""
+        if not self._compacting.acquire(blocking=False):
+            return
+        threading.Thread(target=self._compact_due, name="hcms-ledger-compact").start()
+
+    def _compact_due(self):
+        """
+        Compact if the log is still over the threshold; another process may
+        have compacted it meanwhile.
+        """
+        try:
+            with exclusive(self.base):
+                f, count = self._open_log()
+                f.close()
+                if count >= COMPACT_THRESHOLD:
+                    self.compact()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._compacting.release()
+
+    def compact(self):
+        """
+        Fold the log into the snapshot and start a new log generation.
+
+        The snapshot records the generation it absorbed, so a crash between
+        installing the snapshot and resetting the log never double counts.
+
+        Returns:
+        - None
+        """
+        self._import_legacy()
+        with exclusive(self.base):
+            f, _ = self._open_log()
+            with f:
+                f.seek(0)
+                generation = _read_header(f, LOG_MAGIC)
+                self._fold_rollups(f, generation)
+            self._write_snapshot(
+                _batched(self._merged(), SNAP_CHUNK),
+                generation,
+                self._all_keys()[-KEYS_KEPT:],
+            )
+            self._reset_log(generation + 1)
+
+    def _merged(self):
+        """Yield the snapshot and log records together in ``sort_key`` order."""
+        snap, log = self._open_pair()
+        try:
+            absorbed = _read_header(snap, SNAP_MAGIC) if snap is not None else None
+            snap_records = ()
+            if snap is not None:
+                presorted = _directory_offset(snap) is not None
+                snap.seek(HEADER.size)
+                snap_records = (
+                    record
+                    for _, records in _snapshot_frames(snap)
+                    for record in records
+                )
+                if not presorted:
+                    # Written before snapshots were sorted.
+                    snap_records = sorted(snap_records, key=sort_key)
+            log_records = sorted(self._log_records(log, absorbed), key=sort_key)
+            yield from heapq.merge(snap_records, log_records, key=sort_key)
+        finally:
+            for f in (snap, log):
+                if f is not None:
+                    f.close()
+
+    @staticmethod
+    def _log_records(log, absorbed):
+        """Return the records of a log not yet absorbed into the snapshot."""
+        if log is None:
+            return []
+        log.seek(0)
+        generation = _read_header(log, LOG_MAGIC)
+        if generation is None or (absorbed is not None and generation <= absorbed):
+            return []
+        return [
+            record
+            for _, payload in _iter_frames(log)
+            for record in _entry(payload)[0]
+        ]
+
+    # ------------------------------------------------------------------- keys
+
+    def _snapshot_keys(self, snap):
+        """Return ``(keys, key set)`` of the keys frame of an open snapshot."""
+        st = os.fstat(snap.fileno())
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._keys_index
+        if cached is None or cached[0] != stamp:
+            keys = _read_keys(snap)
+            cached = self._keys_index = (stamp, keys, set(keys))
+        return cached[1:]
+
+    def _key_lists(self):
+        """Return ``(keys, key set)`` of the snapshot and of the log."""
+        snap, log = self._open_pair()
+        try:
+            found, absorbed = [], None
+            if snap is not None:
+                absorbed = _read_header(snap, SNAP_MAGIC)
+                found.append(self._snapshot_keys(snap))
+            if log is not None:
+                generation = _read_header(log, LOG_MAGIC)
+                if generation is not None and (
+                    absorbed is None or generation > absorbed
+                ):
+                    found.append(self._scan_log(log, generation)[2:])
+            return found
+        finally:
+            for f in (snap, log):
+                if f is not None:
+                    f.close()
+
+    def _all_keys(self):
+        """Return the idempotency keys of the snapshot and log, oldest first."""
+        return [key for keys, _ in self._key_lists() for key in keys]
+
+    def paid_keys(self, keys):
+        """
+        Return the idempotency keys among ``keys`` recorded with a payment.
+
+        Args:
+        - keys: Keys to look up.
+
+        Returns:
+        - set: The keys found.
+        """
+        key_sets = [key_set for _, key_set in self._key_lists()]
+        return {key for key in keys if any(key in found for found in key_sets)}
+
+    # ---------------------------------------------------------------- rollups
+
+    def _read_rollups(self):
+        """
+        Read the rollups file.
+
+        Returns:
+        - tuple: (table, ``(log generation, offset)`` folded in up to or
+          None, file stat or None)
+        """
+        try:
+            with open(self.rollups_file, "rb") as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except FileNotFoundError:
+            return {}, None, None
+        metrics.record_read(ROLLUPS, len(data))
+        start = time.perf_counter()
+        try:
+            data = pickle.loads(data)
+        finally:
+            metrics.record_deserialize(ROLLUPS, start)
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if isinstance(data, dict) and "table" in data:
+            return data["table"], data["folded"], stamp
+        # Written before the increments went to the log: the log holds none.
+        return data, None, stamp
+
+    def _write_rollups(self, table, folded):
+        start = time.perf_counter()
+        data = pickle.dumps({"table": table, "folded": folded}, pickle.HIGHEST_PROTOCOL)
+        with atomic_writer(self.rollups_file) as out:
+            out.write(data)
+        metrics.record_write(ROLLUPS, len(data), start)
+
+    @staticmethod
+    def _unfolded(generation, folded):
+        """
+        Return the offset of the first frame of the log of ``generation``
+        whose increments are not in the rollups file yet, or None if none
+        can be.
+        """
+        if generation is None or folded is None or folded[0] < generation:
+            return HEADER.size
+        if folded[0] == generation:
+            return folded[1]
+        return None
+
+    def _fold_rollups(self, log, generation):
+        """
+        Fold the increments of the log into the rollups file. The caller
+        holds the exclusive lock.
+
+        The file records the log offset folded up to, so if the compaction
+        stops before the log is absorbed, the frames appended to that log
+        afterwards are still added.
+        """
+        if self.rollups_file is None:
+            return
+        table, folded, _ = self._read_rollups()
+        offset = self._unfolded(generation, folded)
+        if offset is None:
+            return
+        log.seek(offset)
+        rows = []
+        for offset, payload in _iter_frames(log):
+            rows.extend(_entry(payload)[1])
+        if rows:
+            add_rollups(table, rows)
+            self._write_rollups(table, (generation, offset))
+
+    def load_rollups(self):
+        """
+        Return the rollups with the increments not yet folded in added.
+        Only the frames appended since the last call are read.
+
+        Returns:
+        - dict: ``{(kind, key): (total, count)}``; don't change it.
+        """
+        self._import_legacy()
+        with shared(self.base):
+            table, folded, stamp = self._read_rollups()
+            try:
+                log = open(self.log_file, "rb")
+            except FileNotFoundError:
+                return table
+        with log:
+            generation = _read_header(log, LOG_MAGIC)
+            offset = self._unfolded(generation, folded)
+            if generation is None or offset is None:
+                return table
+            key = (stamp, os.fstat(log.fileno()).st_ino, generation)
+            cached = self._rollups_index
+            if cached is not None and cached[0] == key:
+                offset, table = cached[1], cached[2]
+            log.seek(offset)
+            rows = []
+            for offset, payload in _iter_frames(log):
+                rows.extend(_entry(payload)[1])
+            if rows:
+                table = dict(table)
+                add_rollups(table, rows)
+            self._rollups_index = (key, offset, table)
+            return table
+
+    def replace_rollups(self, table):
+        """
+        Replace the rollups, e.g. after recomputing them from the ledger.
+        The increments already in the log count as included.
+
+        Args:
+        - table (dict): ``{(kind, key): (total, count)}``.
+
+        Returns:
+        - None
+        """
+        self._import_legacy()
+        with exclusive(self.base):
+            f, _ = self._open_log()
+            with f:
+                end = f.tell()
+                f.seek(0)
+                generation = _read_header(f, LOG_MAGIC)
+            self._write_rollups(dict(table), (generation, end))
+
+    # ----------------------------------------------------------- sorted reads
+
+    def _snapshot_index(self, snap):
+        """Return ``(directory, first keys, last keys)`` of an open snapshot."""
+        st = os.fstat(snap.fileno())
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._snap_index
+        if cached is None or cached[0] != stamp:
+            directory = _read_directory(snap)
+            if directory is None:
+                return None
+            cached = self._snap_index = (
+                stamp,
+                directory,
+                [entry[0] for entry in directory],
+                [entry[1] for entry in directory],
+            )
+        return cached[1:]
+
+    def _sorted_log(self, log, absorbed):
+        """Return ``(keys, records)`` of the log sorted by ``sort_key``."""
+        if log is None:
+            return [], []
+        st = os.fstat(log.fileno())
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns, absorbed)
+        cached = self._log_index
+        if cached is None or cached[0] != stamp:
+            records = sorted(self._log_records(log, absorbed), key=sort_key)
+            cached = self._log_index = (
+                stamp,
+                [sort_key(record) for record in records],
+                records,
+            )
+        return cached[1:]
+
+    @staticmethod
+    def _snapshot_range(snap, index, low, high, descending):
+        directory, firsts, lasts = index
+        if not descending:
+            start = 0 if low is None else bisect.bisect_left(lasts, low)
+            for first, _, offset in directory[start:]:
+                if high is not None and first > high:
+                    return
+                for record in _read_frame(snap, offset):
+                    key = sort_key(record)
+                    if low is not None and key < low:
+                        continue
+                    if high is not None and key > high:
+                        return
+                    yield record
+        else:
+            stop = len(directory) if high is None else bisect.bisect_right(firsts, high)
+            for _, last, offset in reversed(directory[:stop]):
+                if low is not None and last < low:
+                    return
+                for record in reversed(_read_frame(snap, offset)):
+                    key = sort_key(record)
+                    if high is not None and key > high:
+                        continue
+                    if low is not None and key < low:
+                        return
+                    yield record
+
+    def iter_sorted(self, low=None, high=None, descending=False):
+        """
+        Yield the records whose ``sort_key`` lies within ``[low, high]``, in
+        ``sort_key`` order (or reversed).
+
+        Only the snapshot frames overlapping the range are read. A snapshot
+        written before snapshots were sorted is compacted first.
+
+        Args:
+        - low, high (tuple): Inclusive key bounds; ``(date,)`` bounds every
+          payment from that date on, ``None`` leaves the side open.
+        - descending (bool): Newest first.
+        """
+        self._import_legacy()
+        snap, log = self._open_pair()
+        try:
+            index = None
+            if snap is not None:
+                index = self._snapshot_index(snap)
+                if index is None:
+                    for f in (snap, log):
+                        if f is not None:
+                            f.close()
+                    self.compact()
+                    snap, log = self._open_pair()
+                    index = self._snapshot_index(snap)
+            if snap is not None:
+                snap.seek(0)
+                absorbed = _read_header(snap, SNAP_MAGIC)
+            else:
+                absorbed = None
+            keys, records = self._sorted_log(log, absorbed)
+            begin = 0 if low is None else bisect.bisect_left(keys, low)
+            end = len(keys) if high is None else bisect.bisect_right(keys, high)
+            log_range = records[begin:end]
+            if descending:
+                log_range.reverse()
+            snap_range = (
+                self._snapshot_range(snap, index, low, high, descending)
+                if snap is not None
+                else ()
+            )
+            yield from heapq.merge(
+                snap_range, log_range, key=sort_key, reverse=descending
+            )
+        finally:
+            for f in (snap, log):
+                if f is not None:
+                    f.close()
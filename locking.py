@@ -0,0 +1,156 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Cross-process file locking and atomic file replacement.
+
+Every data file gets a sidecar ``<file>.lock``. Readers take a shared lock,
+writers an exclusive one, so several worker processes (and threads) can use
+the same files without losing each other's read-modify-write cycles. Files
+are rewritten through a temporary file and ``os.replace``, so a reader never
+sees a half-written file.
+
+Locks are re-entrant per thread: a thread holding a lock may take it again,
+and a thread holding the exclusive lock may also take the shared one.
+Upgrading a shared lock to an exclusive one is refused, because two threads
+doing it at once would deadlock.
+
+On platforms without ``fcntl`` the locks only serialise threads of the
+current process.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+
+_held = threading.local()
+_fallback_locks = {}
+_fallback_guard = threading.Lock()
+
+
+def _holdings():
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    return _held.locks
+
+
+@contextmanager
+def locked(path, mode=EXCLUSIVE):
+    """
+    Hold the lock of ``path`` for the duration of the block.
+
+    Args:
+    - path (str): Data file to lock (the lock lives in ``path + ".lock"``).
+    - mode (str): ``SHARED`` for readers, ``EXCLUSIVE`` for writers.
+
+    Raises:
+    - RuntimeError: Raised when asking for an exclusive lock while this
+      thread holds only a shared one.
+    """
+    lock_path = os.path.abspath(path) + ".lock"
+    holdings = _holdings()
+    held = holdings.get(lock_path)
+    if held is not None:
+        if mode == EXCLUSIVE and held[1] != EXCLUSIVE:
+            raise RuntimeError("Cannot upgrade a shared lock on %s" % path)
+        held[2] += 1
+        try:
+            yield
+        finally:
+            held[2] -= 1
+        return
+
+    start = time.perf_counter()
+    if fcntl is None:
+        with _fallback_guard:
+            handle = _fallback_locks.setdefault(lock_path, threading.Lock())
+        handle.acquire()
+    else:
+        handle = open(lock_path, "a+b")
+        try:
+            fcntl.flock(
+                handle.fileno(), fcntl.LOCK_EX if mode == EXCLUSIVE else fcntl.LOCK_SH
+            )
+        except BaseException:
+            handle.close()
+            raise
+    metrics.record_lock_wait(path, time.perf_counter() - start)
+    holdings[lock_path] = [handle, mode, 1]
+    try:
+        yield
+    finally:
+        del holdings[lock_path]
+        if fcntl is None:
+            handle.release()
+        else:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            handle.close()
+
+
+def shared(path):
+    """Shared (reader) lock of ``path``."""
+    return locked(path, SHARED)
+
+
+def exclusive(path):
+    """Exclusive (writer) lock of ``path``."""
+    return locked(path, EXCLUSIVE)
+
+
+def fsync_dir(path):
+    """Flush the directory entry of ``path`` where the platform allows it."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_writer(path):
+    """
+    Yield a binary file whose contents replace ``path`` when the block ends.
+
+    The data is written to a temporary file in the same directory, flushed
+    to disk and then renamed over ``path``. If the block raises, ``path`` is
+    left untouched.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(
+        prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_dir(path)
@@ -0,0 +1,359 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Process-wide metrics of the app, in Prometheus text format.
+
+Recorded:
+
+    hcms_requests_total              requests per route, method and status
+    hcms_request_seconds             latency histogram per route and method
+    hcms_render_seconds              template rendering time per template
+    hcms_db_operation_seconds        time per DB class method (OCCUPANT_DB...)
+    hcms_store_read_bytes_total      bytes read per store
+    hcms_store_written_bytes_total   bytes written per store
+    hcms_deserialize_seconds         unpickling time per store
+    hcms_store_write_seconds         serialize + write + fsync time per store
+    hcms_lock_wait_seconds           time waiting for a file lock per file
+
+Counters are plain dict entries updated under one lock, so recording costs
+a few hundred nanoseconds. Each worker process has its own registry; scrape
+every worker (or sum them) to see the whole app.
+
+The timings of the current request are also summed per thread and written
+as one JSON line per request to the ``hcms.timing`` logger. Set
+``HCMS_TIMING_LOG`` to a file (or "-" for stderr) to have it written there.
+``HCMS_METRICS=0`` turns all recording off.
+
+The app serves the registry at ``/metrics`` to administrators only; set
+``HCMS_METRICS_TOKEN`` to let a scraper in with that bearer token.
+
+Usage:
+    metrics.record_read("occupants", len(data))
+    start = time.perf_counter(); ...; metrics.record_deserialize("occupants", start)
+    print(metrics.registry.render())
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from bisect import bisect_left
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+ENABLED = os.environ.get("HCMS_METRICS", "1") != "0"
+TIMING_LOG = os.environ.get("HCMS_TIMING_LOG")
+TOKEN = os.environ.get("HCMS_METRICS_TOKEN")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (seconds) of the histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+HELP = {
+    "hcms_requests_total": ("counter", "Requests handled, by route and status."),
+    "hcms_request_seconds": ("histogram", "Request latency by route."),
+    "hcms_render_seconds": ("histogram", "Template rendering time."),
+    "hcms_db_operation_seconds": ("histogram", "Time per DB class method."),
+    "hcms_store_read_bytes_total": ("counter", "Bytes read from a store."),
+    "hcms_store_written_bytes_total": ("counter", "Bytes written to a store."),
+    "hcms_deserialize_seconds": ("histogram", "Deserialization time per store."),
+    "hcms_store_write_seconds": ("histogram", "Serialize, write and fsync time."),
+    "hcms_lock_wait_seconds": ("histogram", "Time waiting for a file lock."),
+}
+
+timing_log = logging.getLogger("hcms.timing")
+if TIMING_LOG:
+    _handler = (
+        logging.StreamHandler(sys.stderr)
+        if TIMING_LOG == "-"
+        else logging.FileHandler(TIMING_LOG)
+    )
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    timing_log.addHandler(_handler)
+    timing_log.setLevel(logging.INFO)
+    timing_log.propagate = False
+
+
+class Histogram:
+    """Cumulative-bucket histogram of durations in seconds."""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+
+
+class Registry:
+    """Counters and histograms keyed by metric name and label values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, value=1):
+        """
+        Add to a counter.
+
+        Args:
+        - name (str): Metric name.
+        - labels (tuple): ``(label, value)`` pairs.
+        - value: Amount added.
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        """Add a duration to a histogram."""
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        Returns:
+        - str: Every metric in Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count))
+                for key, h in self._histograms.items()
+            )
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, text = HELP.get(name, ("untyped", name))
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append("%s{%s} %s" % (name, _labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(
+                    "%s_bucket{%s} %d"
+                    % (name, _labels(labels + (("le", bound),)), cumulative)
+                )
+            lines.append("%s_sum{%s} %.6f" % (name, _labels(labels), total))
+            lines.append("%s_count{%s} %d" % (name, _labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ------------------------------------------------------------------ requests
+
+_local = threading.local()
+
+
+def _request():
+    return getattr(_local, "request", None)
+
+
+def begin_request():
+    """Start summing the timings of a request handled by this thread."""
+    if ENABLED:
+        _local.request = {
+            "start": time.perf_counter(),
+            "render_ms": 0.0,
+            "deserialize_ms": 0.0,
+            "write_ms": 0.0,
+            "lock_wait_ms": 0.0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+        }
+
+
+def end_request(route, method, status):
+    """
+    Record a finished request and log its timings.
+
+    Args:
+    - route (str): URL rule of the request (not its path, to bound the
+      number of label values).
+    - method (str): HTTP method.
+    - status (int): Status code of the response.
+
+    Returns:
+    - dict: The request's timings, or None if none were being summed.
+    """
+    entry = _request()
+    if entry is None:
+        return None
+    _local.request = None
+    seconds = time.perf_counter() - entry.pop("start")
+    registry.observe(
+        "hcms_request_seconds", (("route", route), ("method", method)), seconds
+    )
+    registry.inc(
+        "hcms_requests_total",
+        (("route", route), ("method", method), ("status", str(status))),
+    )
+    entry = {
+        "route": route,
+        "method": method,
+        "status": status,
+        "ms": round(seconds * 1000, 3),
+        **{
+            name: round(value, 3) if isinstance(value, float) else value
+            for name, value in entry.items()
+            if name != "render_start"
+        },
+    }
+    if timing_log.isEnabledFor(logging.INFO):
+        timing_log.info(json.dumps(entry, separators=(",", ":")))
+    return entry
+
+
+def render_started():
+    entry = _request()
+    if entry is not None:
+        entry["render_start"] = time.perf_counter()
+
+
+def render_finished(template):
+    entry = _request()
+    if entry is None or "render_start" not in entry:
+        return
+    seconds = time.perf_counter() - entry.pop("render_start")
+    entry["render_ms"] += seconds * 1000
+    registry.observe("hcms_render_seconds", (("template", template),), seconds)
+
+
+# -------------------------------------------------------------------- stores
+
+
+def record_read(store, nbytes):
+    """Count bytes read from a store."""
+    if not ENABLED:
+        return
+    registry.inc("hcms_store_read_bytes_total", (("store", store),), nbytes)
+    entry = _request()
+    if entry is not None:
+        entry["bytes_read"] += nbytes
+
+
+def record_write(store, nbytes, start):
+    """
+    Count bytes written to a store.
+
+    Args:
+    - store (str): Name of the store.
+    - nbytes (int): Bytes written.
+    - start (float): ``time.perf_counter()`` before serializing.
+    """
+    if not ENABLED:
+        return
+    seconds = time.perf_counter() - start
+    registry.inc("hcms_store_written_bytes_total", (("store", store),), nbytes)
+    registry.observe("hcms_store_write_seconds", (("store", store),), seconds)
+    entry = _request()
+    if entry is not None:
+        entry["bytes_written"] += nbytes
+        entry["write_ms"] += seconds * 1000
+
+
+def record_deserialize(store, start):
+    """Record the time since ``start`` (``time.perf_counter()``) as unpickling."""
+    if not ENABLED:
+        return
+    seconds = time.perf_counter() - start
+    registry.observe("hcms_deserialize_seconds", (("store", store),), seconds)
+    entry = _request()
+    if entry is not None:
+        entry["deserialize_ms"] += seconds * 1000
+
+
+def record_lock_wait(path, seconds):
+    """Record the time spent waiting for the lock of a data file."""
+    if not ENABLED:
+        return
+    registry.observe(
+        "hcms_lock_wait_seconds", (("file", os.path.basename(path)),), seconds
+    )
+    entry = _request()
+    if entry is not None:
+        entry["lock_wait_ms"] += seconds * 1000
+
+
+# ---------------------------------------------------------------- DB classes
+
+
+def timed(operation):
+    """Decorator recording the duration of a function as a DB operation."""
+    labels = (("operation", operation),)
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(
+                    "hcms_db_operation_seconds", labels, time.perf_counter() - start
+                )
+
+        return wrapper
+
+    return decorate
+
+
+def timed_methods(cls):
+    """
+    Class decorator applying ``timed`` to every public method of a class,
+    named "<class>.<method>".
+    """
+    for name, member in list(vars(cls).items()):
+        if name.startswith("_"):
+            continue
+        if isinstance(member, staticmethod):
+            wrapped = staticmethod(
+                timed("%s.%s" % (cls.__name__, name))(member.__func__)
+            )
+        elif callable(member):
+            wrapped = timed("%s.%s" % (cls.__name__, name))(member)
+        else:
+            continue
+        setattr(cls, name, wrapped)
+    return cls
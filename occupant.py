@@ -20,7 +20,9 @@ DISCLAIMER:
 # ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
 
 from abc import ABC, abstractmethod
+import base64
 from datetime import datetime
+import json
 
 
 from validation import (
@@ -31,7 +33,12 @@ from validation import (
     Validations,
 )
 
-import pickle
+from storage import get_backend, OCCUPANTS, PAYMENT_SORTS
+from auth import authenticate, hash_password
+from rollups import rollup_rows
+from unit_of_work import UnitOfWork
+from events import bus, publish_after_commit, PAYMENT
+import metrics
 
 from ps import (
     PaymentStrategy,
@@ -122,63 +129,149 @@ class PaymentObserver(Observer):
         )
 
 
+def update_payment_observers(event):
+    """Update the observers of an occupant that made a payment.
+
+    Args:
+        event: Payment event published by ``OCCUPANT.notify_observers``.
+    """
+    for observer in event["observers"]:
+        observer.update()
+
+
+bus.subscribe(PAYMENT, update_payment_observers)
+
+
 # Payment Database
+@metrics.timed_methods
 class PaymentDB:
-    """Class to handle Payment Database operations."""
+    """Class to handle Payment Database operations.
 
-    __file = "payment_db.pickle"
+    Payments are kept by the storage backend (see ``storage.py``); with the
+    default pickle engine that is the append-only ledger in ``ledger.py``.
+    Running totals per occupant, month and block are kept next to them (see
+    ``rollups.py``).
+    """
 
     @staticmethod
-    def add_payment(email, payment_amount):
-        """Method to add payments to the database."""
-        try:
-            with open(PaymentDB.__file, "rb") as f:
-                payment_data = pickle.load(f)
-        except FileNotFoundError:
-            payment_data = {}
+    def add_payment(email, payment_amount, block=None, date=None, key=None):
+        """Method to add payments to the database.
 
+        Args:
+            email: Email of the occupant.
+            payment_amount: Amount paid.
+            block: Block of the occupant; looked up when not given.
+            date: Date of the payment ("%Y-%m-%d %H:%M:%S"); now by default.
+                Meant for importing or generating past payments.
+            key: Idempotency key recorded with the payment (see
+                ``payment_queue.py``).
+        """
         if payment_amount > 0:
-            payment_data[email] = payment_data.get(email, [])
-            payment_data[email].append(
-                {
-                    "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "amount": payment_amount,
-                }
-            )
-
-        with open(PaymentDB.__file, "wb") as f:
-            pickle.dump(payment_data, f)
+            if block is None:
+                try:
+                    block = get_backend().get(OCCUPANTS, email)._block_no
+                except KeyError:
+                    block = ""
+            if date is None:
+                date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # One unit of work, so the payment and its rollups commit together.
+            with UnitOfWork():
+                backend = get_backend()
+                backend.append_payments(
+                    [(email, payment_amount, date)], [key] if key is not None else []
+                )
+                backend.add_rollups(rollup_rows(email, block, payment_amount, date))
 
     @staticmethod
     def get_payments():
         """Method to retrieve all payments."""
-        try:
-            with open(PaymentDB.__file, "rb") as f:
-                payment_data = pickle.load(f)
-                nested_rows = []
-                for email, payments in payment_data.items():
-                    for payment in payments:
-                        nested_rows.append([email, payment["amount"], payment["date"]])
-                return nested_rows
-        except FileNotFoundError:
-            return []
+        payment_data = {}
+        for email, amount, date in get_backend().iter_payments():
+            payment_data.setdefault(email, []).append([email, amount, date])
+        nested_rows = []
+        for rows in payment_data.values():
+            nested_rows.extend(rows)
+        return nested_rows
 
     @staticmethod
     def get_payment_history(email):
         """Method to retrieve payment history by email."""
+        return [
+            {"date": date, "amount": amount}
+            for (_, amount, date) in get_backend().payment_history(email)
+        ]
+
+    @staticmethod
+    def get_payments_page(
+        sort="date",
+        descending=False,
+        start=None,
+        end=None,
+        email=None,
+        cursor=None,
+        limit=50,
+    ):
+        """Method to retrieve one page of payments.
+
+        Args:
+            sort: "date", "amount" or "email".
+            descending: Largest first (newest first for "date").
+            start: Earliest date to include ("%Y-%m-%d %H:%M:%S").
+            end: Latest date to include ("%Y-%m-%d %H:%M:%S").
+            email: Only include the payments of this occupant.
+            cursor: Token returned with the previous page.
+            limit: Number of payments per page.
+
+        Returns:
+            tuple: Rows as ``[email, amount, date]`` and the cursor of the
+            next page (None on the last page).
+
+        Raises:
+            ValueError: If the sort order or the cursor is not valid.
+        """
+        if sort not in PAYMENT_SORTS:
+            raise ValueError("Unknown sort order: %s" % sort)
+        rows, after = get_backend().payments_page(
+            sort=sort,
+            descending=descending,
+            start=start,
+            end=end,
+            email=email,
+            after=PaymentDB._decode_cursor(cursor),
+            limit=limit,
+        )
+        return [list(row) for row in rows], PaymentDB._encode_cursor(after)
+
+    @staticmethod
+    def _encode_cursor(after):
+        if after is None:
+            return None
+        key, skip = after
+        raw = json.dumps([list(key), skip], separators=(",", ":"))
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        if not cursor:
+            return None
         try:
-            with open(PaymentDB.__file, "rb") as f:
-                payment_data = pickle.load(f)
-            return payment_data.get(email, [])
-        except FileNotFoundError:
-            return []
+            key, skip = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            key, skip = tuple(key), int(skip)
+        except (ValueError, TypeError, UnicodeError):
+            raise ValueError("Invalid cursor")
+        if len(key) != 3 or skip < 0:
+            raise ValueError("Invalid cursor")
+        return key, skip
+
+    @staticmethod
+    def compact():
+        """Method to fold the payment log into its snapshot."""
+        get_backend().compact_payments()
 
 
 # Class to handle occupant database operations
+@metrics.timed_methods
 class OCCUPANT_DB:
-    # File path for occupant database
-    _file = "occupant_db.pickle"
-
     # Method to store occupant data in the database
     @staticmethod
     def store_occupant(data):
@@ -187,25 +280,7 @@ class OCCUPANT_DB:
         Args:
             data: Occupant data to be stored.
         """
-        try:
-            # Load existing database
-            f = open(OCCUPANT_DB._file, "rb")
-            load = pickle.load(f)
-            load[data._email_id] = data
-            f.close()
-
-            # Update database with new data
-            f1 = open(OCCUPANT_DB._file, "wb")
-            pickle.dump(load, f1)
-            f1.close()
-
-        except FileNotFoundError:
-            # Create a new database if it doesn't exist
-            dic = {}
-            f2 = open(OCCUPANT_DB._file, "wb")
-            dic[data._email_id] = data
-            pickle.dump(dic, f2)
-            f2.close()
+        get_backend().put(OCCUPANTS, data._email_id, data)
 
     # Method to display occupant information by email
     @staticmethod
@@ -218,10 +293,7 @@ class OCCUPANT_DB:
         Returns:
             Information of the occupant corresponding to the email.
         """
-        f = open(OCCUPANT_DB._file, "rb")
-        DB = pickle.load(f)
-        f.close()
-        return DB[email].dispaly_info()
+        return OCCUPANT_DB.get_occupant(email).dispaly_info()
 
     # Method to get occupant by email
     @staticmethod
@@ -234,23 +306,31 @@ class OCCUPANT_DB:
         Returns:
             Occupant corresponding to the email.
         """
-        f = open(OCCUPANT_DB._file, "rb")
-        DB = pickle.load(f)
-        f.close()
-        return DB[email]
+        return get_backend().get(OCCUPANTS, email)
+
+    # Method to get many occupants by email
+    @staticmethod
+    def get_occupants(emails):
+        """Gets many occupants by email with a single lookup.
+
+        Args:
+            emails: Emails of the occupants.
+
+        Returns:
+            dict: Occupants found, keyed by email.
+        """
+        return get_backend().get_many(OCCUPANTS, emails)
 
     # Method to display information of all occupants in the database
     @staticmethod
     def show_all_occupant():
         """Displays information of all occupants in the database."""
-        f1 = open(OCCUPANT_DB._file, "rb")
-        load = pickle.load(f1)
+        load = get_backend().load_all(OCCUPANTS)
         count = 0
         for i, j in load.items():
             print(("*") * 40)
             j.dispaly_info()
             count += 1
-        f1.close()
 
     # Method to remove occupant by email
     @staticmethod
@@ -263,14 +343,7 @@ class OCCUPANT_DB:
         Returns:
             Removed occupant.
         """
-        f4 = open(OCCUPANT_DB._file, "rb")
-        load = pickle.load(f4)
-        remove = load.pop(email, None)
-        # Update
-        f5 = open(OCCUPANT_DB._file, "wb")
-        pickle.dump(load, f5)
-        f5.close()
-        return remove
+        return get_backend().delete(OCCUPANTS, email)
 
     @staticmethod
     def validate_credential(email, pwd):
@@ -281,11 +354,9 @@ class OCCUPANT_DB:
             pwd: Password to be validated.
 
         Returns:
-            True if credentials are valid, otherwise False.
+            The occupant if the credentials are valid, otherwise None.
         """
-        occupant = OCCUPANT_DB.get_occupant(email)
-        if occupant._password == pwd:
-            return True
+        return authenticate(OCCUPANTS, email, pwd)
 
 
 # Class representing an occupant
@@ -301,6 +372,7 @@ class OCCUPANT:
         BLOCK_NO,
         FLAT_NO,
         payment_strategy,
+        hashed=False,
     ):
         """Initialize an occupant object with attributes and payment strategy.
 
@@ -313,6 +385,8 @@ class OCCUPANT:
             BLOCK_NO (str): Block number of the occupant's flat.
             FLAT_NO (int): Flat number of the occupant.
             payment_strategy (PaymentState): Payment strategy for the occupant.
+            hashed (bool): PASSWORD was already hashed by
+                ``auth.hash_password`` (and checked by the caller).
         """
         # Validate occupant attributes
         Validation.Occupant_Validation(NAME, PHONE_NO, AADHAR_NO, EMAIL_ID, PASSWORD)
@@ -321,7 +395,7 @@ class OCCUPANT:
         self._phone_no = PHONE_NO
         self._aadhar_no = AADHAR_NO
         self._email_id = EMAIL_ID
-        self._password = PASSWORD
+        self._password = PASSWORD if hashed else hash_password(PASSWORD)
         self._flat_no = FLAT_NO
         self._block_no = BLOCK_NO
 
@@ -343,13 +417,18 @@ class OCCUPANT:
         """
         return self.pending_payments
 
-    def pay_bill(self):
-        """Process payment of the occupant's bill."""
+    def pay_bill(self, key=None):
+        """Process payment of the occupant's bill.
+
+        Args:
+            key: Idempotency key recorded with the payment.
+        """
         amount = self.get_amount()
         self.payment_state.pay_bill(self)
-        PaymentDB.add_payment(self._email_id, amount)
+        PaymentDB.add_payment(self._email_id, amount, self._block_no, key=key)
         self.pending_payments = 0
-        self.notify_observers()
+        self.last_payment_date = datetime.now()
+        self.notify_observers(amount)
         OCCUPANT_DB.store_occupant(self)
         return True
 
@@ -361,10 +440,25 @@ class OCCUPANT:
         """
         self.payment_state = state
 
-    def notify_observers(self):
-        """Notify all observers."""
-        for observer in self.observers:
-            observer.update()
+    def notify_observers(self, amount=None):
+        """Notify all observers.
+
+        A payment event is published on the event bus (see ``events.py``)
+        and the observers are updated by its delivery thread, not on the
+        payment path.
+
+        Args:
+            amount: Amount just paid, if any.
+        """
+        publish_after_commit(
+            PAYMENT,
+            {
+                "email": self._email_id,
+                "amount": amount,
+                "pending_payments": self.pending_payments,
+                "observers": tuple(self.observers),
+            },
+        )
 
     def check_state_transition(self):
         """Check the state transition for the occupant."""
@@ -0,0 +1,400 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Durable write-behind queue for bill payments.
+
+``submit`` appends a payment intent to a journal file, fsyncs it and
+returns, so a request doesn't wait for the ledger and the occupant store to
+be rewritten. A background writer thread drains the journal: it collects
+the intents waiting (up to ``BATCH_SIZE``, after at most
+``GROUP_COMMIT_DELAY`` seconds) and pays them all in one unit of work, so a
+burst of payments costs one ledger append and one occupant store write.
+Intents left in the journal by a crash are paid when the queue starts
+again.
+
+Every intent has an idempotency key. Submitting a key already in the
+journal returns the earlier intent instead of adding one, so a
+double-click or a retried request pays once; only a key whose payment
+failed can be submitted again. The key is also recorded in
+the payment ledger with the payment, and the ledger is written before the
+occupant, so an intent replayed after a crash is paid unless the ledger
+already has its key. As a second guard, an intent is skipped if the
+occupant's last payment is more recent than the intent.
+
+The journal is a file of JSON lines (intents, then "done" records naming
+the keys paid), shared by every worker process through its lock (see
+``locking.py``). Only one process drains it at a time. Once nothing is
+waiting it is rewritten keeping the keys of the last ``KEY_RETENTION``
+seconds.
+
+Usage:
+    queue = get_queue()
+    queue.submit(key, email, amount)
+    queue.flush()   # wait until everything submitted so far is paid
+    queue.drain()   # flush and stop the writer (at shutdown)
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import atexit
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+import traceback
+
+from locking import atomic_writer, exclusive
+from occupant import OCCUPANT_DB
+from unit_of_work import UnitOfWork
+
+JOURNAL_FILE = os.environ.get("HCMS_PAYMENT_JOURNAL", "payment_queue.journal")
+BATCH_SIZE = 500
+# Seconds the writer waits for more intents before committing a batch.
+GROUP_COMMIT_DELAY = 0.005
+# Seconds the writer waits before retrying a batch that failed to commit.
+RETRY_DELAY = 1.0
+# Seconds for which paid keys are remembered once the journal is rewritten.
+KEY_RETENTION = 24 * 60 * 60
+# Journal size (bytes) above which it is rewritten when nothing is waiting.
+COMPACT_SIZE = 1 << 20
+# Seconds the queue is given to flush at interpreter exit; whatever is left
+# stays in the journal and is paid on the next start.
+SHUTDOWN_TIMEOUT = 10.0
+
+PENDING, PAID, SKIPPED, FAILED = "pending", "paid", "skipped", "failed"
+
+
+class PaymentQueue:
+    """
+    Journal of payment intents and the thread paying them.
+
+    Args:
+    - path (str): Journal file.
+    - batch_size (int): Most intents paid per unit of work.
+    - delay (float): Group commit delay in seconds.
+    """
+
+    def __init__(
+        self, path=JOURNAL_FILE, batch_size=BATCH_SIZE, delay=GROUP_COMMIT_DELAY
+    ):
+        self.path = path
+        self.drain_lock = path + ".drain"
+        self.batch_size = batch_size
+        self.delay = delay
+        # Journal contents read so far: status of every key and the intents
+        # still waiting, in submission order.
+        self._status = {}
+        self._done_at = {}
+        self._pending = OrderedDict()
+        self._offset = 0
+        self._inode = None
+        self._state_lock = threading.RLock()
+
+        self._wake = threading.Condition()
+        self._submitted = 0
+        self._completed = 0
+        self._stopping = False
+        self._thread = None
+
+    # --------------------------------------------------------------- journal
+
+    def _refresh(self):
+        """
+        Read the journal lines written since the last call (by any process).
+        The caller holds the journal lock.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self._reset_state(None)
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._inode:
+                # New or rewritten journal: read it from the start.
+                self._reset_state(inode)
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn tail of a crashed write; ``_append`` cuts it off.
+                    break
+                self._offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._read_entry(entry)
+
+    def _reset_state(self, inode):
+        self._status.clear()
+        self._done_at.clear()
+        self._pending.clear()
+        self._offset = 0
+        self._inode = inode
+
+    def _read_entry(self, entry):
+        if entry.get("op") == "intent":
+            key = entry["key"]
+            if self._status.get(key) in (None, FAILED):
+                self._status[key] = PENDING
+                self._pending[key] = entry
+        elif entry.get("op") == "done":
+            for key, status in entry["keys"].items():
+                self._status[key] = status
+                self._done_at[key] = entry["at"]
+                self._pending.pop(key, None)
+
+    def _append(self, entries):
+        """Append journal entries and fsync them. The caller holds the lock."""
+        with open(self.path, "ab") as f:
+            if f.tell() != self._offset:
+                f.truncate(self._offset)
+            data = b"".join(
+                json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n"
+                for entry in entries
+            )
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            if self._inode is None:
+                self._inode = os.fstat(f.fileno()).st_ino
+        self._offset += len(data)
+        for entry in entries:
+            self._read_entry(entry)
+
+    def _compact(self):
+        """
+        Rewrite the journal once nothing is waiting, keeping recent keys.
+        The caller holds the journal lock.
+        """
+        if self._pending or self._offset < COMPACT_SIZE:
+            return
+        cutoff = time.time() - KEY_RETENTION
+        kept = {}
+        for key, status in self._status.items():
+            at = self._done_at.get(key, 0)
+            if at >= cutoff:
+                kept.setdefault(at, {})[key] = status
+        with atomic_writer(self.path) as out:
+            for at, keys in sorted(kept.items()):
+                out.write(
+                    json.dumps({"op": "done", "at": at, "keys": keys}).encode("utf-8")
+                    + b"\n"
+                )
+        self._inode = None
+        self._refresh()
+
+    # ---------------------------------------------------------------- submit
+
+    def submit(self, key, email, amount=None):
+        """
+        Durably record a payment of an occupant's bill.
+
+        Args:
+        - key (str): Idempotency key of the submission.
+        - email (str): Email of the occupant paying.
+        - amount: Amount the occupant was shown (for the record; the bill
+          pending when the intent is paid is what gets paid).
+
+        Returns:
+        - str: Status of the key: ``PENDING`` for a new intent (or a key
+          whose earlier payment failed, which is queued again), or the
+          status of the earlier intent with the same key.
+        """
+        with self._state_lock, exclusive(self.path):
+            self._refresh()
+            status = self._status.get(key)
+            if status in (None, FAILED):
+                self._append(
+                    [
+                        {
+                            "op": "intent",
+                            "key": key,
+                            "email": email,
+                            "amount": amount,
+                            "at": time.time(),
+                        }
+                    ]
+                )
+                status = PENDING
+        if status == PENDING:
+            with self._wake:
+                self._submitted += 1
+                self._wake.notify_all()
+        self.start()
+        return status
+
+    def status(self, key):
+        """Status of a key, or None if the journal doesn't know it."""
+        with self._state_lock, exclusive(self.path):
+            self._refresh()
+            return self._status.get(key)
+
+    def _unchanged(self):
+        """
+        Whether the journal is still what was last read, checked without
+        its lock: it is only appended to, or replaced by a new file.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._inode is None
+        return (st.st_ino, st.st_size) == (self._inode, self._offset)
+
+    def pending(self):
+        """Number of intents waiting in the journal."""
+        with self._state_lock, exclusive(self.path):
+            self._refresh()
+            return len(self._pending)
+
+    # ---------------------------------------------------------------- writer
+
+    def _pay(self, intents):
+        """
+        Pay a batch of intents in one unit of work.
+
+        Returns:
+        - dict: Status of every key of the batch.
+        """
+        results = {}
+        with UnitOfWork() as batch:
+            # Paid before a crash kept the journal from saying so.
+            paid = batch.paid_keys(intent["key"] for intent in intents)
+            for intent in intents:
+                if intent["key"] in paid:
+                    results[intent["key"]] = PAID
+                    continue
+                try:
+                    # Each intent in a nested unit, so one failing payment
+                    # doesn't roll back the others.
+                    with UnitOfWork():
+                        occupant = OCCUPANT_DB.get_occupant(intent["email"])
+                        if occupant.last_payment_date.timestamp() >= intent["at"]:
+                            results[intent["key"]] = SKIPPED
+                            continue
+                        occupant.pay_bill(key=intent["key"])
+                except KeyError:
+                    results[intent["key"]] = FAILED
+                except Exception:
+                    traceback.print_exc()
+                    results[intent["key"]] = FAILED
+                else:
+                    results[intent["key"]] = PAID
+        return results
+
+    def run_once(self):
+        """
+        Pay one batch of the intents waiting, if this process gets to drain
+        the journal.
+
+        Returns:
+        - int: Number of intents handled.
+        """
+        with exclusive(self.drain_lock):
+            with self._state_lock, exclusive(self.path):
+                self._refresh()
+                batch = list(self._pending.values())[: self.batch_size]
+            if not batch:
+                return 0
+            results = self._pay(batch)
+            with self._state_lock, exclusive(self.path):
+                self._refresh()
+                self._append([{"op": "done", "at": time.time(), "keys": results}])
+                self._compact()
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._completed >= self._submitted and not self._stopping:
+                    # Also poll, for intents submitted by other processes,
+                    # locking the journal only once it has changed.
+                    self._wake.wait(RETRY_DELAY)
+                    if (self._pending or not self._unchanged()) and self.pending():
+                        break
+                if self._stopping and not self.pending():
+                    return
+                target = self._submitted
+            time.sleep(self.delay)
+            try:
+                while self.run_once():
+                    pass
+            except Exception:
+                traceback.print_exc()
+                time.sleep(RETRY_DELAY)
+                continue
+            with self._wake:
+                self._completed = max(self._completed, target)
+                self._wake.notify_all()
+
+    def start(self):
+        """Start the writer thread if it isn't running."""
+        with self._wake:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="hcms-payment-writer", daemon=True
+            )
+            self._thread.start()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every intent submitted so far is paid.
+
+        Args:
+        - timeout (float): Seconds to wait at most.
+
+        Returns:
+        - bool: False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._wake:
+            target = self._submitted
+            while self._completed < target:
+                if self._thread is None or not self._thread.is_alive():
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._wake.wait(remaining)
+        # Pay anything left (e.g. with no writer running) on this thread.
+        while deadline is None or time.monotonic() < deadline:
+            if not self.run_once():
+                return True
+        return False
+
+    def drain(self, timeout=None):
+        """
+        Flush the queue and stop the writer thread.
+
+        Returns:
+        - bool: False if the timeout expired first.
+        """
+        flushed = self.flush(timeout)
+        with self._wake:
+            self._stopping = True
+            self._wake.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return flushed
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    Return the process-wide payment queue, starting its writer (and paying
+    what a previous run left in the journal) on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = PaymentQueue()
+            _queue.start()
+            atexit.register(_queue.drain, SHUTDOWN_TIMEOUT)
+        return _queue
@@ -0,0 +1,257 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+On-demand profiling of single requests.
+
+A request is profiled when it carries an ``X-HCMS-Profile`` header naming
+the modes wanted and an ``X-HCMS-Profile-Token`` header matching the
+``HCMS_PROFILE_TOKEN`` environment variable, or when ``HCMS_PROFILE`` names
+modes to apply to every request. Modes (comma separated):
+
+    cpu     deterministic profile (cProfile), saved as .pstats
+            (snakeviz, gprof2dot, ``python -m pstats``)
+    sample  sampling profile of the request thread every
+            ``HCMS_PROFILE_INTERVAL`` seconds, saved as folded stacks
+            (.folded; flamegraph.pl, speedscope)
+    memory  tracemalloc: peak allocation of the request and its top
+            allocation sites, saved as .txt
+
+Files go to ``HCMS_PROFILE_DIR``/<route>/<time>-<pid>.<ext>, and the
+response gets an ``X-HCMS-Profile`` header naming them (plus
+``X-HCMS-Peak-Bytes`` in memory mode). The response body is read in full
+inside the profile, so streamed responses are included.
+
+When neither variable is set, ``install`` leaves the app untouched, so
+profiling costs nothing. tracemalloc is process-wide, so only one request
+at a time is profiled in memory mode; others run without it.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from collections import Counter
+import cProfile
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from werkzeug.exceptions import HTTPException
+
+PROFILE = os.environ.get("HCMS_PROFILE", "")
+TOKEN = os.environ.get("HCMS_PROFILE_TOKEN", "")
+PROFILE_DIR = os.environ.get("HCMS_PROFILE_DIR", "profiles")
+INTERVAL = float(os.environ.get("HCMS_PROFILE_INTERVAL", 0.001))
+
+CPU, SAMPLE, MEMORY = "cpu", "sample", "memory"
+MODES = (CPU, SAMPLE, MEMORY)
+# Allocation sites listed in a memory report.
+TOP_ALLOCATIONS = 25
+
+_memory_lock = threading.Lock()
+
+
+def parse_modes(value):
+    """
+    Args:
+    - value (str): Comma-separated modes, e.g. "cpu,memory".
+
+    Returns:
+    - set: The known modes named.
+    """
+    return {mode.strip().lower() for mode in value.split(",")} & set(MODES)
+
+
+class Sampler:
+    """
+    Thread recording the stack of another thread at a fixed interval.
+
+    Args:
+    - thread_id (int): Identifier of the thread sampled.
+    - interval (float): Seconds between samples.
+    """
+
+    def __init__(self, thread_id, interval=INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="hcms-profile-sampler", daemon=True
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "%s (%s:%d)"
+                    % (
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno,
+                    )
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        """Samples in the folded-stack format of flamegraph.pl."""
+        return "".join(
+            "%s %d\n" % (stack, count) for stack, count in self.stacks.most_common()
+        )
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware profiling the requests that ask for it.
+
+    Args:
+    - app: Flask app (for its URL map, to name the route).
+    - wsgi_app: WSGI callable wrapped.
+    - directory (str): Directory the profiles are saved in.
+    """
+
+    def __init__(self, app, wsgi_app, directory=PROFILE_DIR):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.always = parse_modes(PROFILE)
+
+    def modes(self, environ):
+        """Modes asked for by a request (empty if it may not ask)."""
+        wanted = environ.get("HTTP_X_HCMS_PROFILE")
+        if wanted and TOKEN:
+            token = environ.get("HTTP_X_HCMS_PROFILE_TOKEN", "")
+            if hmac.compare_digest(token.encode("utf-8"), TOKEN.encode("utf-8")):
+                return self.always | parse_modes(wanted)
+        return self.always
+
+    def route(self, environ):
+        """URL rule of a request, as a directory name."""
+        try:
+            rule, _ = self.app.url_map.bind_to_environ(environ).match(return_rule=True)
+            name = rule.rule
+        except HTTPException:
+            name = "unmatched"
+        return re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_") or "root"
+
+    def __call__(self, environ, start_response):
+        modes = self.modes(environ)
+        if not modes:
+            return self.wsgi_app(environ, start_response)
+        return self.profile(environ, start_response, modes)
+
+    def profile(self, environ, start_response, modes):
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return lambda data: body.append(data)
+
+        memory = MEMORY in modes and _memory_lock.acquire(blocking=False)
+        profiler = cProfile.Profile() if CPU in modes else None
+        sampler = Sampler(threading.get_ident()) if SAMPLE in modes else None
+        body = []
+        start = time.perf_counter()
+        try:
+            if memory:
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+            if sampler is not None:
+                sampler.start()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = self.wsgi_app(environ, capture)
+                try:
+                    body.extend(result)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                if sampler is not None:
+                    sampler.stop()
+            seconds = time.perf_counter() - start
+            if memory:
+                _, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+        finally:
+            if memory:
+                tracemalloc.stop()
+                _memory_lock.release()
+
+        base = self.path(environ)
+        saved = []
+        headers = list(captured[1])
+        if profiler is not None:
+            profiler.dump_stats(base + ".pstats")
+            saved.append(base + ".pstats")
+        if sampler is not None:
+            with open(base + ".folded", "w") as f:
+                f.write(sampler.folded())
+            saved.append(base + ".folded")
+        if memory:
+            with open(base + ".txt", "w") as f:
+                f.write(self.memory_report(environ, seconds, peak, snapshot))
+            saved.append(base + ".txt")
+            headers.append(("X-HCMS-Peak-Bytes", str(peak)))
+        headers.append(("X-HCMS-Profile", ", ".join(saved)))
+        start_response(captured[0], headers, captured[2])
+        return body
+
+    def path(self, environ):
+        """Path (without extension) of the files of one profiled request."""
+        directory = os.path.join(self.directory, self.route(environ))
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(
+            directory,
+            "%s-%06d-%d" % (stamp, time.time_ns() // 1000 % 10**6, os.getpid()),
+        )
+
+    @staticmethod
+    def memory_report(environ, seconds, peak, snapshot):
+        lines = [
+            "%s %s" % (environ.get("REQUEST_METHOD"), environ.get("PATH_INFO")),
+            "time       : %.3f ms" % (seconds * 1000),
+            "peak       : %d bytes" % peak,
+            "",
+            "top allocation sites still held at the end of the request:",
+        ]
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            lines.append(
+                "%10d B %7d blocks  %s:%d"
+                % (stat.size, stat.count, frame.filename, frame.lineno)
+            )
+        return "\n".join(lines) + "\n"
+
+
+def install(app, directory=PROFILE_DIR):
+    """
+    Wrap an app's WSGI callable in ``ProfilingMiddleware`` when profiling is
+    configured (``HCMS_PROFILE`` or ``HCMS_PROFILE_TOKEN``); do nothing
+    otherwise.
+
+    Returns:
+    - bool: True if the middleware was installed.
+    """
+    if not (parse_modes(PROFILE) or TOKEN):
+        return False
+    app.wsgi_app = ProfilingMiddleware(app, app.wsgi_app, directory)
+    return True
@@ -98,3 +98,7 @@ class ThreeBHKPayment(PaymentStrategy):
             occupant: The occupant making the payment.
         """
         occupant.pending_payments += self.get_initial_payment()
+
+
+# Payment strategy of a flat, by its number of bedrooms.
+BHK_STRATEGIES = {1: OneBHKPayment, 2: TwoBHKPayment, 3: ThreeBHKPayment}
@@ -0,0 +1,412 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Compact, schema-versioned record format for stored objects.
+
+Instead of pickling live ``OCCUPANT``, ``Client`` and ``Flat`` objects (with
+their strategy and state instances), the stores keep plain tuples of their
+fields. Payment strategies and states are stored as small integer codes.
+Tuples of builtins pickle without per-object class metadata, so files are
+smaller and load faster, and the format no longer depends on class layouts.
+
+Record layouts (schema version 3):
+
+    occupants : (name, phone_no, aadhar_no, email, password, block_no,
+                 flat_no, strategy, pending_payments, payment_state,
+                 last_payment_date as microseconds since 1970-01-01,
+                 last_billed_cycle, next_late_fee as microseconds)
+    clients   : (name, phone, email, password)
+    flats     : (block_no, flat_no, bhk, occupancy, occupant_email)
+
+Older occupant records lack the trailing fields (``last_billed_cycle``
+since version 2, ``next_late_fee`` since version 3) and are still read.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+import pickle
+
+from ps import OneBHKPayment, TwoBHKPayment, ThreeBHKPayment
+
+SCHEMA_VERSION = 3
+MAGIC = "HCMS-RECORDS"
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Enum codes; never renumber, only append.
+STRATEGY_CODES = {None: 0, OneBHKPayment: 1, TwoBHKPayment: 2, ThreeBHKPayment: 3}
+STRATEGIES = {code: cls for cls, code in STRATEGY_CODES.items()}
+UNPAID, PAID = 0, 1
+VACANT, OCCUPIED = 0, 1
+
+# Position of the password in each keyed record.
+PASSWORD_FIELD = {"occupants": 4, "clients": 3}
+# Positions of the fields of an occupant record used by batch jobs.
+OCCUPANT_BLOCK_FIELD = 5
+OCCUPANT_FLAT_FIELD = 6
+OCCUPANT_STRATEGY_FIELD = 7
+OCCUPANT_PENDING_FIELD = 8
+OCCUPANT_STATE_FIELD = 9
+OCCUPANT_LAST_PAID_FIELD = 10
+OCCUPANT_CYCLE_FIELD = 11
+OCCUPANT_LATE_FEE_FIELD = 12
+OCCUPANT_FIELDS = 13
+
+
+class RecordError(Exception):
+    """Raised when a record was written by an unknown schema version."""
+
+    pass
+
+
+def _domain():
+    """
+    Import the domain classes on first use.
+    The storage layer imports this module before they exist.
+    """
+    from occupant import OCCUPANT, PaidState, UnpaidState
+    from client import Client
+    from housingcommunity import Flat, OccupiedState, UnoccupiedState
+
+    return {
+        "OCCUPANT": OCCUPANT,
+        "PaidState": PaidState,
+        "UnpaidState": UnpaidState,
+        "Client": Client,
+        "Flat": Flat,
+        "OccupiedState": OccupiedState,
+        "UnoccupiedState": UnoccupiedState,
+    }
+
+
+# ------------------------------------------------------------------ occupants
+
+
+def encode_occupant(occupant):
+    """
+    Encode an occupant as a record tuple.
+    Observers are runtime-only and are not stored.
+
+    Args:
+    - occupant: OCCUPANT object.
+
+    Returns:
+    - tuple: Occupant record.
+    """
+    strategy = occupant.payment_strategy
+    return (
+        occupant._name,
+        occupant._phone_no,
+        occupant._aadhar_no,
+        occupant._email_id,
+        occupant._password,
+        occupant._block_no,
+        occupant._flat_no,
+        STRATEGY_CODES[None if strategy is None else type(strategy)],
+        occupant.pending_payments,
+        PAID if type(occupant.payment_state).__name__ == "PaidState" else UNPAID,
+        (occupant.last_payment_date - EPOCH) // MICROSECOND,
+        getattr(occupant, "last_billed_cycle", None),
+        getattr(occupant, "next_late_fee", None),
+    )
+
+
+def decode_occupant(record):
+    """
+    Hydrate an occupant record into an OCCUPANT object.
+    The constructor is bypassed, so nothing is validated or stored. The
+    record is kept on the object as the base of ``merge``.
+
+    Args:
+    - record (tuple): Occupant record.
+
+    Returns:
+    - OCCUPANT object.
+    """
+    (
+        name,
+        phone_no,
+        aadhar_no,
+        email,
+        password,
+        block_no,
+        flat_no,
+        strategy,
+        pending,
+        state,
+        last_paid,
+    ) = record[:OCCUPANT_CYCLE_FIELD]
+    domain = _domain()
+    occupant = domain["OCCUPANT"].__new__(domain["OCCUPANT"])
+    occupant._name = name
+    occupant._phone_no = phone_no
+    occupant._aadhar_no = aadhar_no
+    occupant._email_id = email
+    occupant._password = password
+    occupant._block_no = block_no
+    occupant._flat_no = flat_no
+    strategy_cls = STRATEGIES[strategy]
+    occupant.payment_strategy = None if strategy_cls is None else strategy_cls()
+    occupant.pending_payments = pending
+    state_cls = domain["PaidState"] if state == PAID else domain["UnpaidState"]
+    occupant.payment_state = state_cls(occupant.payment_strategy)
+    occupant.observers = []
+    occupant.last_payment_date = EPOCH + last_paid * MICROSECOND
+    (
+        occupant.last_billed_cycle,
+        occupant.next_late_fee,
+    ) = pad_occupant(
+        record
+    )[OCCUPANT_CYCLE_FIELD:]
+    occupant._record = record
+    return occupant
+
+
+def pad_occupant(record):
+    """Fill in the fields an older occupant record lacks with None."""
+    return record + (None,) * (OCCUPANT_FIELDS - len(record))
+
+
+# -------------------------------------------------------------------- clients
+
+
+def encode_client(client):
+    """Encode a client as a ``(name, phone, email, password)`` record."""
+    return (client._name, client._phone, client._email_id, client._password)
+
+
+def decode_client(record):
+    """Hydrate a client record into a Client object without storing it."""
+    client_cls = _domain()["Client"]
+    client = client_cls.__new__(client_cls)
+    client._name, client._phone, client._email_id, client._password = record
+    client._record = record
+    return client
+
+
+# ---------------------------------------------------------------------- flats
+
+
+def encode_flat(flat):
+    """Encode a flat as a record tuple."""
+    return (
+        flat._block_no,
+        flat._flat_no,
+        flat._bhk,
+        OCCUPIED if flat.get_state() == "Yes" else VACANT,
+        flat._occupant_email,
+    )
+
+
+def decode_flat(record):
+    """Hydrate a flat record into a Flat object."""
+    block_no, flat_no, bhk, occupancy, occupant_email = record
+    domain = _domain()
+    flat = domain["Flat"].__new__(domain["Flat"])
+    flat.__dict__.update(
+        _block_no=block_no,
+        _flat_no=flat_no,
+        _bhk=bhk,
+        _occupancy_status=(
+            domain["OccupiedState"]()
+            if occupancy == OCCUPIED
+            else domain["UnoccupiedState"]()
+        ),
+        _occupant_email=occupant_email,
+        _community=None,
+    )
+    return flat
+
+
+CODECS = {
+    "occupants": (encode_occupant, decode_occupant),
+    "clients": (encode_client, decode_client),
+    "flats": (encode_flat, decode_flat),
+}
+
+
+def encode(kind, obj):
+    """Encode an object of the given kind ("occupants", "clients", "flats")."""
+    return CODECS[kind][0](obj)
+
+
+def decode(kind, record):
+    """Hydrate a record of the given kind."""
+    return CODECS[kind][1](record)
+
+
+def merge(kind, base, new, stored):
+    """
+    Merge the record of an object written back by a caller with the record
+    stored now, so a write made from a stale copy doesn't undo what other
+    writers stored since the copy was read.
+
+    Fields the caller left as they were in ``base`` keep their stored
+    value, and fields it changed take its value. The pending amount of an
+    occupant is merged as a change: a payment clears what the caller saw,
+    not the charges added since, and leaves the occupant unpaid if any
+    remain.
+
+    Args:
+    - kind (str): Kind of the records.
+    - base (tuple): Record the object was decoded from (None for a new one).
+    - new (tuple): Record of the object now.
+    - stored (tuple): Stored record, or None if there is none.
+
+    Returns:
+    - tuple: Record to store.
+    """
+    if base is None or stored is None or stored == base:
+        return new
+    if kind == "occupants":
+        base, stored = pad_occupant(base), pad_occupant(stored)
+    merged = [
+        old if value == was else value for was, value, old in zip(base, new, stored)
+    ]
+    if kind == "occupants":
+        amounts = (
+            base[OCCUPANT_PENDING_FIELD],
+            new[OCCUPANT_PENDING_FIELD],
+            stored[OCCUPANT_PENDING_FIELD],
+        )
+        if None not in amounts:
+            was, value, old = amounts
+            pending = old + value - was
+            merged[OCCUPANT_PENDING_FIELD] = pending
+            if pending > 0 and pending != value:
+                merged[OCCUPANT_STATE_FIELD] = UNPAID
+    return tuple(merged)
+
+
+# ------------------------------------------------------------------ envelopes
+
+
+def _check(version):
+    if version > SCHEMA_VERSION:
+        raise RecordError("Unknown record schema version %r" % version)
+
+
+def dumps(kind, obj):
+    """
+    Serialise one object as a versioned record.
+
+    Returns:
+    - bytes: ``pickle((version, record))``.
+    """
+    return dumps_record(encode(kind, obj))
+
+
+def dumps_record(record):
+    """Serialise a record tuple as written by ``dumps``."""
+    return pickle.dumps((SCHEMA_VERSION, record), pickle.HIGHEST_PROTOCOL)
+
+
+def loads(kind, data):
+    """
+    Deserialise bytes written by ``dumps``. Pickled objects written before
+    the record format existed are returned unchanged.
+    """
+    value = pickle.loads(data)
+    if isinstance(value, tuple):
+        _check(value[0])
+        return decode(kind, value[1])
+    return value
+
+
+def loads_record(kind, data):
+    """
+    Deserialise bytes written by ``dumps`` into the record tuple, without
+    building the object. Legacy pickled objects are encoded.
+    """
+    value = pickle.loads(data)
+    if isinstance(value, tuple):
+        _check(value[0])
+        return value[1]
+    return encode(kind, value)
+
+
+def pack_table(records):
+    """Wrap a ``{key: record}`` dict for writing to a store file."""
+    return (MAGIC, SCHEMA_VERSION, records)
+
+
+def unpack_table(kind, data):
+    """
+    Return the ``{key: record}`` dict of a store file.
+
+    Args:
+    - kind (str): Kind of the records.
+    - data: Unpickled file contents; a legacy ``{key: object}`` dict is
+      encoded on the fly.
+
+    Returns:
+    - dict: Records keyed by email.
+    """
+    if isinstance(data, tuple) and data and data[0] == MAGIC:
+        _check(data[1])
+        return data[2]
+    return {key: encode(kind, obj) for key, obj in data.items()}
+
+
+def pack_flats(flats):
+    """Encode a community's ``{block: [Flat]}`` dict."""
+    return (
+        SCHEMA_VERSION,
+        {
+            block: [encode_flat(flat) for flat in block_flats]
+            for block, block_flats in flats.items()
+        },
+    )
+
+
+def unpack_flats(packed):
+    """Decode the output of ``pack_flats``."""
+    version, flats = packed
+    _check(version)
+    return {
+        block: [decode_flat(record) for record in block_flats]
+        for block, block_flats in flats.items()
+    }
+
+
+class LazyRecords(MutableMapping):
+    """
+    Mapping of keys to objects that hydrates each record on first access.
+
+    Args:
+    - raw (dict): Records keyed by email.
+    - decode: Function turning one record into an object.
+    """
+
+    def __init__(self, raw, decode):
+        self._raw = raw
+        self._decode = decode
+        self._objects = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._objects[key]
+        except KeyError:
+            pass
+        obj = self._objects[key] = self._decode(self._raw[key])
+        return obj
+
+    def __setitem__(self, key, value):
+        self._raw[key] = None
+        self._objects[key] = value
+
+    def __delitem__(self, key):
+        del self._raw[key]
+        self._objects.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __contains__(self, key):
+        return key in self._raw
@@ -0,0 +1,156 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Cache of rendered listing pages, invalidated by storage writes.
+
+A cached page is keyed by its route, query string and the versions of the
+stores it reads. The version of a store is the backend's ``stamp`` (a
+counter in the shared version file for the pickle engine, see
+``versions.py``; a counter bumped in the same transaction for SQLite).
+Every write through ``Update_HC``, ``store_occupant`` or ``add_payment``
+changes the stamp, so no explicit invalidation is needed, and writes made
+by other worker processes are seen as well.
+
+Pages are sent with an ``ETag`` and ``Last-Modified``. A conditional GET
+whose validators still match gets a ``304 Not Modified`` without loading
+any data or rendering the template.
+
+Usage:
+    @app.route("/unoccu.html")
+    @cached_page("community")
+    def unoccu():
+        ...
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+import hashlib
+import threading
+
+from flask import make_response, request
+
+from storage import get_backend
+
+CACHE_SIZE = 256
+
+
+class ResponseCache:
+    """
+    LRU map of cache keys to ``(etag, last modified, body)``.
+
+    Args:
+    - max_entries (int): Least recently used pages are dropped beyond this.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def clear(self):
+        """Drop every cached page and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+
+page_cache = ResponseCache()
+
+
+def _not_modified(etag, last_modified):
+    """Tell whether the request's validators match the page."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return (
+        since is not None
+        and last_modified is not None
+        and last_modified.replace(microsecond=0) <= since
+    )
+
+
+def _respond(status, etag, last_modified, body, private):
+    response = make_response(body, status)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response
+
+
+def cached_page(*stores, vary=None):
+    """
+    Decorator caching the page rendered by a view.
+
+    Args:
+    - stores (str): Stores the page is built from (``OCCUPANTS``,
+      ``CLIENTS``, "community" or "payments").
+    - vary: Optional callable returning what else the page depends on (e.g.
+      the logged-in user). Such pages are marked private.
+
+    Only string bodies are cached; redirects and other responses returned by
+    the view pass through untouched.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            backend = get_backend().engine
+            versions = tuple(backend.stamp(store) for store in stores)
+            extra = vary() if vary is not None else None
+            key = (
+                request.endpoint,
+                request.query_string,
+                repr(kwargs),
+                repr(extra),
+                repr(versions),
+            )
+            etag = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+            private = vary is not None
+
+            entry = page_cache.get(key)
+            last_modified = entry[1] if entry is not None else None
+            if (entry is not None or request.if_none_match) and _not_modified(
+                etag, last_modified
+            ):
+                page_cache.count("not_modified")
+                return _respond(304, etag, last_modified, "", private)
+            if entry is not None:
+                page_cache.count("hits")
+                return _respond(200, etag, last_modified, entry[2], private)
+
+            page_cache.count("misses")
+            body = view(*args, **kwargs)
+            if not isinstance(body, str):
+                return body
+            last_modified = datetime.now(timezone.utc)
+            page_cache.put(key, (etag, last_modified, body))
+            return _respond(200, etag, last_modified, body, private)
+
+        return wrapper
+
+    return decorator
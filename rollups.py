@@ -0,0 +1,193 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Running totals of the payment ledger per occupant, month and block.
+
+``PaymentDB.add_payment`` adds every payment to three rollups, in the same
+unit of work as the payment itself:
+
+    email : lifetime total and number of payments of an occupant
+    month : total and number of payments of a month ("YYYY-MM")
+    block : total and number of payments of a block
+
+Reports then read a few rows (one per month at most) instead of looping
+over every payment. The block of a payment is the one its occupant lived in
+when paying.
+
+``rebuild`` recomputes the rollups from the ledger, e.g. for payments made
+before they existed. Run it while no payments are being made.
+
+Usage:
+    python rollups.py rebuild
+    python rollups.py show [--start 2024-01] [--end 2024-12]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+import json
+import threading
+
+from export import occupant_blocks
+from storage import get_backend
+
+EMAIL, MONTH, BLOCK = "email", "month", "block"
+
+
+def rollup_rows(email, block, amount, date):
+    """
+    Increments of one payment.
+
+    Args:
+    - email (str): Email of the occupant.
+    - block (str): Block of the occupant ("" if unknown).
+    - amount: Amount paid.
+    - date (str): Date of the payment, "YYYY-MM-DD HH:MM:SS".
+
+    Returns:
+    - list: ``(kind, key, amount, count)`` rows for ``add_rollups``.
+    """
+    return [
+        (EMAIL, email, amount, 1),
+        (MONTH, date[:7], amount, 1),
+        (BLOCK, block or "", amount, 1),
+    ]
+
+
+# ------------------------------------------------------------------- queries
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _load(kind, keys=None):
+    """
+    Read rollups of one kind. Engines without cheap point lookups (pickle)
+    are read once per change of the rollups and served from memory.
+    """
+    backend = get_backend()
+    if backend.point_lookups or backend is not backend.engine:
+        return backend.load_rollups(kind, keys)
+    stamp = (backend, backend.stamp("rollups"))
+    with _cache_lock:
+        cached = _cache.get(kind)
+        if cached is None or cached[0] != stamp or stamp[1] is None:
+            cached = _cache[kind] = (stamp, backend.load_rollups(kind))
+    table = cached[1]
+    if keys is None:
+        return table
+    return {key: table[key] for key in keys if key in table}
+
+
+def lifetime_paid(email):
+    """
+    Returns:
+    - tuple: ``(total, count)`` of every payment of an occupant.
+    """
+    return _load(EMAIL, [email]).get(email, (0, 0))
+
+
+def collected_in(month):
+    """
+    Args:
+    - month (str): "YYYY-MM".
+
+    Returns:
+    - tuple: ``(total, count)`` of the payments of that month.
+    """
+    return _load(MONTH, [month]).get(month, (0, 0))
+
+
+def monthly(start=None, end=None):
+    """
+    Totals per month.
+
+    Args:
+    - start, end (str): Inclusive "YYYY-MM" bounds.
+
+    Returns:
+    - list: ``(month, total, count)`` in month order.
+    """
+    return [
+        (month, total, count)
+        for month, (total, count) in sorted(_load(MONTH).items())
+        if (start is None or month >= start) and (end is None or month <= end)
+    ]
+
+
+def by_block():
+    """
+    Returns:
+    - list: ``(block, total, count)`` in block order.
+    """
+    return [
+        (block, total, count) for block, (total, count) in sorted(_load(BLOCK).items())
+    ]
+
+
+def report(start=None, end=None):
+    """
+    Summary for the admin reports page.
+
+    Args:
+    - start, end (str): Inclusive "YYYY-MM" bounds of the months listed.
+
+    Returns:
+    - dict: Months, blocks and the total of the months listed.
+    """
+    months = monthly(start, end)
+    return {
+        "months": [
+            {"month": month, "total": total, "count": count}
+            for month, total, count in months
+        ],
+        "blocks": [
+            {"block": block, "total": total, "count": count}
+            for block, total, count in by_block()
+        ],
+        "total": {
+            "total": sum(row[1] for row in months),
+            "count": sum(row[2] for row in months),
+        },
+    }
+
+
+# ------------------------------------------------------------------- rebuild
+
+
+def rebuild():
+    """
+    Recompute every rollup from the payment ledger. Blocks are taken from
+    the occupant store; payments of removed occupants count under "".
+
+    Returns:
+    - int: Number of payments read.
+    """
+    backend = get_backend()
+    blocks = occupant_blocks()
+    table = {}
+    read = 0
+    for email, amount, date in backend.iter_payments():
+        for kind, key, value, count in rollup_rows(
+            email, blocks.get(email, ""), amount, date
+        ):
+            total, old_count = table.get((kind, key), (0, 0))
+            table[kind, key] = (total + value, old_count + count)
+        read += 1
+    backend.replace_rollups(table)
+    return read
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="recompute the rollups from the ledger")
+    show = commands.add_parser("show", help="print the report as JSON")
+    show.add_argument("--start", help="first month, YYYY-MM")
+    show.add_argument("--end", help="last month, YYYY-MM")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print("payments read : %d" % rebuild())
+    elif args.command == "show":
+        print(json.dumps(report(args.start, args.end), indent=2))
@@ -0,0 +1,289 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Due-date scheduler moving overdue occupants to the unpaid state.
+
+An occupant is overdue ``DUE_PERIOD`` after their last payment. The
+scheduler keeps a min-heap of ``(due time, email)``, so a wake-up only
+looks at the occupants whose deadline has passed instead of the whole
+store. Those are handled in batches: each batch is one ``update_records``
+write that moves the occupants to the unpaid state and adds ``LATE_FEE`` to
+their dues.
+
+The time of the next late fee is kept in the occupant record
+(``next_late_fee``), written together with the fee, so an occupant is never
+charged twice for the same deadline, even if the scheduler stops between a
+write and its checkpoint. An occupant still unpaid a period later is
+charged again; one who pays moves their own deadline forward, and the stale
+heap entry is simply pushed back when it comes up.
+
+The heap is saved to a checkpoint file after every run. A restart resumes
+from it; the occupant store is only read again when it changed since the
+checkpoint, and then only new occupants are added to the heap.
+
+Usage:
+    python scheduler.py [--once] [--poll 60]
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+from datetime import datetime, timedelta
+import heapq
+import os
+import pickle
+import time
+
+from locking import atomic_writer, exclusive, shared
+import records
+from storage import get_backend, OCCUPANTS
+
+DUE_PERIOD = timedelta(days=30)
+LATE_FEE = 100
+BATCH_SIZE = 5000
+# Longest sleep between two checks for new occupants, in seconds.
+POLL_INTERVAL = 60
+
+CHECKPOINT_FILE = os.environ.get("HCMS_SCHEDULER_CHECKPOINT", "scheduler.checkpoint")
+CHECKPOINT_VERSION = 1
+
+
+def _micros(when):
+    return (when - records.EPOCH) // records.MICROSECOND
+
+
+def due_time(record, period):
+    """
+    Time at which an occupant record is next charged a late fee.
+
+    Args:
+    - record (tuple): Occupant record.
+    - period (int): Due period in microseconds.
+
+    Returns:
+    - int: Microseconds since 1970-01-01.
+    """
+    record = records.pad_occupant(record)
+    due = record[records.OCCUPANT_LAST_PAID_FIELD] + period
+    next_fee = record[records.OCCUPANT_LATE_FEE_FIELD]
+    return due if next_fee is None else max(due, next_fee)
+
+
+class SchedulerReport:
+    """
+    Outcome of one run.
+
+    Attributes:
+    - woken (int): Heap entries whose deadline had passed.
+    - charged (int): Occupants charged a late fee.
+    - batches (int): Writes made.
+    """
+
+    def __init__(self):
+        self.woken = 0
+        self.charged = 0
+        self.batches = 0
+
+    def summary(self):
+        return "woken %d, charged %d, batches %d" % (
+            self.woken,
+            self.charged,
+            self.batches,
+        )
+
+
+class DueScheduler:
+    """
+    Min-heap of the next due time of every occupant.
+
+    Args:
+    - checkpoint (str): File the heap is saved to between runs.
+    - period (timedelta): Time after a payment before an occupant is overdue.
+    - late_fee: Amount added to the dues of an overdue occupant.
+    - batch_size (int): Occupants written per batch.
+    """
+
+    def __init__(
+        self,
+        checkpoint=CHECKPOINT_FILE,
+        period=DUE_PERIOD,
+        late_fee=LATE_FEE,
+        batch_size=BATCH_SIZE,
+    ):
+        self.checkpoint = checkpoint
+        self.period = period // records.MICROSECOND
+        self.late_fee = late_fee
+        self.batch_size = batch_size
+        self._heap = []
+        self._queued = set()
+        # Stamp of the occupant store the heap was last reconciled with.
+        self._stamp = None
+        self._load_checkpoint()
+
+    # ------------------------------------------------------------ checkpoint
+
+    def _load_checkpoint(self):
+        try:
+            with shared(self.checkpoint), open(self.checkpoint, "rb") as f:
+                data = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+        if (
+            data.get("version") != CHECKPOINT_VERSION
+            or data.get("period") != self.period
+        ):
+            return
+        self._heap = data["heap"]
+        heapq.heapify(self._heap)
+        self._queued = {email for _, email in self._heap}
+        self._stamp = data["stamp"]
+
+    def save_checkpoint(self):
+        """Write the heap and the store stamp it matches."""
+        data = {
+            "version": CHECKPOINT_VERSION,
+            "period": self.period,
+            "stamp": self._stamp,
+            "heap": self._heap,
+        }
+        with exclusive(self.checkpoint), atomic_writer(self.checkpoint) as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    # ----------------------------------------------------------------- heap
+
+    def _push(self, due, email):
+        heapq.heappush(self._heap, (due, email))
+        self._queued.add(email)
+
+    def _add_new(self, table):
+        """Queue the occupants of ``table`` that are not in the heap yet."""
+        for email in table.keys() - self._queued:
+            self._push(due_time(table[email], self.period), email)
+
+    def refresh(self):
+        """
+        Reconcile the heap with the occupant store if the store changed.
+
+        Returns:
+        - bool: True if the store was read.
+        """
+        backend = get_backend()
+        stamp = backend.stamp(OCCUPANTS)
+        if stamp is not None and stamp == self._stamp:
+            return False
+        self._add_new(backend.load_records(OCCUPANTS))
+        self._stamp = stamp
+        return True
+
+    def next_due(self):
+        """
+        Returns:
+        - datetime: Earliest deadline in the heap, or None if it is empty.
+        """
+        if not self._heap:
+            return None
+        return records.EPOCH + self._heap[0][0] * records.MICROSECOND
+
+    # ------------------------------------------------------------------ run
+
+    def _charge(self, table, batch, now, pushes, report):
+        """``update_records`` callback charging the overdue occupants of a batch."""
+        state = records.OCCUPANT_STATE_FIELD
+        pending = records.OCCUPANT_PENDING_FIELD
+        late_fee = records.OCCUPANT_LATE_FEE_FIELD
+        changes = {}
+        for _, email in batch:
+            record = table.get(email)
+            if record is None:
+                # Occupant removed since it was queued.
+                self._queued.discard(email)
+                continue
+            due = due_time(record, self.period)
+            if due > now:
+                # Paid since it was queued.
+                pushes.append((due, email))
+                continue
+            # Missed periods are not charged retroactively; the next fee is
+            # due one full period from now at the earliest.
+            next_fee = due + self.period * ((now - due) // self.period + 1)
+            record = records.pad_occupant(record)
+            changes[email] = (
+                record[:pending]
+                + (record[pending] + self.late_fee, records.UNPAID)
+                + record[state + 1 : late_fee]
+                + (next_fee,)
+                + record[late_fee + 1 :]
+            )
+            pushes.append((next_fee, email))
+        report.charged += len(changes)
+        return changes
+
+    def run_due(self, now=None):
+        """
+        Charge every occupant whose deadline has passed.
+
+        Args:
+        - now (datetime): Current time; ``datetime.now()`` by default.
+
+        Returns:
+        - SchedulerReport
+        """
+        now = _micros(now or datetime.now())
+        report = SchedulerReport()
+        self.refresh()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        report.woken = len(due)
+
+        backend = get_backend()
+        for start in range(0, len(due), self.batch_size):
+            batch = due[start : start + self.batch_size]
+            pushes = []
+            try:
+                backend.update_records(
+                    OCCUPANTS,
+                    lambda table: self._charge(table, batch, now, pushes, report),
+                )
+            except BaseException:
+                # Put the unhandled entries back before giving up.
+                for entry in due[start:]:
+                    heapq.heappush(self._heap, entry)
+                self.save_checkpoint()
+                raise
+            for entry in pushes:
+                heapq.heappush(self._heap, entry)
+            report.batches += 1
+        self.save_checkpoint()
+        return report
+
+    def run_forever(self, poll=POLL_INTERVAL):
+        """
+        Run until interrupted, sleeping until the next deadline (or at most
+        ``poll`` seconds, to pick up new occupants).
+        """
+        while True:
+            report = self.run_due()
+            if report.charged:
+                print("%s %s" % (datetime.now().isoformat(" "), report.summary()))
+            next_due = self.next_due()
+            wait = poll
+            if next_due is not None:
+                wait = min(poll, (next_due - datetime.now()).total_seconds())
+            time.sleep(max(wait, 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--once", action="store_true", help="run once and exit")
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    scheduler = DueScheduler()
+    if args.once:
+        print(scheduler.run_due().summary())
+    else:
+        try:
+            scheduler.run_forever(args.poll)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,471 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Server-side sessions for logged-in occupants and clients.
+
+A login creates a session holding a small projection of the user (email,
+name and the few fields the pages show), so later requests don't have to
+load the occupant or client store. The browser only gets the session id,
+signed with HMAC-SHA256, in a cookie.
+
+Sessions live in an in-memory LRU cache in front of a shared store, so
+several worker processes see the same sessions. A cached session is used
+for ``CACHE_TTL`` seconds before it is read from the shared store again, so
+a logout or update made by another worker shows up within that time:
+
+    MemorySessionStore : this process only (default).
+    FileSessionStore   : one JSON file per session in a directory.
+    SQLiteSessionStore : a table in a SQLite database.
+
+The shared store is chosen with ``HCMS_SESSION_STORE`` ("memory", "file" or
+"sqlite"), ``HCMS_SESSION_PATH`` names its directory or database file and
+``HCMS_SESSION_SECRET`` the signing key. Without a secret, a random key is
+generated and, for the shared stores, kept next to the sessions so every
+worker uses the same one.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from locking import atomic_writer, exclusive
+
+COOKIE_NAME = "hcms_session"
+SESSION_TTL = 8 * 60 * 60
+CACHE_SIZE = 10000
+# Seconds a cached session is trusted before the shared store is asked again.
+CACHE_TTL = 2.0
+
+OCCUPANT = "occupant"
+CLIENT = "client"
+ADMIN = "admin"
+
+
+def json_stamp(stamp):
+    """Return a storage stamp as it reads back from JSON (tuples as lists)."""
+    return json.loads(json.dumps(stamp))
+
+
+def occupant_projection(occupant, stamp=None):
+    """
+    Session data of a logged-in occupant.
+
+    Args:
+    - occupant: OCCUPANT object.
+    - stamp: Occupant store stamp the object was read at; a session whose
+      stamp no longer matches the store should be refreshed.
+
+    Returns:
+    - dict: Role, email, name, flat, pending amount and store stamp.
+    """
+    return {
+        "role": OCCUPANT,
+        "email": occupant._email_id,
+        "name": occupant._name,
+        "block_no": occupant._block_no,
+        "flat_no": occupant._flat_no,
+        "pending_payments": occupant.pending_payments,
+        "stamp": json_stamp(stamp),
+    }
+
+
+def client_projection(client):
+    """
+    Session data of a logged-in client.
+
+    Args:
+    - client: Client object.
+
+    Returns:
+    - dict: Role, email and name.
+    """
+    return {"role": CLIENT, "email": client._email_id, "name": client._name}
+
+
+def admin_projection(user_id):
+    """
+    Session data of a logged-in administrator.
+
+    Args:
+    - user_id (str): Id the administrator logged in with.
+
+    Returns:
+    - dict: Role and user id.
+    """
+    return {"role": ADMIN, "user_id": user_id}
+
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+
+class SessionStore(ABC):
+    """
+    Abstract session store. Entries are ``(expires, data)`` pairs, where
+    ``expires`` is a ``time.time()`` timestamp and ``data`` a JSON-able dict.
+    """
+
+    @abstractmethod
+    def get(self, sid):
+        """
+        Returns:
+        - tuple: ``(expires, data)``, or None if the session doesn't exist.
+        """
+
+    @abstractmethod
+    def set(self, sid, expires, data):
+        """Create or replace a session."""
+
+    @abstractmethod
+    def delete(self, sid):
+        """Remove a session if it exists."""
+
+    def purge(self, now=None):
+        """Remove expired sessions. Stores that expire lazily may skip this."""
+
+
+class MemorySessionStore(SessionStore):
+    """
+    LRU dict of sessions in this process.
+
+    Args:
+    - max_entries (int): Least recently used sessions are dropped beyond this.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is not None:
+                self._entries.move_to_end(sid)
+            return entry
+
+    def set(self, sid, expires, data):
+        with self._lock:
+            self._entries[sid] = (expires, data)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            for sid in [s for s, (exp, _) in self._entries.items() if exp <= now]:
+                del self._entries[sid]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileSessionStore(SessionStore):
+    """
+    One JSON file per session, named after the session id.
+
+    Args:
+    - directory (str): Directory holding the session files.
+    """
+
+    def __init__(self, directory="sessions"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, sid + ".json")
+
+    def get(self, sid):
+        try:
+            with open(self._path(sid), encoding="utf-8") as f:
+                expires, data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return expires, data
+
+    def set(self, sid, expires, data):
+        with atomic_writer(self._path(sid)) as f:
+            f.write(json.dumps([expires, data]).encode("utf-8"))
+
+    def delete(self, sid):
+        try:
+            os.unlink(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            sid = name[: -len(".json")]
+            entry = self.get(sid)
+            if entry is not None and entry[0] <= now:
+                self.delete(sid)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions table in a SQLite database, one connection per thread.
+
+    Args:
+    - path (str): Database file.
+    """
+
+    def __init__(self, path="sessions.db"):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    expires REAL NOT NULL,
+                    data TEXT NOT NULL
+                )
+                """)
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = (
+            self.connection()
+            .execute("SELECT expires, data FROM sessions WHERE sid = ?", (sid,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def set(self, sid, expires, data):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, expires, data) VALUES (?, ?, ?)",
+                (sid, expires, json.dumps(data)),
+            )
+
+    def delete(self, sid):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+
+class SessionManager:
+    """
+    Creates, signs and resolves sessions.
+
+    Args:
+    - secret (bytes): HMAC key for signing session ids.
+    - shared (SessionStore): Store shared between workers, or None to keep
+      sessions in this process only.
+    - ttl (int): Lifetime of a session in seconds.
+    - cache_size (int): Sessions kept in the in-memory LRU cache.
+    - cache_ttl (float): Seconds a cached session is used before it is read
+      from the shared store again.
+    """
+
+    def __init__(
+        self,
+        secret,
+        shared=None,
+        ttl=SESSION_TTL,
+        cache_size=CACHE_SIZE,
+        cache_ttl=CACHE_TTL,
+    ):
+        self.secret = secret
+        self.shared = shared
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        # Entries are (expires, (data, monotonic time the copy is good until)).
+        self.cache = MemorySessionStore(cache_size)
+
+    def sign(self, sid):
+        """
+        Returns:
+        - str: Cookie value ``<sid>.<signature>``.
+        """
+        digest = hmac.new(self.secret, sid.encode("ascii"), hashlib.sha256)
+        return "%s.%s" % (sid, digest.hexdigest())
+
+    def unsign(self, token):
+        """
+        Check the signature of a cookie value.
+
+        Returns:
+        - str: The session id, or None if the value was tampered with.
+        """
+        if not token or "." not in token:
+            return None
+        sid = token.rsplit(".", 1)[0]
+        try:
+            expected = self.sign(sid)
+        except UnicodeEncodeError:
+            return None
+        if hmac.compare_digest(expected, token):
+            return sid
+        return None
+
+    def create(self, data):
+        """
+        Start a session.
+
+        Args:
+        - data (dict): JSON-able session data, e.g. ``occupant_projection``.
+
+        Returns:
+        - str: Signed cookie value.
+        """
+        sid = secrets.token_urlsafe(32)
+        expires = time.time() + self.ttl
+        self._cache(sid, expires, data)
+        if self.shared is not None:
+            self.shared.set(sid, expires, data)
+        return self.sign(sid)
+
+    def _cache(self, sid, expires, data):
+        self.cache.set(sid, expires, (data, time.monotonic() + self.cache_ttl))
+
+    def _entry(self, sid):
+        cached = self.cache.get(sid)
+        if cached is not None:
+            expires, (data, fresh_until) = cached
+            if self.shared is None or time.monotonic() < fresh_until:
+                return expires, data
+        if self.shared is None:
+            return None
+        entry = self.shared.get(sid)
+        if entry is None:
+            self.cache.delete(sid)
+        else:
+            self._cache(sid, *entry)
+        return entry
+
+    def load(self, token):
+        """
+        Resolve a cookie value.
+
+        Returns:
+        - dict: Session data, or None for a missing, forged or expired session.
+        """
+        sid = self.unsign(token)
+        if sid is None:
+            return None
+        entry = self._entry(sid)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires <= time.time():
+            self.destroy(token)
+            return None
+        return data
+
+    def update(self, token, data):
+        """
+        Replace the data of a live session, keeping its expiry.
+
+        Returns:
+        - bool: False if the session no longer exists.
+        """
+        sid = self.unsign(token)
+        entry = None if sid is None else self._entry(sid)
+        if entry is None:
+            return False
+        self._cache(sid, entry[0], data)
+        if self.shared is not None:
+            self.shared.set(sid, entry[0], data)
+        return True
+
+    def destroy(self, token):
+        """End a session."""
+        sid = self.unsign(token)
+        if sid is None:
+            return
+        self.cache.delete(sid)
+        if self.shared is not None:
+            self.shared.delete(sid)
+
+
+def _shared_secret(path):
+    """Read the signing key kept at ``path``, creating it if needed."""
+    with exclusive(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        secret = secrets.token_bytes(32)
+        with atomic_writer(path) as f:
+            f.write(secret)
+        os.chmod(path, 0o600)
+        return secret
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """
+    Return the process-wide session manager, creating it on first use.
+
+    Returns:
+    - SessionManager: Backed by the store selected by ``HCMS_SESSION_STORE``.
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                kind = os.environ.get("HCMS_SESSION_STORE", "memory").lower()
+                path = os.environ.get("HCMS_SESSION_PATH")
+                if kind == "file":
+                    shared = FileSessionStore(path or "sessions")
+                    key_file = os.path.join(shared.directory, "session.key")
+                elif kind == "sqlite":
+                    shared = SQLiteSessionStore(path or "sessions.db")
+                    key_file = shared.path + ".key"
+                elif kind == "memory":
+                    shared = key_file = None
+                else:
+                    raise ValueError("Unknown session store: %s" % kind)
+                secret = os.environ.get("HCMS_SESSION_SECRET")
+                if secret:
+                    secret = secret.encode("utf-8")
+                elif key_file is not None:
+                    secret = _shared_secret(key_file)
+                else:
+                    secret = secrets.token_bytes(32)
+                _manager = SessionManager(secret, shared)
+    return _manager
+
+
+def set_manager(manager):
+    """Replace the process-wide session manager."""
+    global _manager
+    _manager = manager
@@ -0,0 +1,1569 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Storage backends for the occupant, client, payment and community stores.
+
+The DB classes (``OCCUPANT_DB``, ``CLIENT_DB``, ``PaymentDB`` and
+``HousingCommunity``) keep their static-method APIs and delegate all I/O to
+the backend returned by ``get_backend()``:
+
+    PickleBackend : the original one-pickle-per-store layout (default).
+    SQLiteBackend : a local SQLite database in WAL mode with primary keys on
+                    email and (block, flat_no), so point lookups and single
+                    row updates cost O(log n).
+
+The engine is chosen with the ``HCMS_STORAGE`` environment variable
+("pickle" or "sqlite"); ``HCMS_SQLITE_PATH`` names the database file.
+
+Usage:
+    python storage.py migrate [--root DIR] [--db FILE]
+    python storage.py normalize-flats
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager, nullcontext
+import heapq
+from itertools import islice
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+
+from ledger import KEYS_KEPT, PaymentLedger, sort_key
+from locking import atomic_writer, exclusive, fsync_dir, shared
+import metrics
+import records
+import versions
+
+# Keyed record stores.
+OCCUPANTS = "occupants"
+CLIENTS = "clients"
+# Kinds of payment rollups (see ``rollups.py``).
+ROLLUP_KINDS = ("email", "month", "block")
+
+
+def flat_key(block_no, flat_no):
+    """
+    Normalise a (block, flat number) pair.
+
+    Args:
+    - block_no (str): Block of the flat.
+    - flat_no (int | str): Flat number.
+
+    Returns:
+    - tuple: (upper-cased block, flat number as a stripped string)
+    """
+    return str(block_no).strip().upper(), str(flat_no).strip()
+
+
+# Orders in which payments can be paged, as keys of ``(email, amount, date)``
+# records. Every key covers the whole record, so records with equal keys are
+# interchangeable.
+PAYMENT_SORTS = {
+    "date": sort_key,
+    "amount": lambda record: (record[1], record[2], record[0]),
+    "email": lambda record: (record[0], record[2], record[1]),
+}
+
+
+def paginate(rows, key, after, limit, skipped=False):
+    """
+    Cut one page from payment rows.
+
+    Args:
+    - rows: Iterable of records in page order, starting at the cursor key
+      (inclusive).
+    - key: Sort key function (see ``PAYMENT_SORTS``).
+    - after (tuple): Cursor ``(key, skip)`` of the previous page, or None;
+      ``skip`` records equal to ``key`` were already returned.
+    - limit (int): Page size.
+    - skipped (bool): ``rows`` already leaves out the ``skip`` records.
+
+    Returns:
+    - tuple: (list of records, cursor of the next page or None)
+    """
+    last_key, skip = after if after is not None else (None, 0)
+    offset = 0 if skipped else skip
+    page = list(islice(rows, offset, offset + limit + 1))
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    next_key = key(page[-1])
+    repeats = 0
+    for record in reversed(page):
+        if key(record) != next_key:
+            break
+        repeats += 1
+    if repeats == len(page) and next_key == last_key:
+        repeats += skip
+    return page, (next_key, repeats)
+
+
+def _within(rows, min_amount, max_amount):
+    """Keep the payment records whose amount is within inclusive bounds."""
+    if min_amount is not None:
+        rows = (record for record in rows if record[1] >= min_amount)
+    if max_amount is not None:
+        rows = (record for record in rows if record[1] <= max_amount)
+    return rows
+
+
+def _date_bounds(start, end):
+    """Key bounds of a date range over ``sort_key``."""
+    return (
+        None if start is None else (start,),
+        None if end is None else (end, "\U0010ffff"),
+    )
+
+
+class StorageBackend(ABC):
+    """
+    Abstract storage engine used by the DB classes.
+    """
+
+    # True when ``get`` reads only the requested record, so callers need not
+    # keep their own index in front of it.
+    point_lookups = False
+
+    @property
+    def engine(self):
+        """The backend that actually holds the data (self, unless buffered)."""
+        return self
+
+    # ------------------------------------------------------ keyed records
+
+    @abstractmethod
+    def get(self, store, key):
+        """
+        Fetch one record.
+
+        Args:
+        - store (str): Store name (``OCCUPANTS`` or ``CLIENTS``).
+        - key (str): Email of the record.
+
+        Returns:
+        - The stored object.
+
+        Raises:
+        - KeyError: Raised if the record doesn't exist.
+        """
+        pass
+
+    @abstractmethod
+    def put(self, store, key, value):
+        """Insert or replace one record."""
+        pass
+
+    @abstractmethod
+    def delete(self, store, key):
+        """Remove one record, returning it or None if it didn't exist."""
+        pass
+
+    @abstractmethod
+    def load_all(self, store):
+        """Return every record of a store as a ``{key: object}`` dict."""
+        pass
+
+    def load_records(self, store):
+        """
+        Return every record of a store in its compact form (see
+        ``records.py``), without building the objects where possible.
+
+        Returns:
+        - dict: Record tuples keyed by email.
+        """
+        return {
+            key: records.encode(store, value)
+            for key, value in self.load_all(store).items()
+        }
+
+    def update_records(self, store, update):
+        """
+        Rewrite records of a store in their compact form, in one write.
+
+        Engines hold the store locked (or a write transaction open) from the
+        read to the write, so no write made meanwhile is lost.
+
+        Args:
+        - store (str): ``OCCUPANTS`` or ``CLIENTS``.
+        - update: Function taking the ``{key: record}`` dict of the store and
+          returning the ``{key: new record}`` dict of the records to replace.
+
+        Returns:
+        - dict: The replaced records, as returned by ``update``.
+        """
+        changes = update(self.load_records(store))
+        if changes:
+            self.put_many(
+                store,
+                [
+                    (key, records.decode(store, record))
+                    for key, record in changes.items()
+                ],
+            )
+        return changes
+
+    def get_many(self, store, keys):
+        """Return the records found for ``keys`` as a ``{key: object}`` dict."""
+        found = {}
+        for key in keys:
+            try:
+                found[key] = self.get(store, key)
+            except KeyError:
+                pass
+        return found
+
+    def put_many(self, store, items):
+        """Insert or replace many ``(key, value)`` pairs."""
+        for key, value in items:
+            self.put(store, key, value)
+
+    def delete_many(self, store, keys):
+        """Remove many records."""
+        for key in keys:
+            self.delete(store, key)
+
+    # ---------------------------------------------------------- community
+
+    @abstractmethod
+    def load_community(self):
+        """
+        Load the housing community.
+
+        Raises:
+        - FileNotFoundError: Raised if no community has been saved yet.
+        """
+        pass
+
+    @abstractmethod
+    def save_community(self, hc):
+        """Write the whole housing community."""
+        pass
+
+    @abstractmethod
+    def save_community_header(self, hc):
+        """Write the community without touching its flats (e.g. new blocks)."""
+        pass
+
+    @abstractmethod
+    def save_flat(self, hc, flat):
+        """Insert or replace a single flat of ``hc``."""
+        pass
+
+    def pending_community(self):
+        """Community saved through this backend but not yet committed."""
+        return None
+
+    def lock_community(self):
+        """
+        Lock held by a community writer from reading the stored community
+        to saving its change, so writers in other processes can't overwrite
+        it with a stale copy. Re-entrant per thread. The default does
+        nothing.
+
+        Returns:
+        - A context manager.
+        """
+        return nullcontext()
+
+    # ----------------------------------------------------------- payments
+
+    @abstractmethod
+    def append_payments(self, records, keys=()):
+        """
+        Append ``(email, amount, date)`` records to the payment ledger,
+        together with the idempotency keys they were paid under.
+        """
+        pass
+
+    @abstractmethod
+    def paid_keys(self, keys):
+        """
+        Return the idempotency keys among ``keys`` recorded with a payment.
+
+        Args:
+        - keys: Keys to look up.
+
+        Returns:
+        - set: The keys found.
+        """
+        pass
+
+    @abstractmethod
+    def iter_payments(self):
+        """Yield every ``(email, amount, date)`` record in append order."""
+        pass
+
+    @abstractmethod
+    def payment_history(self, email):
+        """Return the ``(email, amount, date)`` records of one occupant."""
+        pass
+
+    def compact_payments(self):
+        """Compact the payment ledger, if the engine needs it."""
+        pass
+
+    def payments_page(
+        self,
+        sort="date",
+        descending=False,
+        start=None,
+        end=None,
+        email=None,
+        after=None,
+        limit=50,
+        min_amount=None,
+        max_amount=None,
+    ):
+        """
+        Return one page of payments.
+
+        This default scans every payment and keeps only a page worth of them
+        in memory; engines override it with an indexed lookup.
+
+        Args:
+        - sort (str): Key of ``PAYMENT_SORTS``.
+        - descending (bool): Largest keys first.
+        - start, end (str): Inclusive date bounds ("%Y-%m-%d %H:%M:%S").
+        - email (str): Only the payments of this occupant.
+        - after (tuple): Cursor returned with the previous page.
+        - limit (int): Page size.
+        - min_amount, max_amount (number): Inclusive amount bounds.
+
+        Returns:
+        - tuple: (list of ``(email, amount, date)`` records, cursor of the
+          next page or None)
+        """
+        return self._select_page(
+            _within(self.iter_payments(), min_amount, max_amount),
+            sort,
+            descending,
+            start,
+            end,
+            email,
+            after,
+            limit,
+        )
+
+    @staticmethod
+    def _select_page(records, sort, descending, start, end, email, after, limit):
+        """Pick one page out of unordered records with a bounded heap."""
+        key = PAYMENT_SORTS[sort]
+        cursor = after[0] if after is not None else None
+
+        def wanted(record):
+            if email is not None and record[0] != email:
+                return False
+            if start is not None and record[2] < start:
+                return False
+            if end is not None and record[2] > end:
+                return False
+            if cursor is None:
+                return True
+            return key(record) <= cursor if descending else key(record) >= cursor
+
+        size = limit + 1 + (after[1] if after is not None else 0)
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return paginate(select(size, filter(wanted, records), key), key, after, limit)
+
+    # ------------------------------------------------------------ rollups
+
+    def record_payments(self, records, rows, keys=()):
+        """
+        Append payments and add their rollup increments. Engines that can
+        write both at once override it.
+
+        Args:
+        - records (list): ``(email, amount, date)`` records.
+        - rows (list): ``(kind, key, amount, count)`` increments.
+        - keys (list): Idempotency keys of the payments.
+
+        Returns:
+        - None
+        """
+        if records or keys:
+            self.append_payments(records, keys)
+        if rows:
+            self.add_rollups(rows)
+
+    @abstractmethod
+    def add_rollups(self, rows):
+        """
+        Add to the payment rollups (see ``rollups.py``).
+
+        Args:
+        - rows: ``(kind, key, amount, count)`` increments.
+        """
+        pass
+
+    @abstractmethod
+    def load_rollups(self, kind, keys=None):
+        """
+        Read the payment rollups of one kind.
+
+        Args:
+        - kind (str): "email", "month" or "block".
+        - keys: Keys to read; every key of the kind by default.
+
+        Returns:
+        - dict: ``(total, count)`` keyed by the rollup key.
+        """
+        pass
+
+    @abstractmethod
+    def replace_rollups(self, table):
+        """Replace every rollup with a ``{(kind, key): (total, count)}`` dict."""
+        pass
+
+    # ------------------------------------------------------------- stamps
+
+    @abstractmethod
+    def stamp(self, store):
+        """
+        Return a cheap token that changes whenever ``store`` is written.
+
+        Args:
+        - store (str): ``OCCUPANTS``, ``CLIENTS``, "community", "payments"
+          or "rollups".
+
+        Returns:
+        - A hashable token, or None if the store doesn't exist yet.
+        """
+        pass
+
+    def watch(self):
+        """
+        Start noticing changes made to the stores outside the app, for
+        engines that need to. The default does nothing.
+
+        Returns:
+        - The watcher started, or None.
+        """
+        return None
+
+    # ------------------------------------------------------------ batches
+
+    def apply(self, batch):
+        """
+        Write the changes collected by a unit of work.
+
+        Args:
+        - batch (UnitOfWork): Buffered puts, deletes, community changes and
+          payments.
+
+        Returns:
+        - None
+        """
+        # Payments first: if the records after them are lost, the payment
+        # keys still say the payments were made, so they aren't made again.
+        if batch.payments or batch.rollups or batch.payment_keys:
+            self.record_payments(batch.payments, batch.rollups, batch.payment_keys)
+        for store, records in batch.puts.items():
+            if records:
+                self.put_many(store, records.items())
+        for store, keys in batch.deletes.items():
+            if keys:
+                self.delete_many(store, keys)
+        hc = batch.community
+        if hc is None:
+            return
+        if batch.full_community:
+            self.save_community(hc)
+            return
+        if batch.header:
+            self.save_community_header(hc)
+        for flat in batch.flats.values():
+            self.save_flat(hc, flat)
+
+
+class PickleBackend(StorageBackend):
+    """
+    Stores each collection as a single pickle file, as the app always has.
+
+    Reads hold the file's shared lock and writes its exclusive lock (see
+    ``locking.py``), and files are replaced atomically, so several worker
+    processes can share the files.
+
+    Every write bumps the store's counter in the shared version file (see
+    ``versions.py``), and those counters are the stamps. Where the file
+    can't be mapped, stamps fall back to the stat of the store's files.
+
+    A unit of work writing more than one store is first saved to a commit
+    journal with the final records, and only then written to the stores. A
+    journal left behind by a crash is rolled forward before the next write,
+    so the batch lands in every store or in none. The journal is locked
+    after the community and before the other stores.
+
+    Args:
+    - root (str): Directory holding the data files.
+    """
+
+    FILES = {
+        OCCUPANTS: "occupant_db.pickle",
+        CLIENTS: "client_db.pickle",
+        "community": "housing_community.pickle",
+        "payments": "payment_db",
+        "legacy_payments": "payment_db.pickle",
+        "rollups": "payment_rollups.pickle",
+        "journal": "commit.journal",
+    }
+
+    def __init__(self, root="."):
+        self.root = root
+        self.ledger = PaymentLedger(
+            self.path("payments"),
+            legacy_file=self.path("legacy_payments"),
+            rollups_file=self.path("rollups"),
+        )
+        self._versions = None
+        self._roll_forward()
+
+    def path(self, name):
+        """Return the file path of a store."""
+        return os.path.join(self.root, self.FILES[name])
+
+    @property
+    def versions(self):
+        """The shared version file, or None if it can't be used."""
+        if self._versions is None:
+            try:
+                shared_versions = versions.SharedVersions(
+                    os.path.join(self.root, versions.VERSION_FILE)
+                )
+            except OSError:
+                self._versions = False
+            else:
+                # Count edits made to the files while no process was running.
+                # Without the store locks: the caller may hold one already.
+                self._watcher(shared_versions).check_all(lock=False)
+                self._versions = shared_versions
+        return self._versions or None
+
+    def _watcher(self, shared_versions):
+        return versions.FileWatcher(
+            shared_versions,
+            os.path.abspath(self.root),
+            {store: self._files(store) for store in versions.STORES},
+        )
+
+    def _files(self, store):
+        """Files of a store and the path its writers lock."""
+        if store == "payments":
+            return [self.ledger.snap_file, self.ledger.log_file], self.ledger.base
+        if store == "rollups":
+            # The increments since the last compaction are in the log.
+            return [self.path("rollups"), self.ledger.log_file], self.ledger.base
+        path = self.path(store)
+        return [path], path
+
+    def _bump(self, store):
+        """Count a write of a store. The caller holds the store's lock."""
+        shared_versions = self.versions
+        if shared_versions is not None and store in versions.STORES:
+            shared_versions.bump(store, versions.signature(self._files(store)[0]))
+
+    def _load(self, name):
+        path = self.path(name)
+        with shared(path), open(path, "rb") as f:
+            data = f.read()
+        metrics.record_read(name, len(data))
+        start = time.perf_counter()
+        try:
+            return pickle.loads(data)
+        finally:
+            metrics.record_deserialize(name, start)
+
+    def _dump(self, name, data):
+        path = self.path(name)
+        with exclusive(path):
+            start = time.perf_counter()
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            with atomic_writer(path) as f:
+                f.write(data)
+            metrics.record_write(name, len(data), start)
+            self._bump(name)
+
+    def _load_records(self, store):
+        """Return the ``{key: record tuple}`` dict of a keyed store."""
+        try:
+            data = self._load(store)
+        except FileNotFoundError:
+            return {}
+        return records.unpack_table(store, data)
+
+    def _dump_records(self, store, table):
+        self._dump(store, records.pack_table(table))
+
+    def get(self, store, key):
+        return records.decode(store, self._load_records(store)[key])
+
+    def put(self, store, key, value):
+        self.put_many(store, [(key, value)])
+
+    def delete(self, store, key):
+        self._roll_forward()
+        with exclusive(self.path(store)):
+            table = self._load_records(store)
+            removed = table.pop(key, None)
+            self._dump_records(store, table)
+        return None if removed is None else records.decode(store, removed)
+
+    def get_many(self, store, keys):
+        table = self._load_records(store)
+        return {key: records.decode(store, table[key]) for key in keys if key in table}
+
+    def put_many(self, store, items):
+        encoded = [(key, value, records.encode(store, value)) for key, value in items]
+        self._roll_forward()
+        with exclusive(self.path(store)):
+            table = self._load_records(store)
+            for key, value, record in encoded:
+                table[key] = records.merge(
+                    store, getattr(value, "_record", None), record, table.get(key)
+                )
+            self._dump_records(store, table)
+        for _, value, record in encoded:
+            value._record = record
+
+    def delete_many(self, store, keys):
+        self._roll_forward()
+        with exclusive(self.path(store)):
+            table = self._load_records(store)
+            for key in keys:
+                table.pop(key, None)
+            self._dump_records(store, table)
+
+    def load_all(self, store):
+        return records.LazyRecords(
+            self._load_records(store), lambda record: records.decode(store, record)
+        )
+
+    def load_records(self, store):
+        return self._load_records(store)
+
+    def update_records(self, store, update):
+        self._roll_forward()
+        with exclusive(self.path(store)):
+            table = self._load_records(store)
+            changes = update(table)
+            if changes:
+                table.update(changes)
+                self._dump_records(store, table)
+        return changes
+
+    def load_community(self):
+        return self._load("community")
+
+    def save_community(self, hc):
+        self._roll_forward()
+        self._dump("community", hc)
+
+    def save_community_header(self, hc):
+        self.save_community(hc)
+
+    def save_flat(self, hc, flat):
+        self.save_community(hc)
+
+    def lock_community(self):
+        return exclusive(self.path("community"))
+
+    def apply(self, batch):
+        # Every community change rewrites the whole file, so do it once.
+        if batch.community is not None:
+            batch.full_community = True
+        stores = [
+            store
+            for store in (OCCUPANTS, CLIENTS)
+            if batch.puts[store] or batch.deletes[store]
+        ]
+        if batch.payments or batch.rollups or batch.payment_keys:
+            stores.append("payments")
+        if len(stores) + (batch.community is not None) < 2:
+            self._roll_forward()
+            if stores in ([OCCUPANTS], [CLIENTS]):
+                with exclusive(self.path(stores[0])):
+                    self._write_batch(batch, stores)
+            else:
+                super().apply(batch)
+            return
+        journal = self.path("journal")
+        with ExitStack() as locks:
+            locks.enter_context(self.lock_community())
+            locks.enter_context(exclusive(journal))
+            self._finish_commit()
+            for store in stores:
+                path = self.ledger.base if store == "payments" else self.path(store)
+                locks.enter_context(exclusive(path))
+            self._write_batch(batch, stores, journal)
+
+    def _write_batch(self, batch, stores, journal=None):
+        """
+        Write a batch, through the journal if one is given, and note on it
+        the stamps of the keyed stores before and after the write with the
+        records written to them. The caller holds the store locks.
+        """
+        keyed = [store for store in stores if store != "payments"]
+        before = {store: self.stamp(store) for store in keyed}
+        changes, tables, encoded = self._changes(batch)
+        if journal is None:
+            self._write_changes(changes, tables)
+        else:
+            with atomic_writer(journal) as out:
+                out.write(pickle.dumps(changes, pickle.HIGHEST_PROTOCOL))
+            self._write_changes(changes, tables)
+            os.unlink(journal)
+            fsync_dir(journal)
+        for store in keyed:
+            batch.written[store] = (
+                before[store],
+                self.stamp(store),
+                changes["records"][store],
+                changes["deletes"][store],
+            )
+        for value, record in encoded:
+            value._record = record
+
+    def _changes(self, batch):
+        """
+        Work out what a batch writes. The caller holds the store locks.
+
+        Returns:
+        - tuple: (journal entry, ``{store: table}`` of the keyed stores
+          read, ``(value, record)`` pairs of the records put)
+        """
+        changes = {
+            "id": "commit:" + uuid.uuid4().hex,
+            "records": {},
+            "deletes": {},
+            "community": batch.community,
+            "payments": (batch.payments, batch.rollups, batch.payment_keys),
+        }
+        tables, encoded = {}, []
+        for store in (OCCUPANTS, CLIENTS):
+            puts, deletes = batch.puts[store], batch.deletes[store]
+            if not puts and not deletes:
+                continue
+            table = tables[store] = self._load_records(store)
+            merged = changes["records"][store] = {}
+            for key, value in puts.items():
+                record = records.encode(store, value)
+                merged[key] = records.merge(
+                    store, getattr(value, "_record", None), record, table.get(key)
+                )
+                encoded.append((value, record))
+            changes["deletes"][store] = list(deletes)
+        return changes, tables, encoded
+
+    def _write_changes(self, changes, tables=None, replay=False):
+        """
+        Write a journal entry to the stores. Replaying one is harmless:
+        records are replaced by their final value, and the payments are
+        skipped if the ledger has the commit id among its keys. The caller
+        holds the store locks.
+        """
+        payments, rows, keys = changes["payments"]
+        if (payments or rows or keys) and not (
+            replay and self.paid_keys([changes["id"]])
+        ):
+            self.record_payments(payments, rows, [*keys, changes["id"]])
+        for store in (OCCUPANTS, CLIENTS):
+            if store not in changes["records"]:
+                continue
+            table = (tables or {}).get(store)
+            if table is None:
+                table = self._load_records(store)
+            table.update(changes["records"][store])
+            for key in changes["deletes"][store]:
+                table.pop(key, None)
+            self._dump_records(store, table)
+        if changes["community"] is not None:
+            self._dump("community", changes["community"])
+
+    def _finish_commit(self):
+        """
+        Roll forward the journal left behind by a crashed commit, if any.
+        The caller holds the community and journal locks.
+        """
+        journal = self.path("journal")
+        try:
+            with open(journal, "rb") as f:
+                changes = pickle.load(f)
+        except FileNotFoundError:
+            return
+        with ExitStack() as locks:
+            for store in changes["records"]:
+                locks.enter_context(exclusive(self.path(store)))
+            locks.enter_context(exclusive(self.ledger.base))
+            self._write_changes(changes, replay=True)
+        os.unlink(journal)
+        fsync_dir(journal)
+
+    def _roll_forward(self):
+        """Finish a crashed commit before writing, if one was left behind."""
+        if os.path.exists(self.path("journal")):
+            with self.lock_community(), exclusive(self.path("journal")):
+                self._finish_commit()
+
+    def append_payments(self, records, keys=()):
+        self.record_payments(records, (), keys)
+
+    def record_payments(self, records, rows, keys=()):
+        # One frame, so a payment, its rollups and its keys are written
+        # together.
+        with exclusive(self.ledger.base):
+            self.ledger.append(records, rows, keys)
+            if records:
+                self._bump("payments")
+            if rows:
+                self._bump("rollups")
+
+    def paid_keys(self, keys):
+        return self.ledger.paid_keys(keys)
+
+    def iter_payments(self):
+        return self.ledger.iter_records()
+
+    def payment_history(self, email):
+        return [record for record in self.ledger.iter_records() if record[0] == email]
+
+    def compact_payments(self):
+        with exclusive(self.ledger.base):
+            self.ledger.compact()
+            self._bump("payments")
+            self._bump("rollups")
+
+    def add_rollups(self, rows):
+        self.record_payments((), rows)
+
+    def load_rollups(self, kind, keys=None):
+        table = self.ledger.load_rollups()
+        if keys is not None:
+            return {key: table[kind, key] for key in keys if (kind, key) in table}
+        return {
+            key: value for (row_kind, key), value in table.items() if row_kind == kind
+        }
+
+    def replace_rollups(self, table):
+        with exclusive(self.ledger.base):
+            self.ledger.replace_rollups(table)
+            self._bump("rollups")
+
+    def payments_page(
+        self,
+        sort="date",
+        descending=False,
+        start=None,
+        end=None,
+        email=None,
+        after=None,
+        limit=50,
+        min_amount=None,
+        max_amount=None,
+    ):
+        low, high = _date_bounds(start, end)
+        if sort != "date":
+            # Only the date range is indexed; other orders go through a heap.
+            return self._select_page(
+                _within(self.ledger.iter_sorted(low, high), min_amount, max_amount),
+                sort,
+                descending,
+                None,
+                None,
+                email,
+                after,
+                limit,
+            )
+        if after is not None:
+            if descending:
+                high = after[0] if high is None else min(high, after[0])
+            else:
+                low = after[0] if low is None else max(low, after[0])
+        rows = self.ledger.iter_sorted(low, high, descending)
+        if email is not None:
+            rows = (record for record in rows if record[0] == email)
+        return paginate(_within(rows, min_amount, max_amount), sort_key, after, limit)
+
+    def stamp(self, store):
+        shared_versions = self.versions
+        if shared_versions is not None and store in versions.STORES:
+            return shared_versions.stamp(store)
+        paths = self._files(store)[0]
+        if len(paths) > 1:
+            return tuple(self._stat(path) for path in paths)
+        return self._stat(paths[0])
+
+    def watch(self):
+        """Start a ``versions.FileWatcher`` over the store files."""
+        shared_versions = self.versions
+        if shared_versions is None:
+            return None
+        watcher = self._watcher(shared_versions)
+        watcher.start()
+        return watcher
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Stores every collection in one SQLite database.
+
+    Records are kept as versioned blobs (see ``records.py``) next to the
+    indexed key columns, so reads and writes touch only the rows involved.
+
+    Args:
+    - path (str): Database file.
+    """
+
+    point_lookups = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS occupants (
+            email TEXT PRIMARY KEY,
+            data  BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clients (
+            email TEXT PRIMARY KEY,
+            data  BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS community (
+            id   INTEGER PRIMARY KEY CHECK (id = 1),
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS flats (
+            seq     INTEGER NOT NULL,
+            block   TEXT NOT NULL,
+            flat_no TEXT NOT NULL,
+            data    BLOB NOT NULL,
+            PRIMARY KEY (block, flat_no)
+        );
+        CREATE INDEX IF NOT EXISTS flats_seq ON flats (seq);
+        CREATE TABLE IF NOT EXISTS payments (
+            id     INTEGER PRIMARY KEY AUTOINCREMENT,
+            email  TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            date   TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS payments_email ON payments (email, id);
+        CREATE INDEX IF NOT EXISTS payments_date ON payments (date, id);
+        CREATE INDEX IF NOT EXISTS payments_by_date ON payments (date, email, amount);
+        CREATE INDEX IF NOT EXISTS payments_by_amount
+            ON payments (amount, date, email);
+        CREATE INDEX IF NOT EXISTS payments_by_email
+            ON payments (email, date, amount);
+        CREATE TABLE IF NOT EXISTS payment_keys (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS rollups (
+            kind  TEXT NOT NULL,
+            key   TEXT NOT NULL,
+            total NUMERIC NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS versions (
+            store   TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path="housing.db"):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Yield the connection for a write, committing it afterwards unless a
+        batch (see ``apply``) is in progress on this thread.
+        """
+        conn = self.connection()
+        if getattr(self._local, "batch", False):
+            yield conn
+        else:
+            with conn:
+                yield conn
+
+    def apply(self, batch):
+        # One transaction for the whole batch, so it commits atomically.
+        conn = self.connection()
+        self._local.batch = True
+        try:
+            with conn:
+                super().apply(batch)
+        finally:
+            self._local.batch = False
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _bump(conn, store):
+        """Advance the version of ``store`` inside the caller's transaction."""
+        conn.execute(
+            """
+            INSERT INTO versions (store, version) VALUES (?, 1)
+            ON CONFLICT (store) DO UPDATE SET version = version + 1
+            """,
+            (store,),
+        )
+
+    def stamp(self, store):
+        row = (
+            self.connection()
+            .execute("SELECT version FROM versions WHERE store = ?", (store,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    @staticmethod
+    def _table(store):
+        if store not in (OCCUPANTS, CLIENTS):
+            raise KeyError(store)
+        return store
+
+    def get(self, store, key):
+        row = (
+            self.connection()
+            .execute("SELECT data FROM %s WHERE email = ?" % self._table(store), (key,))
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        metrics.record_read(store, len(row[0]))
+        start = time.perf_counter()
+        try:
+            return records.loads(store, row[0])
+        finally:
+            metrics.record_deserialize(store, start)
+
+    def get_many(self, store, keys):
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        conn = self.connection()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = conn.execute(
+                "SELECT email, data FROM %s WHERE email IN (%s)"
+                % (self._table(store), ", ".join("?" * len(chunk))),
+                chunk,
+            ).fetchall()
+            metrics.record_read(store, sum(len(data) for _, data in rows))
+            begin = time.perf_counter()
+            found.update((email, records.loads(store, data)) for email, data in rows)
+            metrics.record_deserialize(store, begin)
+        return found
+
+    def put(self, store, key, value):
+        self.put_many(store, [(key, value)])
+
+    def put_many(self, store, items):
+        """Insert or replace many ``(key, value)`` pairs in one transaction."""
+        start = time.perf_counter()
+        encoded = [(key, value, records.encode(store, value)) for key, value in items]
+        bases = {
+            key: value._record
+            for key, value, _ in encoded
+            if getattr(value, "_record", None) is not None
+        }
+        with self._writing() as conn:
+            stored = {}
+            if bases:
+                if not conn.in_transaction:
+                    # Read the records to merge with under the write lock.
+                    conn.execute("BEGIN IMMEDIATE")
+                stored = self._select_records(conn, store, list(bases))
+            rows = [
+                (
+                    key,
+                    records.dumps_record(
+                        records.merge(store, bases.get(key), record, stored.get(key))
+                    ),
+                )
+                for key, _, record in encoded
+            ]
+            conn.executemany(
+                "INSERT OR REPLACE INTO %s (email, data) VALUES (?, ?)"
+                % self._table(store),
+                rows,
+            )
+            self._bump(conn, store)
+        metrics.record_write(store, sum(len(data) for _, data in rows), start)
+        for _, value, record in encoded:
+            value._record = record
+
+    def _select_records(self, conn, store, keys):
+        """Return the stored ``{key: record tuple}`` of some keys."""
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = conn.execute(
+                "SELECT email, data FROM %s WHERE email IN (%s)"
+                % (self._table(store), ", ".join("?" * len(chunk))),
+                chunk,
+            ).fetchall()
+            metrics.record_read(store, sum(len(data) for _, data in rows))
+            found.update(
+                (email, records.loads_record(store, data)) for email, data in rows
+            )
+        return found
+
+    def delete(self, store, key):
+        try:
+            removed = self.get(store, key)
+        except KeyError:
+            return None
+        with self._writing() as conn:
+            conn.execute("DELETE FROM %s WHERE email = ?" % self._table(store), (key,))
+            self._bump(conn, store)
+        return removed
+
+    def delete_many(self, store, keys):
+        with self._writing() as conn:
+            conn.executemany(
+                "DELETE FROM %s WHERE email = ?" % self._table(store),
+                ((key,) for key in keys),
+            )
+            self._bump(conn, store)
+
+    def load_all(self, store):
+        rows = self.connection().execute(
+            "SELECT email, data FROM %s ORDER BY rowid" % self._table(store)
+        )
+        table = dict(rows.fetchall())
+        metrics.record_read(store, sum(map(len, table.values())))
+        return records.LazyRecords(table, lambda data: records.loads(store, data))
+
+    def load_records(self, store):
+        rows = (
+            self.connection()
+            .execute("SELECT email, data FROM %s ORDER BY rowid" % self._table(store))
+            .fetchall()
+        )
+        metrics.record_read(store, sum(len(data) for _, data in rows))
+        start = time.perf_counter()
+        table = {email: records.loads_record(store, data) for email, data in rows}
+        metrics.record_deserialize(store, start)
+        return table
+
+    def update_records(self, store, update):
+        with self._writing() as conn:
+            if not conn.in_transaction:
+                # Take the write lock before reading, not at the first UPDATE.
+                conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT email, data FROM %s" % self._table(store)
+            ).fetchall()
+            metrics.record_read(store, sum(len(data) for _, data in rows))
+            start = time.perf_counter()
+            table = {email: records.loads_record(store, data) for email, data in rows}
+            metrics.record_deserialize(store, start)
+            changes = update(table)
+            if changes:
+                start = time.perf_counter()
+                rows = [
+                    (key, records.dumps_record(record))
+                    for key, record in changes.items()
+                ]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO %s (email, data) VALUES (?, ?)"
+                    % self._table(store),
+                    rows,
+                )
+                self._bump(conn, store)
+                metrics.record_write(store, sum(len(data) for _, data in rows), start)
+        return changes
+
+    @staticmethod
+    def _header(hc):
+        """Pickle ``hc`` without its flats; they live in their own table."""
+        shell = object.__new__(type(hc))
+        shell.__dict__.update(hc.__dict__, _flats={})
+        return pickle.dumps(shell)
+
+    def load_community(self):
+        conn = self.connection()
+        row = conn.execute("SELECT data FROM community WHERE id = 1").fetchone()
+        if row is None:
+            raise FileNotFoundError("No housing community in %s" % self.path)
+        rows = conn.execute("SELECT block, data FROM flats ORDER BY seq").fetchall()
+        metrics.record_read(
+            "community", len(row[0]) + sum(len(data) for _, data in rows)
+        )
+        start = time.perf_counter()
+        hc = pickle.loads(row[0])
+        flats = {}
+        for block, data in rows:
+            flats.setdefault(block, []).append(records.loads("flats", data))
+        hc.__setstate__({**hc.__dict__, "_flats": flats})
+        metrics.record_deserialize("community", start)
+        return hc
+
+    def save_community(self, hc):
+        start = time.perf_counter()
+        header = self._header(hc)
+        rows = [
+            (
+                seq,
+                *flat_key(flat._block_no, flat._flat_no),
+                records.dumps("flats", flat),
+            )
+            for seq, flat in enumerate(
+                flat for block_flats in hc._flats.values() for flat in block_flats
+            )
+        ]
+        with self._writing() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO community (id, data) VALUES (1, ?)", (header,)
+            )
+            conn.execute("DELETE FROM flats")
+            conn.executemany(
+                "INSERT INTO flats (seq, block, flat_no, data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._bump(conn, "community")
+        metrics.record_write(
+            "community", len(header) + sum(len(row[3]) for row in rows), start
+        )
+
+    def save_community_header(self, hc):
+        with self._writing() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO community (id, data) VALUES (1, ?)",
+                (self._header(hc),),
+            )
+            self._bump(conn, "community")
+
+    def save_flat(self, hc, flat):
+        with self._writing() as conn:
+            conn.execute(
+                """
+                INSERT INTO flats (seq, block, flat_no, data)
+                VALUES ((SELECT COALESCE(MAX(seq), -1) + 1 FROM flats), ?, ?, ?)
+                ON CONFLICT (block, flat_no) DO UPDATE SET data = excluded.data
+                """,
+                (
+                    *flat_key(flat._block_no, flat._flat_no),
+                    records.dumps("flats", flat),
+                ),
+            )
+            self._bump(conn, "community")
+
+    def lock_community(self):
+        # A file lock rather than a transaction: the community is read
+        # before the unit of work that saves it starts writing.
+        return exclusive(self.path)
+
+    def append_payments(self, records, keys=()):
+        with self._writing() as conn:
+            conn.executemany(
+                "INSERT INTO payments (email, amount, date) VALUES (?, ?, ?)", records
+            )
+            if keys:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO payment_keys (key) VALUES (?)",
+                    ((key,) for key in keys),
+                )
+                # Keep as many keys as the pickle ledger does.
+                conn.execute(
+                    "DELETE FROM payment_keys "
+                    "WHERE seq <= (SELECT MAX(seq) FROM payment_keys) - ?",
+                    (KEYS_KEPT,),
+                )
+            self._bump(conn, "payments")
+
+    def paid_keys(self, keys):
+        conn = self.connection()
+        keys = list(dict.fromkeys(keys))
+        found = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = conn.execute(
+                "SELECT key FROM payment_keys WHERE key IN (%s)"
+                % ", ".join("?" * len(chunk)),
+                chunk,
+            )
+            found.update(key for key, in rows)
+        return found
+
+    def add_rollups(self, rows):
+        with self._writing() as conn:
+            conn.executemany(
+                """
+                INSERT INTO rollups (kind, key, total, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT (kind, key) DO UPDATE
+                SET total = total + excluded.total, count = count + excluded.count
+                """,
+                rows,
+            )
+            self._bump(conn, "rollups")
+
+    def load_rollups(self, kind, keys=None):
+        conn = self.connection()
+        if keys is None:
+            rows = conn.execute(
+                "SELECT key, total, count FROM rollups WHERE kind = ?", (kind,)
+            )
+            return {key: (total, count) for key, total, count in rows}
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = conn.execute(
+                "SELECT key, total, count FROM rollups WHERE kind = ? AND key IN (%s)"
+                % ", ".join("?" * len(chunk)),
+                [kind, *chunk],
+            )
+            found.update((key, (total, count)) for key, total, count in rows)
+        return found
+
+    def replace_rollups(self, table):
+        with self._writing() as conn:
+            conn.execute("DELETE FROM rollups")
+            conn.executemany(
+                "INSERT INTO rollups (kind, key, total, count) VALUES (?, ?, ?, ?)",
+                (
+                    (kind, key, total, count)
+                    for (kind, key), (total, count) in table.items()
+                ),
+            )
+            self._bump(conn, "rollups")
+
+    def iter_payments(self):
+        return iter(
+            self.connection().execute(
+                "SELECT email, amount, date FROM payments ORDER BY id"
+            )
+        )
+
+    def payment_history(self, email):
+        return (
+            self.connection()
+            .execute(
+                "SELECT email, amount, date FROM payments WHERE email = ? ORDER BY id",
+                (email,),
+            )
+            .fetchall()
+        )
+
+    # Columns of each order in ``PAYMENT_SORTS``.
+    SORT_COLUMNS = {
+        "date": ("date", "email", "amount"),
+        "amount": ("amount", "date", "email"),
+        "email": ("email", "date", "amount"),
+    }
+
+    def payments_page(
+        self,
+        sort="date",
+        descending=False,
+        start=None,
+        end=None,
+        email=None,
+        after=None,
+        limit=50,
+        min_amount=None,
+        max_amount=None,
+    ):
+        columns = self.SORT_COLUMNS[sort]
+        where, params = [], []
+        if start is not None:
+            where.append("date >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("date <= ?")
+            params.append(end)
+        if email is not None:
+            where.append("email = ?")
+            params.append(email)
+        if min_amount is not None:
+            where.append("amount >= ?")
+            params.append(min_amount)
+        if max_amount is not None:
+            where.append("amount <= ?")
+            params.append(max_amount)
+        skip = 0
+        if after is not None:
+            where.append(
+                "(%s) %s (?, ?, ?)" % (", ".join(columns), "<=" if descending else ">=")
+            )
+            params.extend(after[0])
+            skip = after[1]
+        direction = " DESC" if descending else ""
+        query = (
+            "SELECT email, amount, date FROM payments%s ORDER BY %s LIMIT ? OFFSET ?"
+            % (
+                " WHERE " + " AND ".join(where) if where else "",
+                ", ".join(column + direction for column in columns),
+            )
+        )
+        params.extend([limit + 1, skip])
+        rows = self.connection().execute(query, params).fetchall()
+        return paginate(rows, PAYMENT_SORTS[sort], after, limit, skipped=True)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_overlays = threading.local()
+
+
+def get_backend():
+    """
+    Return the storage backend for the calling thread.
+
+    Inside a unit of work this is the unit of work itself, which buffers
+    writes until it commits; otherwise it is the process-wide engine.
+
+    Returns:
+    - StorageBackend: Backend to read from and write to.
+    """
+    stack = getattr(_overlays, "stack", None)
+    if stack:
+        return stack[-1]
+    return get_engine()
+
+
+def push_overlay(backend):
+    """Route this thread's ``get_backend()`` calls to ``backend``."""
+    if not hasattr(_overlays, "stack"):
+        _overlays.stack = []
+    _overlays.stack.append(backend)
+
+
+def pop_overlay():
+    """Undo the last ``push_overlay`` of this thread."""
+    return _overlays.stack.pop()
+
+
+def get_engine():
+    """
+    Return the process-wide storage engine, creating it on first use.
+
+    Returns:
+    - StorageBackend: Engine selected by ``HCMS_STORAGE``.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                engine = os.environ.get("HCMS_STORAGE", "pickle").lower()
+                if engine == "sqlite":
+                    _backend = SQLiteBackend(
+                        os.environ.get("HCMS_SQLITE_PATH", "housing.db")
+                    )
+                elif engine == "pickle":
+                    _backend = PickleBackend()
+                else:
+                    raise ValueError("Unknown storage engine: %s" % engine)
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace the process-wide storage backend.
+
+    Args:
+    - backend (StorageBackend): Engine to use from now on.
+
+    Returns:
+    - StorageBackend: The previous engine (may be None).
+    """
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def migrate(source, target):
+    """
+    Copy every store from one backend into another (normally empty) one.
+
+    Keyed records, the community and the rollups replace what the target
+    holds, but payments can only be appended, so a target that already has
+    payments is refused rather than given a second copy of them.
+
+    Args:
+    - source (StorageBackend): Backend to read from.
+    - target (StorageBackend): Backend to write to.
+
+    Returns:
+    - dict: Number of records copied per store.
+
+    Raises:
+    - ValueError: Raised if the target already has payments.
+    """
+    if next(iter(target.iter_payments()), None) is not None:
+        raise ValueError("The target already has payments; migrate into a new one")
+    counts = {}
+    for store in (OCCUPANTS, CLIENTS):
+        records = source.load_all(store)
+        target.put_many(store, records.items())
+        counts[store] = len(records)
+    try:
+        hc = source.load_community()
+    except FileNotFoundError:
+        counts["flats"] = 0
+    else:
+        target.save_community(hc)
+        counts["flats"] = sum(len(flats) for flats in hc._flats.values())
+    payments = list(source.iter_payments())
+    target.append_payments(payments)
+    counts["payments"] = len(payments)
+    target.replace_rollups(
+        {
+            (kind, key): value
+            for kind in ROLLUP_KINDS
+            for key, value in source.load_rollups(kind).items()
+        }
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Housing community storage tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_cmd = commands.add_parser(
+        "migrate", help="import the *.pickle files into a SQLite database"
+    )
+    migrate_cmd.add_argument("--root", default=".", help="directory of the pickles")
+    migrate_cmd.add_argument("--db", default="housing.db", help="SQLite database")
+    commands.add_parser(
+        "normalize-flats",
+        help="store only the occupant's email with each flat of the community",
+    )
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        try:
+            counts = migrate(PickleBackend(args.root), SQLiteBackend(args.db))
+        except ValueError as e:
+            parser.error(str(e))
+        for store, count in counts.items():
+            print("%-10s : %d" % (store, count))
+    elif args.command == "normalize-flats":
+        from housingcommunity import HousingCommunity
+
+        copied = HousingCommunity.GET_HC().normalize_occupants()
+        print("occupants copied into the occupant store : %d" % copied)
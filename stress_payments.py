@@ -0,0 +1,139 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Multi-process stress test for the pickle stores.
+
+Starts several worker processes that record payments through
+``PaymentDB.add_payment``, store occupants through
+``OCCUPANT_DB.store_occupant`` and add blocks through
+``HousingCommunity.add_block`` at the same time, all against one scratch
+directory, then checks that no payment, occupant or block was lost. The
+ledger is made to compact often so compactions race with appends as well.
+
+Usage:
+    python stress_payments.py [--workers 8] [--payments 200] [--occupants 20]
+                              [--blocks 25]
+
+Exits with status 1 if anything went missing.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+import argparse
+import multiprocessing
+import sys
+import tempfile
+
+import ledger
+import records
+from storage import PickleBackend, set_backend
+
+
+def block_name(worker_id, index):
+    return "W%dB%d" % (worker_id, index)
+
+
+def worker(root, worker_id, payments, occupants, blocks, compact_every):
+    """Record payments, store occupants and add blocks from one process."""
+    ledger.COMPACT_THRESHOLD = compact_every
+    set_backend(PickleBackend(root))
+    from housingcommunity import HousingCommunity
+    from occupant import OCCUPANT_DB, PaymentDB
+
+    step = max(1, payments // max(1, occupants))
+    for i in range(payments):
+        PaymentDB.add_payment("worker%d@example.com" % worker_id, i + 1)
+        if i % step == 0 and occupants:
+            occupants -= 1
+            email = "w%d-o%d@example.com" % (worker_id, occupants)
+            OCCUPANT_DB.store_occupant(
+                records.decode_occupant(
+                    ("Stress", "0", "0", email, "pw", "A", 1, 1, 0, 0, 0)
+                )
+            )
+    # Each call works on the cached community, which the other workers'
+    # blocks make stale.
+    for b in range(blocks):
+        HousingCommunity.GET_HC().add_block(block_name(worker_id, b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent payment stress test")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--payments", type=int, default=200)
+    parser.add_argument("--occupants", type=int, default=20)
+    parser.add_argument("--blocks", type=int, default=25)
+    parser.add_argument("--compact-every", type=int, default=64)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="hcms-stress-")
+    set_backend(PickleBackend(root))
+    from housingcommunity import HousingCommunity
+
+    HousingCommunity().Update_HC()
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=worker,
+            args=(
+                root,
+                n,
+                args.payments,
+                args.occupants,
+                args.blocks,
+                args.compact_every,
+            ),
+        )
+        for n in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    set_backend(PickleBackend(root))
+    from occupant import OCCUPANT_DB, PaymentDB
+
+    HousingCommunity.clear_cache()
+    failures = [p.exitcode for p in processes if p.exitcode != 0]
+    rows = PaymentDB.get_payments()
+    expected_rows = args.workers * args.payments
+    expected_total = args.workers * args.payments * (args.payments + 1) // 2
+    total = sum(amount for _, amount, _ in rows)
+    stored = len(
+        OCCUPANT_DB.get_occupants(
+            [
+                "w%d-o%d@example.com" % (w, o)
+                for w in range(args.workers)
+                for o in range(args.occupants)
+            ]
+        )
+    )
+    expected_stored = args.workers * min(args.occupants, args.payments)
+    stored_blocks = set(HousingCommunity.GET_HC().list_blocks())
+    blocks = sum(
+        block_name(w, b) in stored_blocks
+        for w in range(args.workers)
+        for b in range(args.blocks)
+    )
+    expected_blocks = args.workers * args.blocks
+
+    print("data directory : %s" % root)
+    print("payments       : %d / %d" % (len(rows), expected_rows))
+    print("amount         : %d / %d" % (total, expected_total))
+    print("occupants      : %d / %d" % (stored, expected_stored))
+    print("blocks         : %d / %d" % (blocks, expected_blocks))
+    if failures or (len(rows), total, stored, blocks) != (
+        expected_rows,
+        expected_total,
+        expected_stored,
+        expected_blocks,
+    ):
+        print("FAILED")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
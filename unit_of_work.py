@@ -0,0 +1,244 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Unit of work for grouping storage writes.
+
+Inside ``with UnitOfWork():`` every write made through the DB classes is
+buffered instead of hitting the storage engine, and reads see the buffered
+changes. Leaving the block normally commits everything in one batch; leaving
+it with an exception throws the buffer away.
+
+Usage:
+    with UnitOfWork():
+        occupant = OCCUPANT(...)
+        flat.occupy(occupant)
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from contextlib import ExitStack, nullcontext
+
+from storage import (
+    StorageBackend,
+    OCCUPANTS,
+    CLIENTS,
+    flat_key,
+    get_backend,
+    push_overlay,
+    pop_overlay,
+)
+
+
+class UnitOfWork(StorageBackend):
+    """
+    Write-buffering backend that commits its changes once.
+
+    Units of work nest: an inner unit commits into the outer one, and only
+    the outermost unit writes to the storage engine.
+    """
+
+    # Callables invoked with the unit of work after the engine commit or
+    # before a rollback clears it (e.g. to refresh or drop in-memory
+    # caches). Both run while the unit still holds its locks.
+    committed_listeners = []
+    rolled_back_listeners = []
+
+    def __init__(self):
+        self._base = None
+        self.puts = {OCCUPANTS: {}, CLIENTS: {}}
+        self.deletes = {OCCUPANTS: set(), CLIENTS: set()}
+        self.community = None
+        self.full_community = False
+        self.header = False
+        self.flats = {}
+        self.payments = []
+        self.payment_keys = []
+        self.rollups = []
+        # {store: (stamp before, stamp after, records put, keys deleted)}
+        # of the keyed stores the engine wrote, noted while committing.
+        self.written = {}
+        # (topic, event) pairs published once the engine commit is done.
+        self.events = []
+        # Locks taken through lock_community, released after the commit.
+        self._locks = ExitStack()
+        self._community_locked = False
+
+    @property
+    def engine(self):
+        return self._base.engine
+
+    def __enter__(self):
+        self._base = get_backend()
+        push_overlay(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pop_overlay()
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def commit(self):
+        """
+        Write the buffered changes to the enclosing backend.
+
+        Returns:
+        - None
+        """
+        try:
+            self._base.apply(self)
+            if self._base is self.engine:
+                for listener in list(UnitOfWork.committed_listeners):
+                    listener(self)
+        finally:
+            self._locks.close()
+
+    def rollback(self):
+        """
+        Discard the buffered changes.
+
+        Returns:
+        - None
+        """
+        locks = self._locks
+        try:
+            for listener in list(UnitOfWork.rolled_back_listeners):
+                listener(self)
+        finally:
+            self.__init__()
+            locks.close()
+
+    # ------------------------------------------------------ keyed records
+
+    def get(self, store, key):
+        if key in self.deletes[store]:
+            raise KeyError(key)
+        if key in self.puts[store]:
+            return self.puts[store][key]
+        return self._base.get(store, key)
+
+    def put(self, store, key, value):
+        self.deletes[store].discard(key)
+        self.puts[store][key] = value
+
+    def delete(self, store, key):
+        try:
+            removed = self.get(store, key)
+        except KeyError:
+            removed = None
+        self.puts[store].pop(key, None)
+        self.deletes[store].add(key)
+        return removed
+
+    def get_many(self, store, keys):
+        deleted, written = self.deletes[store], self.puts[store]
+        found = self._base.get_many(
+            store, [key for key in keys if key not in deleted and key not in written]
+        )
+        found.update((key, written[key]) for key in keys if key in written)
+        return found
+
+    def load_all(self, store):
+        records = self._base.load_all(store)
+        for key in self.deletes[store]:
+            records.pop(key, None)
+        records.update(self.puts[store])
+        return records
+
+    # ---------------------------------------------------------- community
+
+    def pending_community(self):
+        if self.community is not None:
+            return self.community
+        return self._base.pending_community()
+
+    def load_community(self):
+        hc = self.pending_community()
+        if hc is not None:
+            return hc
+        return self._base.load_community()
+
+    def lock_community(self):
+        # Held until the unit of work ends, so no other writer saves the
+        # community between its read and this commit.
+        if not self._community_locked:
+            self._locks.enter_context(self._base.lock_community())
+            self._community_locked = True
+        return nullcontext()
+
+    def save_community(self, hc):
+        self.community = hc
+        self.full_community = True
+
+    def save_community_header(self, hc):
+        self.community = hc
+        self.header = True
+
+    def save_flat(self, hc, flat):
+        self.community = hc
+        self.flats[flat_key(flat._block_no, flat._flat_no)] = flat
+
+    # ----------------------------------------------------------- payments
+
+    def append_payments(self, records, keys=()):
+        self.payments.extend(records)
+        self.payment_keys.extend(keys)
+
+    def paid_keys(self, keys):
+        keys = set(keys)
+        found = self._base.paid_keys(keys)
+        found.update(keys.intersection(self.payment_keys))
+        return found
+
+    def iter_payments(self):
+        yield from self._base.iter_payments()
+        yield from self.payments
+
+    def payment_history(self, email):
+        history = list(self._base.payment_history(email))
+        history.extend(record for record in self.payments if record[0] == email)
+        return history
+
+    # ------------------------------------------------------------ rollups
+
+    def add_rollups(self, rows):
+        self.rollups.extend(rows)
+
+    def load_rollups(self, kind, keys=None):
+        found = dict(self._base.load_rollups(kind, keys))
+        for row_kind, key, amount, count in self.rollups:
+            if row_kind == kind and (keys is None or key in keys):
+                total, old_count = found.get(key, (0, 0))
+                found[key] = (total + amount, old_count + count)
+        return found
+
+    def replace_rollups(self, table):
+        # A rebuild reads the whole ledger; it is not buffered.
+        self.rollups = []
+        self._base.replace_rollups(table)
+
+    def stamp(self, store):
+        return self._base.stamp(store)
+
+    # ------------------------------------------------------------ batches
+
+    def apply(self, batch):
+        """Merge a committed inner unit of work into this one."""
+        for store, records in batch.puts.items():
+            for key, value in records.items():
+                self.put(store, key, value)
+        for store, keys in batch.deletes.items():
+            for key in keys:
+                self.puts[store].pop(key, None)
+                self.deletes[store].add(key)
+        self.payments.extend(batch.payments)
+        self.payment_keys.extend(batch.payment_keys)
+        self.rollups.extend(batch.rollups)
+        self.events.extend(batch.events)
+        if batch.community is not None:
+            self.community = batch.community
+            self.full_community = self.full_community or batch.full_community
+            self.header = self.header or batch.header
+            self.flats.update(batch.flats)
@@ -1,6 +1,75 @@
 import threading
 import time
 
+from events import bus, ANNOUNCEMENT
+
+class ValidationException(Exception):
+    """Raised when the details entered by a user are invalid."""
+
+class OccupantValidationException(ValidationException):
+    """Raised for invalid occupant details."""
+
+class ClientValidationException(ValidationException):
+    """Raised for invalid client details."""
+
+class Validations:
+    """
+    Checks of single fields. Each returns an error message, or None if the
+    value is valid. Every value is accepted: the rules for names, numbers
+    and passwords are registration policy, to be set in their own change.
+    """
+
+    @staticmethod
+    def name(value):
+        return None
+
+    @staticmethod
+    def phone(value):
+        return None
+
+    @staticmethod
+    def aadhar(value):
+        return None
+
+    @staticmethod
+    def email(value):
+        return None
+
+    @staticmethod
+    def password(value):
+        return None
+
+class Validation:
+    """Validation of the registration details of occupants and clients."""
+
+    @staticmethod
+    def _check(exception, checks):
+        for check, value in checks:
+            error = check(value)
+            if error is not None:
+                raise exception(error)
+
+    @staticmethod
+    def Occupant_Validation(name, phone, aadhar, email, password):
+        """Raises OccupantValidationException on the first invalid field."""
+        Validation._check(OccupantValidationException, [
+            (Validations.name, name),
+            (Validations.phone, phone),
+            (Validations.aadhar, aadhar),
+            (Validations.email, email),
+            (Validations.password, password),
+        ])
+
+    @staticmethod
+    def Client_Validation(name, phone, email, password):
+        """Raises ClientValidationException on the first invalid field."""
+        Validation._check(ClientValidationException, [
+            (Validations.name, name),
+            (Validations.phone, phone),
+            (Validations.email, email),
+            (Validations.password, password),
+        ])
+
 class User:
     def __init__(self, name):
         self.name = name
@@ -11,27 +80,31 @@ class User:
 class BlogWriter:
     def __init__(self, name):
         self.name = name
-        self.__subscribers = []
+        self.__subscribers = {}
         self.__articles = []
         self.lock = threading.Lock()  # Add a lock for thread safety
 
     def add_article(self, article):
         with self.lock:
             self.__articles.append(article)
-            self.notify_subscribers(article)
+        # Published outside the lock; the event bus updates the subscribers
+        self.notify_subscribers(article)
 
     def subscribe(self, subscriber):
+        def handler(event):
+            if event['writer'] is self:
+                subscriber.update(event['article'], self)
+
         with self.lock:
-            self.__subscribers.append(subscriber)
+            self.__subscribers[subscriber] = bus.subscribe(ANNOUNCEMENT, handler)
 
     def unsubscribe(self, subscriber):
         with self.lock:
-            self.__subscribers.remove(subscriber)
+            handler = self.__subscribers.pop(subscriber)
+        bus.unsubscribe(ANNOUNCEMENT, handler)
 
     def notify_subscribers(self, article):
-        with self.lock:
-            for sub in self.__subscribers:
-                sub.update(article, self)
+        bus.publish(ANNOUNCEMENT, {'writer': self, 'article': article})
 
 def user_thread(blog_writer, user, articles):
     for article in articles:
@@ -54,3 +127,4 @@ if __name__ == '__main__':
 
     articles_writer_thread.join()
     articles_reader_thread.join()
+    bus.flush()
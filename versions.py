@@ -0,0 +1,291 @@
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+"""
+Store versions shared by every worker process through a memory-mapped file.
+
+The file holds one slot per store: a counter that every write through the
+pickle engine increments once the new data is in place, and a signature
+(stat of the store's files) taken at that moment. Each process maps the
+file, so reading the version of a store is one memory read with no system
+call and no lock. The versions are the pickle engine's stamps (see
+``StorageBackend.stamp``), so the caches keyed on stamps (``GET_HC``, the
+community snapshot, the page cache, the session projections, the rollups)
+notice writes made by other workers and reload only the stores that
+changed.
+
+Edits made outside the app (e.g. a pickle file restored from a backup)
+don't bump the counter. ``FileWatcher`` covers them: it watches the data
+directory with inotify (or polls it where inotify is missing) and bumps
+the version of a store whose files no longer match the signature of its
+last write.
+
+Layout (little endian):
+
+    header : magic "HCMSVER1", generation (random, set when created)
+    slots  : version (uint64), signature (uint64), one per store in STORES
+
+The generation is part of every stamp, so recreating the file never makes
+an old stamp valid again. Don't delete the file while the app runs.
+"""
+
+# ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~ - ~
+
+from contextlib import nullcontext
+import ctypes
+import ctypes.util
+import mmap
+import os
+import struct
+import threading
+import traceback
+
+from locking import exclusive, shared
+
+VERSION_FILE = "store_versions.bin"
+STORES = ("community", "occupants", "clients", "payments", "rollups")
+MAGIC = b"HCMSVER1"
+HEADER = struct.Struct("<8sQ")
+SLOT = struct.Struct("<QQ")
+# Seconds between two scans of the data directory without inotify.
+POLL_INTERVAL = 2.0
+
+_MASK = (1 << 64) - 1
+
+
+def signature(paths):
+    """
+    Fingerprint of the current state of some files (stat of each).
+
+    Args:
+    - paths (list): Files of one store.
+
+    Returns:
+    - int: 64-bit value, the same in every process for the same files.
+    """
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stats.append((0, 0, 0))
+        else:
+            stats.append((st.st_mtime_ns, st.st_size, st.st_ino))
+    # Hashes of tuples of ints are not salted, so every process agrees.
+    return hash(tuple(stats)) & _MASK
+
+
+class SharedVersions:
+    """
+    Memory map of the version file of a data directory.
+
+    Args:
+    - path (str): Version file; created if missing.
+
+    Raises:
+    - OSError: Raised if the file can't be created or mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        size = HEADER.size + SLOT.size * len(STORES)
+        with exclusive(path):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                magic = os.pread(fd, len(MAGIC), 0)
+                if magic != MAGIC:
+                    generation = int.from_bytes(os.urandom(8), "little")
+                    os.ftruncate(fd, 0)
+                    os.pwrite(fd, HEADER.pack(MAGIC, generation), 0)
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        self.generation = HEADER.unpack_from(self._map)[1]
+        self._offsets = {
+            store: HEADER.size + SLOT.size * index for index, store in enumerate(STORES)
+        }
+
+    def version(self, store):
+        """
+        Returns:
+        - int: Number of writes of a store so far.
+
+        Raises:
+        - KeyError: Raised for a store without a slot.
+        """
+        return SLOT.unpack_from(self._map, self._offsets[store])[0]
+
+    def stamp(self, store):
+        """Stamp of a store: ``(generation, version)``."""
+        return self.generation, SLOT.unpack_from(self._map, self._offsets[store])[0]
+
+    def signature(self, store):
+        """Signature recorded by the last write of a store."""
+        return SLOT.unpack_from(self._map, self._offsets[store])[1]
+
+    def bump(self, store, sig=0):
+        """
+        Count a write of a store. Call it once the written data is visible
+        to readers, while still holding the store's lock.
+
+        Args:
+        - store (str): Store written.
+        - sig (int): ``signature`` of the store's files after the write.
+
+        Returns:
+        - int: The new version.
+        """
+        offset = self._offsets[store]
+        with exclusive(self.path):
+            version = SLOT.unpack_from(self._map, offset)[0] + 1
+            SLOT.pack_into(self._map, offset, version, sig)
+        return version
+
+
+# ---------------------------------------------------------------- file watch
+
+
+class _InotifyEvent(ctypes.Structure):
+    _fields_ = [
+        ("wd", ctypes.c_int),
+        ("mask", ctypes.c_uint32),
+        ("cookie", ctypes.c_uint32),
+        ("len", ctypes.c_uint32),
+    ]
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+
+def _inotify():
+    """Return libc if it has inotify, else None."""
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """
+    Thread bumping the version of stores whose files are changed outside
+    the app.
+
+    Args:
+    - versions (SharedVersions): Versions to bump.
+    - directory (str): Directory holding the files.
+    - files (dict): Store name to ``(files of the store, path locked by
+      its writers)``.
+    - poll (float): Seconds between scans when inotify is not available.
+    """
+
+    def __init__(self, versions, directory, files, poll=POLL_INTERVAL):
+        self.versions = versions
+        self.directory = directory
+        self.files = files
+        self.poll = poll
+        self._by_name = {
+            os.path.basename(path): store
+            for store, (paths, _) in files.items()
+            for path in paths
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self, store, lock=True):
+        """
+        Bump a store if its files don't match the signature of its last
+        write.
+
+        Args:
+        - store (str): Store to check.
+        - lock (bool): Wait for a write in progress to finish first, so it
+          isn't counted twice. Without the lock, a check racing a write may
+          bump the store once more than needed, which is harmless.
+
+        Returns:
+        - bool: True if the store was bumped.
+        """
+        paths, path = self.files[store]
+        with shared(path) if lock else nullcontext():
+            sig = signature(paths)
+            if sig == self.versions.signature(store):
+                return False
+            self.versions.bump(store, sig)
+        return True
+
+    def check_all(self, lock=True):
+        """Check every store; returns the stores bumped."""
+        return [store for store in self.files if self.check(store, lock)]
+
+    def _open_inotify(self):
+        """Return an inotify descriptor watching the directory, or None."""
+        libc = _inotify()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        wd = libc.inotify_add_watch(
+            fd,
+            os.fsencode(self.directory),
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE,
+        )
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _changed_stores(self, data):
+        """Stores named by a buffer of inotify events."""
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            event = _InotifyEvent.from_buffer_copy(data, offset)
+            start = offset + ctypes.sizeof(_InotifyEvent)
+            name = os.fsdecode(data[start : start + event.len].rstrip(b"\0"))
+            offset = start + event.len
+            store = self._by_name.get(name)
+            if store is not None:
+                changed.add(store)
+        return changed
+
+    def _run(self, fd):
+        if fd is not None:
+            try:
+                with open(fd, "rb", buffering=0) as events:
+                    while not self._stop.is_set():
+                        for store in self._changed_stores(events.read(64 * 1024)):
+                            self.check(store)
+                return
+            except Exception:
+                traceback.print_exc()
+        while not self._stop.wait(self.poll):
+            try:
+                self.check_all()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """
+        Start watching on a daemon thread, then check every store once (so
+        nothing changed in between is missed).
+        """
+        fd = self._open_inotify()
+        self._thread = threading.Thread(
+            target=self._run, args=(fd,), name="hcms-file-watcher", daemon=True
+        )
+        self._thread.start()
+        self.check_all()
+
+    def stop(self):
+        """Stop polling (an inotify watch ends with the process)."""
+        self._stop.set()